@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+from hashlib import blake2b
+
+AGGREGATES = ['sum', 'min', 'max', 'mean', 'distinct']
+
+# HyperLogLog precision: 2**12 registers give a standard error of about 1.6%.
+HLL_PRECISION = 12
+HLL_REGISTERS = 1 << HLL_PRECISION
+
+# Sketches hold the hashes of up to this many values exactly before switching to
+# registers, so that the many small counts of a typical collection stay small.
+HLL_SPARSE = 64
+
+class HyperLogLog:
+    # A mergeable sketch of the number of distinct values added to it. Values are
+    # hashed with a stable hash rather than Python's randomised one, so that
+    # sketches built by different processes or runs agree. Counts of up to
+    # HLL_SPARSE values are exact; above that the registers give an estimate in
+    # fixed memory. The registers are the same however the values were split
+    # between sketches, so merged results do not depend on jobs or batches.
+
+    def __init__(self):
+        self.hashes = set()
+        self.registers = None
+
+    @staticmethod
+    def hash(value):
+        return int.from_bytes(blake2b(repr(value).encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def addhash(self, valuehash):
+        if self.registers is None:
+            self.hashes.add(valuehash)
+            if len(self.hashes) > HLL_SPARSE:
+                self.densify()
+        else:
+            register = valuehash >> (64 - HLL_PRECISION)
+            rest = valuehash & ((1 << (64 - HLL_PRECISION)) - 1)
+            rank = 64 - HLL_PRECISION - rest.bit_length() + 1
+            if rank > self.registers[register]:
+                self.registers[register] = rank
+
+    def densify(self):
+        (hashes, self.hashes) = (self.hashes, None)
+        self.registers = bytearray(HLL_REGISTERS)
+        for valuehash in hashes:
+            self.addhash(valuehash)
+
+    def add(self, value):
+        self.addhash(HyperLogLog.hash(value))
+
+    def merge(self, other):
+        if other.registers is None:
+            for valuehash in other.hashes:
+                self.addhash(valuehash)
+        else:
+            if self.registers is None:
+                self.densify()
+            self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        if self.registers is None:
+            return len(self.hashes)
+
+        alpha = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+        estimate = alpha * HLL_REGISTERS * HLL_REGISTERS / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * HLL_REGISTERS and zeros:
+            estimate = HLL_REGISTERS * math.log(HLL_REGISTERS / zeros)
+        return round(estimate)
+
+class Aggregates:
+    # Aggregation of a row's scores into the state of an index, one kind per score.
+    # A state is a list holding for each score a sum, a minimum or maximum (None
+    # until a value is seen), a [sum, count] pair for a mean, or a HyperLogLog
+    # sketch for a count of distinct values. States built separately merge in any
+    # order to the same values, and do not grow with the number of rows.
+
+    def __init__(self, kinds, count):
+        for kind in kinds:
+            if kind not in AGGREGATES:
+                raise RuntimeError("Aggregate '" + kind + "' not recognised.")
+        if len(kinds) > count:
+            raise RuntimeError("Number of aggregates must not exceed number of scores.")
+
+        self.kinds = kinds + ['sum'] * (count - len(kinds))
+
+    def new(self):
+        return [0 if kind == 'sum' else [0, 0] if kind == 'mean' else HyperLogLog() if kind == 'distinct' else None
+                for kind in self.kinds]
+
+    def add(self, state, rowscore):
+        for (idx, (kind, value)) in enumerate(zip(self.kinds, rowscore)):
+            if kind == 'sum':
+                state[idx] += value
+            elif kind == 'distinct':
+                state[idx].add(value)
+            elif kind == 'mean':
+                state[idx][0] += value
+                state[idx][1] += 1
+            elif value is not None:
+                if state[idx] is None or (value < state[idx] if kind == 'min' else value > state[idx]):
+                    state[idx] = value
+
+    def merge(self, state, other):
+        for (idx, (kind, value)) in enumerate(zip(self.kinds, other)):
+            if kind == 'sum':
+                state[idx] += value
+            elif kind == 'distinct':
+                state[idx].merge(value)
+            elif kind == 'mean':
+                state[idx][0] += value[0]
+                state[idx][1] += value[1]
+            elif value is not None:
+                if state[idx] is None or (value < state[idx] if kind == 'min' else value > state[idx]):
+                    state[idx] = value
+
+    def values(self, state):
+        return [value.count() if kind == 'distinct' else value[0] / value[1] if kind == 'mean' else value
+                for (kind, value) in zip(self.kinds, state)]
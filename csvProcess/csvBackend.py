@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pymp
+from csvProcess.csvReader import RowBatch
+from csvProcess.csvColumnCache import ColumnBatch
+
+BACKENDS = ['serial', 'pymp', 'process', 'thread']
+
+# Kernels of the open process pool backends. Pool workers are forked after their
+# kernel is registered here, so they inherit it rather than having it pickled.
+kernels = {}
+
+def runkernel(kernelid, rows, start, stop):
+    return kernels[kernelid](rows, start, stop)
+
+def timedkernel(kernel):
+    # Wrap a kernel so that it returns (result, job profile) with just its time.
+    def timed(rows, start, stop):
+        starttime = time.perf_counter()
+        result = kernel(rows, start, stop)
+        return (result, {'seconds': time.perf_counter() - starttime})
+
+    return timed
+
+class Backend:
+    # Runs a tool's row-processing kernel over a batch of rows. The kernel is
+    # called as kernel(rows, start, stop) on contiguous ranges of the batch, one
+    # per job, and map() returns its results in range order, so that merging them
+    # in order gives the same result whatever the backend or number of jobs. Each
+    # job's time is returned with its results, along with its stage timings if
+    # a Profiler is enabled; those of the last batch are kept in jobseconds.
+
+    def __init__(self, name, jobs, kernel, verbosity=1, profiler=None):
+        self.name = name or ('serial' if jobs == 1 else 'pymp')
+        if self.name not in BACKENDS:
+            raise RuntimeError("Backend '" + self.name + "' not recognised.")
+
+        self.jobs = 1 if self.name == 'serial' else jobs
+        self.profiler = profiler if profiler and profiler.enabled else None
+        self.kernel = self.profiler.kernel(kernel) if self.profiler else timedkernel(kernel)
+        self.verbosity = verbosity
+        self.pool = None
+        self.mapseconds = 0
+        self.jobseconds = []
+
+    def batch(self, reader, count):
+        # Forked workers parse their own rows from a shared memory batch; for
+        # threads and the serial backend the rows are parsed as they are read. A
+        # sample's batch also carries the sample units of its rows.
+        if self.name in ('pymp', 'process') or reader.sampler:
+            return reader.batch(count)
+        else:
+            return list(itertools.islice(reader, count))
+
+    def ranges(self, rowcount):
+        if rowcount == 0:
+            return []
+
+        chunk = -(-rowcount // self.jobs)
+        return [(start, min(start + chunk, rowcount)) for start in range(0, rowcount, chunk)]
+
+    def map(self, rows, rowcount=None):
+        rowcount = len(rows) if rowcount is None else rowcount
+        ranges = self.ranges(rowcount)
+        starttime = time.perf_counter()
+        if len(ranges) <= 1:
+            results = [self.kernel(rows, start, stop) for (start, stop) in ranges]
+        elif self.name == 'pymp':
+            shared = pymp.shared.dict()
+            with pymp.Parallel(len(ranges)) as p:
+                (start, stop) = ranges[p.thread_num]
+                result = self.kernel(rows, start, stop)
+                with p.lock:
+                    shared[p.thread_num] = result
+
+            results = [shared[index] for index in range(len(ranges))]
+        elif self.name == 'process':
+            if self.pool is None:
+                kernels[id(self)] = self.kernel
+                self.pool = ProcessPoolExecutor(self.jobs, mp_context=multiprocessing.get_context('fork'))
+
+            futures = [self.pool.submit(runkernel, id(self), rows, start, stop) for (start, stop) in ranges]
+            results = [future.result() for future in futures]
+        else:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(self.jobs)
+
+            futures = [self.pool.submit(self.kernel, rows, start, stop) for (start, stop) in ranges]
+            results = [future.result() for future in futures]
+
+        self.mapseconds = time.perf_counter() - starttime
+        self.jobseconds = [profile['seconds'] for (result, profile) in results]
+        if self.profiler:
+            self.profiler.batch(rowcount, self.mapseconds, [profile for (result, profile) in results])
+        results = [result for (result, profile) in results]
+
+        if self.verbosity >= 2:
+            for index, result in enumerate(results):
+                print("Job " + str(index) + " returned " + str(len(result)) + " results.", file=sys.stderr)
+
+        return results
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+            kernels.pop(id(self), None)
+
+# Number of rows in the first batch when batch sizes are adaptive, and the most a
+# batch may grow by from one batch to the next.
+PROBE_BATCH = 1000
+GROWTH = 4
+
+def rowbytes(rows):
+    # Estimated memory per row of a batch: its raw text if held in shared memory or
+    # a column cache, otherwise the size of the parsed rows, measured on a sample.
+    if isinstance(rows, RowBatch):
+        return rows.offsets[-1] / len(rows)
+    elif isinstance(rows, ColumnBatch):
+        return rows.nbytes() / len(rows)
+
+    sample = rows[::max(1, len(rows) // 100)]
+    return sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in sample) / len(sample)
+
+class BatchSizer:
+    # Chooses the number of rows in each batch. Without a memory budget or target
+    # latency every batch has the fixed size; otherwise the first batch is a small
+    # probe and later sizes follow from the bytes per row and the rows per second
+    # observed so far. With several streams read side by side, as by csvCompare,
+    # each gets an equal share of the memory budget.
+
+    def __init__(self, batch, memory=None, latency=None, limit=None, streams=1, verbosity=1):
+        self.batch = batch
+        self.memory = memory * 1024 * 1024 / streams if memory else None
+        self.latency = latency
+        self.limit = limit
+        self.verbosity = verbosity
+        self.bytesperrow = None
+        self.rowspersec = None
+        self.current = min(batch, PROBE_BATCH) if self.adaptive() else batch
+        self.starttime = None
+
+    def adaptive(self):
+        return bool(self.memory or self.latency)
+
+    def size(self, rowcount=0):
+        self.starttime = time.time()
+        return min(self.current, self.limit - rowcount) if self.limit else self.current
+
+    def record(self, rows):
+        # Update the measurements after a batch has been processed, and choose the
+        # size of the next batch.
+        if not self.adaptive() or len(rows) == 0:
+            return
+
+        elapsed = max(time.time() - self.starttime, 1e-6)
+        bytesperrow = rowbytes(rows)
+        rowspersec = len(rows) / elapsed
+        # Smooth the measurements so that one unusual batch does not swing the size.
+        self.bytesperrow = bytesperrow if self.bytesperrow is None else (self.bytesperrow + bytesperrow) / 2
+        self.rowspersec = rowspersec if self.rowspersec is None else (self.rowspersec + rowspersec) / 2
+
+        sizes = []
+        if self.memory:
+            sizes.append(self.memory / self.bytesperrow)
+        if self.latency:
+            sizes.append(self.latency * self.rowspersec)
+
+        self.current = max(1, min(int(min(sizes)), self.current * GROWTH))
+        if self.verbosity >= 2:
+            print("Batch size " + str(self.current) + " rows, from " + str(int(self.bytesperrow)) + " bytes per row and " + str(int(self.rowspersec)) + " rows per second.", file=sys.stderr)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import sys
+import os
+import csv
+import json
+import random
+import subprocess
+import tempfile
+import time
+import platform
+import multiprocessing
+from datetime import datetime, timedelta
+
+TWEET_COLUMNS = ['id', 'date', 'user', 'text', 'retweets', 'favorites', 'lang']
+DATE_ORDERS = ['ascending', 'descending', 'random']
+LANGUAGES = ['en', 'en', 'en', 'es', 'fr', 'de', 'ja', 'pt']
+
+def generate(outfile, rows=100000, columns=len(TWEET_COLUMNS), words=15, dates='ascending',
+             newlines=0.01, comments=0, seed=0):
+    # Write a tweet-like CSV to outfile. The same arguments always give the same
+    # file. Words, users and hashtags follow a skewed distribution so that a few
+    # are very common, as in real feeds; text has about the given number of words,
+    # and the given fraction of texts contain embedded newlines. Columns beyond the
+    # usual tweet columns are filled with numbers.
+    rng = random.Random(seed)
+    vocabulary = ['word' + str(index) for index in range(5000)]
+    vocabweights = [1 / (index + 1) for index in range(len(vocabulary))]
+    hashtags = ['#tag' + str(index) for index in range(200)]
+    hashweights = [1 / (index + 1) for index in range(len(hashtags))]
+    users = ['user' + str(index) for index in range(max(10, rows // 20))]
+    userweights = [1 / (index + 1) for index in range(len(users))]
+    extracolumns = ['extra' + str(index) for index in range(max(0, columns - len(TWEET_COLUMNS)))]
+
+    start = datetime(2019, 1, 1)
+    seconds = sorted(rng.randrange(365 * 24 * 3600) for index in range(rows))
+    if dates == 'descending':
+        seconds.reverse()
+    elif dates == 'random':
+        rng.shuffle(seconds)
+
+    for index in range(comments):
+        outfile.write('# Generated by csvBench, comment line ' + str(index + 1) + '\n')
+
+    writer = csv.writer(outfile, lineterminator='\n')
+    writer.writerow(TWEET_COLUMNS + extracolumns)
+    for index in range(rows):
+        textwords = rng.choices(vocabulary, vocabweights, k=rng.randint(max(1, words // 2), max(1, words * 3 // 2)))
+        if rng.random() < 0.3:
+            textwords.insert(rng.randrange(len(textwords) + 1), rng.choices(hashtags, hashweights)[0])
+        if rng.random() < 0.2:
+            textwords.insert(0, '@' + rng.choices(users, userweights)[0])
+        text = ' '.join(textwords)
+        if rng.random() < newlines:
+            split = rng.randrange(len(text) + 1)
+            text = text[:split] + '\n' + text[split:]
+
+        writer.writerow([str(1000000 + index),
+                         (start + timedelta(seconds=seconds[index])).strftime('%Y-%m-%d %H:%M:%S'),
+                         rng.choices(users, userweights)[0],
+                         text,
+                         str(int(rng.expovariate(0.2))),
+                         str(int(rng.expovariate(0.1))),
+                         rng.choice(LANGUAGES)] +
+                        [str(rng.randrange(1000)) for column in extracolumns])
+
+# Standard scenarios as (name, tool, arguments, input). Input is 'tweets' for the
+# generated file, or 'counts' for the pair of word counts compared by csvCompare.
+SCENARIOS = [
+    ('filter',           'csvFilter',  ['-f', 'int(retweets) > 5', '-C', 'id', 'user', 'text'], 'tweets'),
+    ('filter-regexp',    'csvFilter',  ['-c', 'text', '-r', r'.*(?P<hashtag>#\w+)', '-C', 'id', 'hashtag'], 'tweets'),
+    ('collect',          'csvCollect', ['-c', 'text', '-r', r'(?P<word>\w+)', '-s', '1 + int(retweets)'], 'tweets'),
+    ('collect-interval', 'csvCollect', ['-c', 'user', '-r', '(?P<user>.+)', '--interval', '1 day'], 'tweets'),
+    ('compare',          'csvCompare', ['-c', 'word', '-s', 'int(frequency)'], 'counts'),
+    ('cloud-word',       'csvCloud',   ['-m', 'word'], 'tweets'),
+]
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(command):
+    # Run a command, returning its wall time in seconds and the peak resident set
+    # size in kilobytes of it and its workers, or raising RuntimeError on failure.
+    starttime = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    (pid, status, rusage) = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - starttime
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError("Command failed: " + ' '.join(command) + '\n' + stderr.decode('utf-8', 'replace').strip())
+
+    maxrss = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+    return (wall, maxrss)
+
+def csvBench(arglist=None):
+    parser = argparse.ArgumentParser(description='Benchmark the csvProcess tools on generated tweet data.',
+                                     fromfile_prefix_chars='@')
+
+    parser.add_argument('-v', '--verbosity', type=int, default=1)
+    parser.add_argument('-j', '--jobs',      type=str, default='1,2,4', help='Comma separated list of job counts to run each scenario with.')
+    parser.add_argument('-b', '--batch',     type=int, default=100000, help='Batch size passed to each tool.')
+    parser.add_argument(      '--backend',   type=str, help='Backend passed to each tool.')
+    parser.add_argument('-s', '--scenario',  type=str, nargs='*', choices=[scenario[0] for scenario in SCENARIOS], help='Scenarios to run, default is all.')
+    parser.add_argument(      '--repeat',    type=int, default=3, help='Number of runs of each scenario, of which the fastest is reported.')
+
+    parser.add_argument('-r', '--rows',      type=int, default=100000, help='Number of rows to generate.')
+    parser.add_argument(      '--columns',   type=int, default=len(TWEET_COLUMNS), help='Number of columns to generate.')
+    parser.add_argument(      '--words',     type=int, default=15, help='Mean number of words of text per row.')
+    parser.add_argument(      '--dates',     type=str, choices=DATE_ORDERS, default='ascending', help='Order of dates in generated rows.')
+    parser.add_argument(      '--newlines',  type=float, default=0.01, help='Fraction of texts containing embedded newlines.')
+    parser.add_argument(      '--comments',  type=int, default=10, help='Number of comment lines at the start of the generated file.')
+    parser.add_argument(      '--seed',      type=int, default=0, help='Seed for generated data.')
+
+    parser.add_argument(      '--generate',  type=str, help='Only write generated data to this file.')
+    parser.add_argument(      '--data-dir',  type=str, help='Directory to keep generated data in, so that it is generated only once, otherwise a temporary directory is used.')
+    parser.add_argument('-o', '--outfile',   type=str, help='Append results as JSON lines to this file, otherwise use stdout.')
+    parser.add_argument(      '--baseline',  type=str, help='Results file from an earlier run to compare rows per second with.')
+
+    args = parser.parse_args(arglist)
+    dataargs = {'rows': args.rows, 'columns': args.columns, 'words': args.words, 'dates': args.dates,
+                'newlines': args.newlines, 'comments': args.comments, 'seed': args.seed}
+
+    if args.generate:
+        with open(args.generate, 'w', newline='') as outfile:
+            generate(outfile, **dataargs)
+        return
+
+    jobslist = [int(jobs) for jobs in args.jobs.split(',')]
+    scenarios = [scenario for scenario in SCENARIOS if not args.scenario or scenario[0] in args.scenario]
+
+    tempdir = None
+    if args.data_dir:
+        datadir = args.data_dir
+        os.makedirs(datadir, exist_ok=True)
+    else:
+        tempdir = tempfile.TemporaryDirectory()
+        datadir = tempdir.name
+
+    # Generated files are named for the arguments that generate them.
+    def dataname(seed):
+        seedargs = dict(dataargs, seed=seed)
+        return '-'.join(str(seedargs[key]) for key in sorted(seedargs))
+
+    def tweetsfile(seed):
+        filename = os.path.join(datadir, 'tweets-' + dataname(seed) + '.csv')
+        if not os.path.isfile(filename):
+            if args.verbosity >= 1:
+                print("Generating " + filename, file=sys.stderr)
+            with open(filename + '.tmp', 'w', newline='') as outfile:
+                generate(outfile, **dict(dataargs, seed=seed))
+            os.replace(filename + '.tmp', filename)
+        return filename
+
+    def countsfile(seed):
+        filename = os.path.join(datadir, 'counts-' + dataname(seed) + '.csv')
+        if not os.path.isfile(filename):
+            run([sys.executable, '-m', 'csvProcess.csvCollect', '-c', 'text', '-r', r'(?P<word>\w+)', '-v', '0', '-o', filename,
+                 tweetsfile(seed)])
+        return filename
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r') as baselinefile:
+            for line in baselinefile:
+                result = json.loads(line)
+                if result.get('rowspersec'):
+                    baseline[(result['scenario'], result['jobs'])] = result['rowspersec']
+
+    outfile = open(args.outfile, 'a') if args.outfile else sys.stdout
+    environment = {'commit':  git_commit(),
+                   'python':  platform.python_version(),
+                   'cpus':    multiprocessing.cpu_count(),
+                   'batch':   args.batch,
+                   'backend': args.backend,
+                   'data':    dataargs}
+
+    try:
+        for (name, tool, toolargs, source) in scenarios:
+            if source == 'counts':
+                infiles = [countsfile(args.seed), countsfile(args.seed + 1)]
+                rows = sum(1 for infile in infiles for line in open(infile) if line[:1] != '#') - len(infiles)
+            else:
+                infiles = [tweetsfile(args.seed)]
+                rows = args.rows
+
+            for jobs in jobslist:
+                command = [sys.executable, '-m', 'csvProcess.' + tool] + toolargs + ['-j', str(jobs), '-b', str(args.batch), '-v', '0']
+                if args.backend:
+                    command += ['--backend', args.backend]
+                if tool == 'csvCloud':
+                    command += ['-o', os.path.join(datadir, 'cloud.png')]
+                else:
+                    command += ['--no-comments']
+                command += infiles
+
+                result = dict(environment, scenario=name, tool=tool, jobs=jobs, rows=rows)
+                try:
+                    runs = [run(command) for repeat in range(args.repeat)]
+                    wall = min(wall for (wall, maxrss) in runs)
+                    result.update(wall=round(wall, 3),
+                                  rowspersec=round(rows / wall, 1),
+                                  maxrss=max(maxrss for (wall, maxrss) in runs))
+                except RuntimeError as error:
+                    result['error'] = str(error)
+
+                outfile.write(json.dumps(result) + '\n')
+                outfile.flush()
+
+                if args.verbosity >= 1:
+                    if 'error' in result:
+                        summary = 'failed: ' + result['error'].splitlines()[-1]
+                    else:
+                        summary = str(int(result['rowspersec'])) + ' rows/s, ' + str(result['maxrss'] // 1024) + ' MB peak'
+                        if (name, jobs) in baseline:
+                            summary += ', ' + format(result['rowspersec'] / baseline[(name, jobs)], '.2f') + 'x baseline'
+                    print(name.ljust(18) + ' -j ' + str(jobs).ljust(3) + summary, file=sys.stderr)
+    finally:
+        if args.outfile:
+            outfile.close()
+        if tempdir:
+            tempdir.cleanup()
+
+if __name__ == '__main__':
+    csvBench(None)
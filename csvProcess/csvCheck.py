@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import sys
+import os
+import filecmp
+import shutil
+import shlex
+import tempfile
+import time
+import traceback
+import subprocess
+import multiprocessing
+from csvProcess.csvBench import generate
+from csvProcess.csvBackend import BACKENDS
+from csvProcess.csvFilter import csvFilter
+from csvProcess.csvCollect import csvCollect
+from csvProcess.csvCompare import csvCompare
+from csvProcess.csvIO import open_text, compression
+
+TOOLS = {'csvFilter': csvFilter, 'csvCollect': csvCollect, 'csvCompare': csvCompare}
+
+# Equivalence cases as (name, tool, arguments, input, extra outputs). Input is the
+# name of a generated file: 'tweets' has embedded newlines and random date order,
+# 'tweets.gz' and 'tweets.zst' are the same compressed, 'sorted' is in date order,
+# and 'counts1' to 'counts3' are word counts collected from other generated tweets.
+# An input named 'pipe:' and a file is read through --pipe, and 'stdin:' and a file
+# as stdin. Extra outputs are options naming further files that must also be
+# identical, such as csvFilter's reject file, or --queries, whose file is written
+# for each run from QUERIES with an output file for every query but the first,
+# which takes the command line's.
+CASES = [
+    ('filter',           'csvFilter',  ['-f', 'int(retweets) > 5', '-C', 'id', 'user', 'text'], 'tweets', ['--rejfile']),
+    ('filter-regexp',    'csvFilter',  ['-c', 'text', '-r', r'.*(?P<hashtag>#\w+)', '-C', 'id', 'hashtag'], 'tweets', ['--rejfile']),
+    ('filter-invert',    'csvFilter',  ['-c', 'text', '-r', r'[@](?P<mention>\w+)', '--invert', '-C', 'id', 'user'], 'tweets', ['--rejfile']),
+    ('filter-data',      'csvFilter',  ['-H', 'word', '-d', '[(word,) for word in text.split()[:3]]', '-C', 'id'], 'tweets', []),
+    ('filter-lazy',      'csvFilter',  ['-H', 'word', '-d', '((word,) for word in text.split()[:3])', '-C', 'id'], 'tweets', []),
+    ('filter-dates',     'csvFilter',  ['--since', '2019-03-01', '--until', '2019-09-01', '-C', 'id', 'date'], 'tweets', []),
+    ('filter-number',    'csvFilter',  ['-f', 'lang == "en"', '-n', '321', '-C', 'id'], 'tweets', []),
+    ('filter-limit',     'csvFilter',  ['-l', '777', '-C', 'id', 'text'], 'tweets', []),
+    ('filter-sample',    'csvFilter',  ['--sample', '0.2', '--sample-block', '30', '--sample-seed', '7', '-C', 'id'], 'tweets', []),
+    ('filter-files',     'csvFilter',  ['-f', 'int(favorites) > 8', '-C', 'id', 'date'], 'tweets sorted', []),
+    ('filter-cache',     'csvFilter',  ['-f', 'int(retweets) > 5', '-C', 'id', 'user', 'text', '--column-cache'], 'tweets', ['--rejfile']),
+    ('filter-gz',        'csvFilter',  ['-f', 'int(retweets) > 5', '-C', 'id', 'user', 'text'], 'tweets.gz', []),
+    ('filter-zst',       'csvFilter',  ['-c', 'text', '-r', r'.*(?P<hashtag>#\w+)', '-C', 'id', 'hashtag'], 'tweets.zst', []),
+    ('filter-pipe',      'csvFilter',  ['-f', 'int(retweets) > 5', '-C', 'id', 'user', 'text'], 'pipe:tweets', []),
+    ('filter-stdin',     'csvFilter',  ['-c', 'text', '-r', r'[@](?P<mention>\w+)', '-C', 'id', 'mention'], 'stdin:tweets', []),
+    ('filter-queries',   'csvFilter',  ['-C', 'id', 'user'], 'tweets', ['--queries']),
+    ('collect',          'csvCollect', ['-c', 'text', '-r', r'(?P<word>\w+)', '-s', '1 + int(retweets)'], 'tweets', []),
+    ('collect-indexes',  'csvCollect', ['-I', '[user, lang]', '-H', 'user', '-s', '1', 'int(favorites)', '-sh', 'tweets', 'favorites'], 'tweets', []),
+    ('collect-interval', 'csvCollect', ['-c', 'user', '-r', '(?P<user>.+)', '--interval', '1 day'], 'sorted', []),
+    ('collect-sort',     'csvCollect', ['-c', 'user', '-r', '(?P<user>.+)', '-t', '5', '--sort=-int(frequency)', '-n', '50'], 'tweets', []),
+    ('collect-limit',    'csvCollect', ['-c', 'text', '-r', r'(?P<tag>#\w+)', '-l', '999'], 'tweets', []),
+    ('collect-aggregate', 'csvCollect', ['-c', 'text', '-r', r'(?P<hashtag>#\w+)', '-s', '1', 'user', 'id', 'int(retweets)', 'int(favorites)', '-a', 'sum', 'distinct', 'distinct', 'max', 'mean'], 'tweets', []),
+    ('collect-sample',   'csvCollect', ['-c', 'text', '-r', r'(?P<word>\w+)', '--sample', '0.3', '-s', '1', 'int(retweets)'], 'tweets', []),
+    ('collect-files',    'csvCollect', ['-c', 'user', '-r', '(?P<user>.+)', '-s', 'int(retweets)'], 'sorted tweets', []),
+    ('collect-cache',    'csvCollect', ['-c', 'text', '-r', r'(?P<word>\w+)', '-s', '1 + int(retweets)', '--column-cache'], 'tweets', []),
+    ('collect-zst',      'csvCollect', ['-c', 'user', '-r', '(?P<user>.+)', '-s', '1', 'int(favorites)'], 'tweets.zst', []),
+    ('collect-stdin',    'csvCollect', ['-c', 'text', '-r', r'(?P<tag>#\w+)', '-s', '1'], 'stdin:tweets', []),
+    ('compare',          'csvCompare', ['-c', 'word', '-s', 'int(frequency)'], 'counts1 counts2', []),
+    ('compare-merge',    'csvCompare', ['-c', 'word', '-s', 'int(frequency)', '--merge'], 'counts1 counts2', []),
+    ('compare-matrix',   'csvCompare', ['-c', 'word', '-s', 'int(frequency)'], 'counts1 counts2 counts3', []),
+    ('compare-number',   'csvCompare', ['-c', 'word', '-s', 'int(frequency)', '-n', '40', '--merge'], 'counts1 counts2 counts3', []),
+]
+
+# Options that change how a tool works but must not change its results. The
+# reference for a case with one of them is run without it.
+MODE_OPTIONS = ['--merge', '--column-cache']
+
+# Queries for cases with --queries, as (name, options, extra outputs).
+QUERIES = [
+    ('english',  '-f "lang == \'en\'"', []),
+    ('popular',  '-f "int(retweets) > 5" -C id text', ['--rejfile']),
+    ('hashtags', '-c text -r ".*(?P<hashtag>#\\w+)" -C id hashtag', []),
+]
+
+# Output files of cases written compressed, by case name. They are compared after
+# decompression, as compressed blocks may depend on the number of jobs.
+OUTPUT_SUFFIXES = {'filter-gz': '.gz', 'filter-zst': '.zst', 'collect-zst': '.zst'}
+
+# Scaling cases, whose time with several jobs is checked against one job.
+SCALING_CASES = ['filter', 'collect']
+
+# The daemon check runs this case through csvDaemon with several pymp jobs, and
+# waits this many seconds for the client's output to end.
+DAEMON_CASE = 'filter'
+DAEMON_TIMEOUT = 60
+
+# Replay cases as (name, stages, input), each stage a tool and its arguments. The
+# stages are run as a pipeline of the installed commands, and the trail recorded
+# in their output is replayed by csvReplay, both as commands and in-process.
+REPLAY_CASES = [
+    ('replay',      [('csvFilter', ['-f', 'int(retweets) > 5', '-C', 'id', 'user', 'text'])], 'tweets'),
+    ('replay-pipe', [('csvFilter', ['-f', 'int(retweets) > 2', '-C', 'id', 'user', 'retweets']),
+                     ('csvCollect', ['-c', 'user', '-r', '(?P<user>.+)', '-s', '1', 'int(retweets)'])], 'tweets'),
+]
+
+def checkdaemon(workdir, tool, arglist, referencefile):
+    # Run a tool through a daemon, reading the client's output through a pipe as a
+    # shell pipeline would, so that any process left holding it open is caught.
+    # Returns a failure or None.
+    socketname = os.path.join(workdir, 'daemon.sock')
+    daemon = subprocess.Popen([sys.executable, '-m', 'csvProcess.csvDaemon', '-v', '0', '-s', socketname], stderr=subprocess.DEVNULL)
+    try:
+        while not os.path.exists(socketname):
+            if daemon.poll() is not None:
+                return "daemon exited with status " + str(daemon.returncode)
+            time.sleep(0.1)
+
+        # A leftover process holding stderr would also hold up whatever reads this
+        # harness's own output.
+        client = subprocess.Popen([sys.executable, '-m', 'csvProcess.csvClient', '-s', socketname, tool] + arglist,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            (output, errors) = client.communicate(timeout=DAEMON_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            client.kill()
+            client.wait()
+            client.stdout.close()
+            return "output not ended within " + str(DAEMON_TIMEOUT) + "s"
+        if client.returncode:
+            return "client exited with status " + str(client.returncode)
+        with open(referencefile, 'rb') as reference:
+            if reference.read() != output:
+                return "output differs from reference"
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    return None
+
+def recordpipe(stages, infiles, outfile):
+    # Run stages as a shell pipeline would, so that the output records the trail
+    # of the whole pipeline. Returns a failure or None.
+    processes = []
+    for (index, (tool, arglist)) in enumerate(stages):
+        arglist = (infiles if index == 0 else []) + arglist + ['-v', '0']
+        if index == len(stages) - 1:
+            arglist += ['-o', outfile]
+        processes.append(subprocess.Popen([tool] + arglist,
+                                          stdin=processes[-1].stdout if processes else subprocess.DEVNULL,
+                                          stdout=subprocess.PIPE if index < len(stages) - 1 else subprocess.DEVNULL,
+                                          stderr=subprocess.PIPE))
+        if index > 0:
+            processes[-2].stdout.close()
+
+    for ((tool, arglist), process) in zip(stages, processes):
+        errors = process.communicate()[1]
+        if process.returncode:
+            return tool + " exited with status " + str(process.returncode) + ': ' + (errors.decode('utf-8', 'replace').strip().splitlines() or [''])[-1]
+
+    return None
+
+def checkreplay(workdir, recordfile, modeargs):
+    # Replay a recorded file in place and compare it, trail included, with what was
+    # recorded. Returns a failure or None.
+    referencefile = recordfile + '.recorded'
+    if not os.path.isfile(referencefile):
+        shutil.copyfile(recordfile, referencefile)
+    replay = subprocess.run([sys.executable, '-m', 'csvProcess.csvReplay', recordfile, '--force', '--no-cache', '-v', '0'] + modeargs,
+                            cwd=workdir, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if replay.returncode:
+        return "csvReplay exited with status " + str(replay.returncode) + ': ' + (replay.stderr.decode('utf-8', 'replace').strip().splitlines() or [''])[-1]
+    if not filecmp.cmp(recordfile, referencefile, shallow=False):
+        return "replayed output differs from recorded"
+
+    return None
+
+def runtool(tool, arglist, stdinfile=None):
+    # Run a tool in this process, so that workers are forked from it rather than
+    # each run paying for a new interpreter, reading stdinfile, if given, as stdin.
+    if stdinfile is None:
+        TOOLS[tool](arglist)
+        return
+
+    savedstdin = os.dup(0)
+    try:
+        with open(stdinfile, 'rb') as infile:
+            os.dup2(infile.fileno(), 0)
+        TOOLS[tool](arglist)
+    finally:
+        os.dup2(savedstdin, 0)
+        os.close(savedstdin)
+
+def samecontent(filename, referencename):
+    # Whether two outputs are identical, after decompression if compressed.
+    if compression(filename) is None:
+        return filecmp.cmp(filename, referencename, shallow=False)
+
+    with open_text(filename) as output, open_text(referencename) as reference:
+        return output.read() == reference.read()
+
+def csvCheck(arglist=None):
+    parser = argparse.ArgumentParser(description='Check that the csvProcess tools give identical results whatever the number of jobs, batch size and backend, and that they scale.',
+                                     fromfile_prefix_chars='@')
+
+    parser.add_argument('-v', '--verbosity',   type=int, default=1)
+    parser.add_argument('-j', '--jobs',        type=str, default='1,2,4', help='Comma separated list of job counts to check.')
+    parser.add_argument('-b', '--batch',       type=str, default='50,997,0', help='Comma separated list of batch sizes to check, 0 for no limit.')
+    parser.add_argument(      '--backend',     type=str, nargs='*', choices=BACKENDS, help='Backends to check with more than one job, default is all.')
+    parser.add_argument('-c', '--case',        type=str, nargs='*', choices=[case[0] for case in CASES], help='Cases to check, default is all.')
+    parser.add_argument('-r', '--rows',        type=int, default=2000, help='Number of rows of generated input.')
+    parser.add_argument(      '--seed',        type=int, default=0, help='Seed for generated input.')
+
+    parser.add_argument(      '--scaling-rows', type=int, default=200000, help='Number of rows of generated input for scaling checks.')
+    parser.add_argument(      '--scaling-jobs', type=int, default=4, help='Number of jobs for scaling checks, reduced to the number of CPUs if there are fewer.')
+    parser.add_argument(      '--min-speedup', type=float, default=1.5, help='Minimum speedup with scaling jobs over one job, reduced in proportion with fewer jobs.')
+    parser.add_argument(      '--no-scaling',  action='store_true', help='Do not run scaling checks.')
+    parser.add_argument(      '--no-daemon',   action='store_true', help='Do not run the check through csvDaemon.')
+    parser.add_argument(      '--no-replay',   action='store_true', help='Do not run the checks through csvReplay.')
+
+    parser.add_argument('-k', '--keep',        type=str, help='Directory to keep inputs and outputs in, otherwise a temporary directory is used.')
+
+    args = parser.parse_args(arglist)
+
+    jobslist = [int(jobs) for jobs in args.jobs.split(',')]
+    batchlist = [int(batch) for batch in args.batch.split(',')]
+    backends = args.backend or [backend for backend in BACKENDS if backend != 'serial']
+    cases = [case for case in CASES if not args.case or case[0] in args.case]
+
+    tempdir = None
+    if args.keep:
+        workdir = args.keep
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        tempdir = tempfile.TemporaryDirectory()
+        workdir = tempdir.name
+
+    def generated(name, suffix='', **generateargs):
+        filename = os.path.join(workdir, name + '.csv' + suffix)
+        with (open_text(filename, 'w') if suffix else open(filename, 'w', newline='')) as outfile:
+            generate(outfile, **generateargs)
+        return filename
+
+    def sourceargs(source):
+        # Input files and options for a case's input, and the file to read as stdin.
+        arglist = []
+        stdinfile = None
+        for infile in source.split():
+            (kind, colon, infile) = infile.rpartition(':')
+            if kind == 'pipe':
+                arglist += ['--pipe', 'cat ' + shlex.quote(inputs[infile])]
+            elif kind == 'stdin':
+                stdinfile = inputs[infile]
+            else:
+                arglist.append(inputs[infile])
+        return (arglist, stdinfile)
+
+    # The reference for each case is a single serial batch.
+    reference = ['-j', '1', '-b', '0', '--backend', 'serial']
+    inputs = {'tweets': generated('tweets', rows=args.rows, dates='random', newlines=0.05, comments=3, seed=args.seed),
+              'sorted': generated('sorted', rows=args.rows, dates='ascending', seed=args.seed)}
+    for suffix in ('.gz', '.zst'):
+        inputs['tweets' + suffix] = generated('tweets', suffix, rows=args.rows, dates='random', newlines=0.05, comments=3, seed=args.seed)
+    for index in range(1, 4):
+        inputs['counts' + str(index)] = os.path.join(workdir, 'counts' + str(index) + '.csv')
+        runtool('csvCollect', [generated('counts' + str(index) + '-tweets', rows=args.rows, seed=args.seed + index),
+                               '-c', 'text', '-r', r'(?P<word>\w+)', '-v', '0', '--no-comments', '-o', inputs['counts' + str(index)]] + reference)
+
+    variants = [(1, batch, 'serial') for batch in batchlist]
+    variants += [(jobs, batch, backend) for jobs in jobslist if jobs > 1 for batch in batchlist for backend in backends]
+
+    failures = []
+    checks = 0
+    for (name, tool, toolargs, source, extraoutputs) in cases:
+        (infiles, stdinfile) = sourceargs(source)
+        suffix = OUTPUT_SUFFIXES.get(name, '')
+
+        def run(label, variantargs, caseargs=toolargs):
+            outputs = [os.path.join(workdir, name + '-' + label + '.csv' + suffix)]
+            extraargs = []
+            for option in extraoutputs:
+                if option == '--queries':
+                    queryfilename = os.path.join(workdir, name + '-' + label + '.queries')
+                    with open(queryfilename, 'w') as queryfile:
+                        for (queryindex, (queryname, queryoptions, queryoutputs)) in enumerate(QUERIES):
+                            queryargs = []
+                            for queryoption in (['--outfile'] if queryindex else []) + queryoutputs:
+                                outputs.append(os.path.join(workdir, name + '-' + label + '.' + queryname + queryoption.replace('-', '.') + '.csv'))
+                                queryargs += [queryoption, shlex.quote(outputs[-1])]
+                            print(queryname + ': ' + ' '.join([queryoptions] + queryargs), file=queryfile)
+                    extraargs += [option, queryfilename]
+                else:
+                    outputs.append(os.path.join(workdir, name + '-' + label + option.replace('-', '.') + '.csv'))
+                    extraargs += [option, outputs[-1]]
+            runtool(tool, infiles + caseargs + extraargs + variantargs + ['-v', '0', '--no-comments', '-o', outputs[0]], stdinfile)
+            return outputs
+
+        referenceoutputs = run('reference', reference, [arg for arg in toolargs if arg not in MODE_OPTIONS])
+        for (jobs, batch, backend) in variants:
+            label = 'j' + str(jobs) + '-b' + str(batch) + '-' + backend
+            checks += 1
+            try:
+                outputs = run(label, ['-j', str(jobs), '-b', str(batch), '--backend', backend])
+                different = [os.path.basename(output) for (output, referenceoutput) in zip(outputs, referenceoutputs)
+                             if not samecontent(output, referenceoutput)]
+                if different:
+                    failures.append(name + ' ' + label + ': ' + ', '.join(different) + ' differ from reference')
+            except (Exception, SystemExit):
+                failures.append(name + ' ' + label + ': ' + traceback.format_exc().strip().splitlines()[-1])
+
+        if args.verbosity >= 1:
+            casefailures = sum(1 for failure in failures if failure.startswith(name + ' '))
+            print(name.ljust(18) + str(len(variants) - casefailures) + '/' + str(len(variants)) + ' identical', file=sys.stderr)
+
+    if not args.no_daemon:
+        (name, tool, toolargs, source, extraoutputs) = next(case for case in CASES if case[0] == DAEMON_CASE)
+        (infiles, stdinfile) = sourceargs(source)
+        referencefile = os.path.join(workdir, 'daemon-reference.csv')
+        runtool(tool, infiles + toolargs + reference + ['-v', '0', '--no-comments', '-o', referencefile])
+        checks += 1
+        failure = checkdaemon(workdir, tool, infiles + toolargs + ['-j', '2', '-b', '997', '--backend', 'pymp', '-v', '0', '--no-comments'], referencefile)
+        if failure:
+            failures.append(name + ' daemon: ' + failure)
+        if args.verbosity >= 1:
+            print((name + ' daemon').ljust(18) + (failure or 'identical'), file=sys.stderr)
+
+    if not args.no_replay:
+        for (name, stages, source) in REPLAY_CASES:
+            (infiles, stdinfile) = sourceargs(source)
+            recordfile = os.path.join(workdir, name + '.csv')
+            failure = recordpipe(stages, infiles, recordfile)
+            for (label, modeargs) in (('command', []), ('in-process', ['--in-process'])):
+                checks += 1
+                casefailure = failure or checkreplay(workdir, recordfile, modeargs)
+                if casefailure:
+                    failures.append(name + ' ' + label + ': ' + casefailure)
+                if args.verbosity >= 1:
+                    print((name + ' ' + label + ' ').ljust(18) + (casefailure or 'identical'), file=sys.stderr)
+
+    if not args.no_scaling:
+        # With fewer CPUs than scaling jobs, scaling is checked with as many jobs as
+        # CPUs and a speedup reduced in proportion.
+        scalingjobs = min(args.scaling_jobs, multiprocessing.cpu_count())
+        minspeedup = 1 + (args.min_speedup - 1) * (scalingjobs - 1) / max(args.scaling_jobs - 1, 1)
+        if scalingjobs < 2:
+            if args.verbosity >= 1:
+                print("Skipping scaling checks on " + str(multiprocessing.cpu_count()) + " CPU.", file=sys.stderr)
+        else:
+            if scalingjobs < args.scaling_jobs and args.verbosity >= 1:
+                print("Checking scaling with " + str(scalingjobs) + " jobs on " + str(multiprocessing.cpu_count()) + " CPUs, minimum speedup " + format(minspeedup, '.2f') + ".", file=sys.stderr)
+            scalinginput = generated('scaling', rows=args.scaling_rows, seed=args.seed)
+            for (name, tool, toolargs, source, extraoutputs) in CASES:
+                if name not in SCALING_CASES:
+                    continue
+
+                timings = []
+                for jobs in (1, scalingjobs):
+                    starttime = time.perf_counter()
+                    runtool(tool, [scalinginput] + toolargs + ['-j', str(jobs), '-v', '0', '--no-comments', '-o', os.path.join(workdir, 'scaling.out.csv')])
+                    timings.append(time.perf_counter() - starttime)
+
+                checks += 1
+                speedup = timings[0] / timings[1]
+                if speedup < minspeedup:
+                    failures.append(name + ' scaling: speedup ' + format(speedup, '.2f') + ' with ' + str(scalingjobs) + ' jobs is below ' + format(minspeedup, '.2f'))
+                if args.verbosity >= 1:
+                    print(name.ljust(18) + 'speedup ' + format(speedup, '.2f') + ' with ' + str(scalingjobs) + ' jobs', file=sys.stderr)
+
+    if tempdir:
+        tempdir.cleanup()
+
+    for failure in failures:
+        print("FAIL " + failure, file=sys.stderr)
+    if args.verbosity >= 1:
+        print(str(checks - len(failures)) + " of " + str(checks) + " checks passed.", file=sys.stderr)
+
+    return not failures
+
+def main():
+    sys.exit(0 if csvCheck(None) else 1)
+
+if __name__ == '__main__':
+    main()
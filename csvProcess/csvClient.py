@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import sys
+import os
+import json
+import socket
+import tempfile
+import importlib
+
+# The client imports only what it needs to reach a daemon, so that it starts
+# quickly; the daemon shares these definitions.
+
+# Tools the daemon runs, each a module of csvProcess with a function of the same
+# name taking an argument list.
+TOOLS = ['csvFilter', 'csvCollect', 'csvCompare', 'csvCloud']
+
+MESSAGE_SIZE = 1 << 16
+
+def default_socket():
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), 'csvProcess-' + str(os.getuid()) + '.sock')
+
+def tool_function(tool):
+    # The module file and function of a tool, so that its comments name it as if
+    # run from the command line.
+    module = importlib.import_module('csvProcess.' + tool)
+    return (module.__file__, getattr(module, tool))
+
+def run(tool, arglist, socketname=None):
+    # Run a tool by a daemon listening on socketname, passing it this process's
+    # stdin, stdout and stderr, and return its exit status. Without a daemon the
+    # tool is run in this process.
+    connection = socket.socket(socket.AF_UNIX)
+    try:
+        connection.connect(socketname or default_socket())
+    except (FileNotFoundError, ConnectionRefusedError):
+        connection.close()
+        (filename, function) = tool_function(tool)
+        sys.argv = [filename] + arglist
+        try:
+            function(arglist)
+        except SystemExit as exit:
+            return exit.code if isinstance(exit.code, int) else 0 if exit.code is None else 1
+        return 0
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    request = {'tool': tool, 'args': arglist, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+    socket.send_fds(connection, [(json.dumps(request) + '\n').encode('utf-8')], [0, 1, 2])
+
+    reply = b''
+    while not reply.endswith(b'\n'):
+        data = connection.recv(MESSAGE_SIZE)
+        if not data:
+            raise RuntimeError("Daemon ended without completing " + tool + ".")
+        reply += data
+
+    connection.close()
+    return json.loads(reply)['status']
+
+def csvClient(arglist=None):
+    parser = argparse.ArgumentParser(description='Run a csvProcess tool by a csvDaemon if one is listening, otherwise in this process.')
+
+    parser.add_argument('-s', '--socket', type=str, help='Unix socket of the daemon, default is csvProcess-<uid>.sock in the runtime or temporary directory.')
+    parser.add_argument('tool',           type=str, choices=TOOLS, help='Tool to run.')
+    parser.add_argument('arglist',        nargs=argparse.REMAINDER, help='Arguments for the tool.')
+
+    args = parser.parse_args(arglist)
+    return run(args.tool, args.arglist, args.socket)
+
+if __name__ == '__main__':
+    sys.exit(csvClient(None))
@@ -16,18 +16,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from __future__ import print_function
 import argparse
 import sys
 import os
 import codecs
-import unicodecsv
 import string
 import re
 from dateutil import parser as dateparser
-import pymp
 from wordcloud import WordCloud
 import subprocess
+from csvProcess.csvReader import CSVReader, RowBatch, expression_columns
+from csvProcess.csvBackend import Backend, BatchSizer, BACKENDS
+from csvProcess.csvMetrics import Metrics
+from csvProcess.csvLookup import lookup
 
 def csvCloud(arglist):
     parser = argparse.ArgumentParser(description='Twitter feed word cloud.',
@@ -35,7 +36,12 @@ def csvCloud(arglist):
 
     parser.add_argument('-v', '--verbosity', type=int, default=1)
     parser.add_argument('-j', '--jobs',      type=int, help='Number of parallel tasks, default is number of CPUs')
-    parser.add_argument('-b', '--batch',     type=int, default=100000, help='Number of tweets to process per batch. Use to limit memory usage with very large files. May affect performance but not results.')
+    parser.add_argument('-b', '--batch',     type=int, default=100000, help='Number of tweets to process per batch, 0 for no limit. Use to limit memory usage with very large files. May affect performance but not results.')
+    parser.add_argument(      '--batch-memory', type=float, help='Adapt batch sizes to use about this many megabytes of input per batch. May affect performance but not results.')
+    parser.add_argument(      '--batch-time', type=float, help='Adapt batch sizes to take about this many seconds per batch. May affect performance but not results.')
+    parser.add_argument(      '--backend',   type=str, choices=BACKENDS, help='How to run parallel tasks, default is pymp, or serial for a single job. May affect performance but not results.')
+    parser.add_argument(      '--metrics',   type=str, nargs='?', const='-', help='Report progress metrics to stderr, or append them as JSON lines to this file.')
+    parser.add_argument(      '--metrics-interval', type=float, default=10, help='Seconds between progress metrics reports.')
 
     parser.add_argument('-p', '--prelude',   type=str, nargs="*", help='Python code to execute before processing')
     parser.add_argument('-f', '--filter',    type=str, help='Python expression evaluated to determine whether tweet is included')
@@ -46,7 +52,7 @@ def csvCloud(arglist):
 
     parser.add_argument('-c', '--column',    type=str, default='text', help='Text column')
     parser.add_argument('-s', '--score',     type=str,                 help='Comma separated list of score columns')
-    parser.add_argument('-x', '--exclude',   type=lambda s: unicode(s, 'utf8'), help='Comma separated list of words to exclude from cloud')
+    parser.add_argument('-x', '--exclude',   type=str, help='Comma separated list of words to exclude from cloud')
 
     parser.add_argument('-m', '--mode',      choices=['word', 'lemma', 'phrase'], default='word')
 
@@ -58,13 +64,13 @@ def csvCloud(arglist):
     parser.add_argument('-o', '--outfile', type=str, help='Output image file, otherwise display on screen.')
 
     parser.add_argument('-P', '--pipe', type=str,            help='Command to pipe input from')
-    parser.add_argument('infile',       type=str, nargs='?', help='Input CSV file, if neither input nor pipe is specified, stdin is used.')
+    parser.add_argument('infile',       type=str, nargs='*', help='Input CSV files or glob patterns, read in order as one input. If neither input nor pipe is specified, stdin is used.')
 
     parser.add_argument('--no-comments',     action='store_true',
                                                     help='Do not produce a comments logfile')
 
     args = parser.parse_args(arglist)
-    hiddenargs = ['verbosity', 'jobs', 'batch', 'no_comments']
+    hiddenargs = ['verbosity', 'jobs', 'batch', 'batch_memory', 'batch_time', 'backend', 'metrics', 'metrics_interval', 'no_comments']
 
     if args.jobs is None:
         import multiprocessing
@@ -74,33 +80,23 @@ def csvCloud(arglist):
         print("Using " + str(args.jobs) + " jobs.", file=sys.stderr)
 
     if args.batch == 0:
-        args.batch = sys.maxint
+        args.batch = sys.maxsize
+
+    namespace = dict(globals())
+    namespace['args'] = args
 
     if args.prelude:
         if args.verbosity >= 1:
             print("Executing prelude code.", file=sys.stderr)
 
-        exec(os.linesep.join(args.prelude)) in globals()
+        exec(os.linesep.join(args.prelude), namespace)
 
     until = dateparser.parse(args.until) if args.until else None
     since = dateparser.parse(args.since) if args.since else None
 
-    if args.infile:
-        infile = open(args.infile, 'rU')
-    elif args.pipe:
-        infile = subprocess.Popen(args.pipe, stdout=subprocess.PIPE, shell=True).stdout
-    else:
-        infile = sys.stdin
-
-    # Skip comments at start of infile.
-    incomments = ''
-    while True:
-        line = infile.readline()
-        if line[:1] == '#':
-            incomments += line
-        else:
-            infieldnames = next(unicodecsv.reader([line]))
-            break
+    inreader = CSVReader(args.infile, args.pipe)
+    incomments = inreader.comments
+    infieldnames = inreader.fieldnames
 
     if args.outfile and not args.no_comments:
         comments = (' ' + args.outfile + ' ').center(80, '#') + '\n'
@@ -110,7 +106,7 @@ def csvCloud(arglist):
             if arg not in hiddenargs:
                 val = getattr(args, arg)
                 argstr = arg.replace('_', '-')
-                if type(val) == str or type(val) == unicode:
+                if type(val) == str:
                     comments += '#     --' + argstr + '="' + val + '"\n'
                 elif type(val) == bool:
                     if val:
@@ -130,21 +126,35 @@ def csvCloud(arglist):
         logfile.write(incomments)
         logfile.close()
 
-    inreader=unicodecsv.DictReader(infile, fieldnames=infieldnames)
-
     argbadchars = re.compile(r"[^0-9a-zA-Z_]")
+    score = args.score.split(',') if args.score else None
+
+    for col in [args.column] + (score or []):
+        if col not in infieldnames:
+            raise RuntimeError("Column '" + col + "' not present in input data.")
+
+    # Only parse the columns used by the filter, text, score and dates.
+    exprcolumns = expression_columns([args.filter] if args.filter else [], infieldnames, lambda v: argbadchars.sub('_', v))
+    if exprcolumns is not None:
+        inreader.project(set(exprcolumns + [args.column] + (score or []) + ([args.datecol] if since or until else [])))
+
+    fieldindex = inreader.fieldindex
+    cleanfieldnames = [argbadchars.sub('_', fieldname) for fieldname in inreader.fieldnames]
+    columnindex = fieldindex[args.column]
+    dateindex = fieldindex.get(args.datecol)
+    scoreindexes = [fieldindex[col] for col in score] if score else None
+
     if args.filter:
-        exec "\
-def evalfilter(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twitterread.fieldnames]) + ",**kwargs):\n\
-    return " + args.filter in locals()
+        exec("\
+def evalfilter(" + ','.join(cleanfieldnames + ['**kwargs']) + "):\n\
+    return " + args.filter, namespace)
+        evalfilter = namespace['evalfilter']
 
     from nltk.corpus import stopwords
     exclude = set(stopwords.words('english'))
     if args.exclude is not None:
         exclude = exclude.union(word.lower() for word in args.exclude.split(','))
 
-    score = args.score.split(',') if args.score else None
-
     if args.mode == 'lemma':
         from nltk import word_tokenize, pos_tag
         from nltk.corpus import wordnet
@@ -155,22 +165,18 @@ def evalfilter(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in tw
     if args.verbosity >= 1:
         print("Loading CSV data.", file=sys.stderr)
 
-    inrowcount = 0
-    mergedscoredicts = {}
+    # Score the words of rows[start:stop], returning their scores by word.
+    def cloudkernel(rows, start, stop):
+        scoredict = {}
+        for rowindex in range(start, stop):
+            row = rows[rowindex]
 
-    # NB Code for single- and multi-threaded processing is separate
-    if args.jobs == 1:
-        for row in inreader:
-            if args.limit and inrowcount == args.limit:
-                break
-            inrowcount += 1
-
-            rowargs = {argbadchars.sub('_', key): value for key, value in row.iteritems()}
+            rowargs = dict(zip(cleanfieldnames, row))
             keep = True
             if args.filter:
                 keep = evalfilter(**rowargs) or False
             if keep and (since or until):
-                date = row.get(args.datecol)
+                date = row[dateindex] if dateindex is not None else None
                 if date:
                     date = dateparser.parse(date)
                     if until and date >= until:
@@ -181,7 +187,7 @@ def evalfilter(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in tw
             if not keep:
                 continue
 
-            text = row[args.column]
+            text = row[columnindex]
             if args.mode == 'lemma':
                 wordlist = []
                 words = pos_tag(word_tokenize(text))
@@ -207,104 +213,47 @@ def evalfilter(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in tw
                 wordlist = [text]
 
             for word in wordlist:
-                if score is None:
+                if scoreindexes is None:
                     wordscore = 1
                 else:
                     wordscore = 0
-                    for col in score:
-                        wordscore += int(row[col])
+                    for scoreindex in scoreindexes:
+                        wordscore += int(row[scoreindex])
 
-                mergedscoredicts[word] = mergedscoredicts.get(word, 0) + wordscore
+                scoredict[word] = scoredict.get(word, 0) + wordscore
 
-    else:
-        while True:
-            if args.verbosity >= 2:
-                print("Loading batch.", file=sys.stderr)
-
-            rows = []
-            batchcount = 0
-            while batchcount < args.batch:
-                if args.limit and inrowcount == args.limit:
-                    break
-                try:
-                    rows.append(next(inreader))
-                    inrowcount += 1
-                    batchcount += 1
-                except StopIteration:
-                    break
-
-            if batchcount == 0:
-                break
-
-            if args.verbosity >= 2:
-                print("Processing batch.", file=sys.stderr)
-
-            rowcount = len(rows)
-            scoredicts = pymp.shared.list()
-            with pymp.Parallel(args.jobs) as p:
-                scoredict = {}
-                for rowindex in p.range(0, rowcount):
-                    row = rows[rowindex]
-
-                    rowargs = {argbadchars.sub('_', key): value for key, value in row.iteritems()}
-                    keep = True
-                    if args.filter:
-                        keep = evalfilter(**rowargs) or False
-                    if keep and (since or until):
-                        date = row.get(args.datecol)
-                        if date:
-                            date = dateparser.parse(date)
-                            if until and date >= until:
-                                keep = False
-                            elif since and date < since:
-                                keep = False
-
-                    if not keep:
-                        continue
-
-                    text = row[args.column]
-                    if args.mode == 'lemma':
-                        if args.mode == 'lemma':
-                            wordlist = []
-                            words = pos_tag(word_tokenize(text))
-                            for word in words:
-
-                                if word[1].startswith('J'):
-                                    pos = wordnet.ADJ
-                                elif word[1].startswith('V'):
-                                    pos = wordnet.VERB
-                                elif word[1].startswith('N'):
-                                    pos = wordnet.NOUN
-                                elif word[1].startswith('R'):
-                                    pos = wordnet.ADV
-                                else:
-                                    pos = None
-
-                                if pos:
-                                    lemma = lemmatizer.lemmatize(word[0], pos=pos)
-                                    if lemma.lower() not in exclude:
-                                        wordlist += [lemma]
-                    elif args.mode == 'word':
-                        wordlist = [word for word in text.split() if word.lower() not in exclude]
-                    else:
-                        wordlist = [text]
+        return scoredict
 
-                    for word in wordlist:
-                        if score is None:
-                            wordscore = 1
-                        else:
-                            wordscore = 0
-                            for col in score:
-                                wordscore += int(row[col])
+    backend = Backend(args.backend, args.jobs, cloudkernel, args.verbosity)
+    sizer = BatchSizer(args.batch, args.batch_memory, args.batch_time, args.limit, verbosity=args.verbosity)
+    metrics = Metrics(args.metrics, args.metrics_interval, sys.argv[0], inreader)
+
+    inrowcount = 0
+    mergedscoredicts = {}
+    while True:
+        if args.verbosity >= 2:
+            print("Loading batch.", file=sys.stderr)
+
+        rows = backend.batch(inreader, sizer.size(inrowcount))
+        inrowcount += len(rows)
+        if len(rows) == 0:
+            break
+
+        if args.verbosity >= 2:
+            print("Processing batch.", file=sys.stderr)
 
-                        scoredict[word] = scoredict.get(word, 0) + wordscore
+        for scoredict in backend.map(rows):
+            for index in scoredict:
+                mergedscoredicts[index] = mergedscoredicts.get(index, 0) + scoredict[index]
 
-                with p.lock:
-                    scoredicts += [scoredict]
+        sizer.record(rows)
+        metrics.batch(rows, backend, inrowcount)
+        if isinstance(rows, RowBatch):
+            rows.close()
 
-            for scoredict in scoredicts:
-                for index in scoredict:
-                    mergedscoredicts[index] = mergedscoredicts.get(index, 0) + scoredict[index]
+    metrics.close()
+    backend.close()
+    inreader.close()
 
     if args.verbosity >= 1:
         print("Generating word cloud.", file=sys.stderr)
@@ -23,7 +23,6 @@ import shutil
 import csv
 import string
 import multiprocessing
-import pymp
 import re
 from dateutil import parser as dateparser
 import calendar
@@ -31,18 +30,46 @@ from pytimeparse.timeparse import timeparse
 from operator import sub, add
 import subprocess
 import datetime
+import time
 from decimal import *
 import itertools
-from more_itertools import peekable
-
-def csvCollect(arglist=None):
+import math
+from csvProcess.csvPipeline import RowStream
+from csvProcess.csvReader import CSVReader, RowBatch, expression_columns
+from csvProcess.csvAggregate import Aggregates, AGGREGATES
+from csvProcess.csvBackend import Backend, BatchSizer, BACKENDS
+from csvProcess.csvStats import write_stats
+from csvProcess.csvProfile import Profiler
+from csvProcess.csvMetrics import Metrics
+from csvProcess.csvIO import open_text
+from csvProcess.csvLookup import lookup
+
+# A sample's scores are also summed in this many groups of sample units, whose
+# spread gives the variance of the estimated totals; and the Student t quantile for
+# 95% confidence with one fewer degrees of freedom.
+SAMPLE_GROUPS = 20
+SAMPLE_T95 = 2.093
+
+# If source is given, it is read in place of infile, pipe or stdin; it may be a text
+# stream or the RowStream of an upstream tool. If pipeout is true, output rows are
+# returned as a RowStream rather than written to outfile.
+def csvCollect(arglist=None, source=None, pipeout=False):
+    starttime = time.time()
 
     parser = ArgumentRecorder(description='CSV data collection.',
                               fromfile_prefix_chars='@')
 
     parser.add_argument('-v', '--verbosity',  type=int, default=1, private=True)
     parser.add_argument('-j', '--jobs',       type=int, help='Number of parallel tasks, default is number of CPUs. May affect performance but not results.', private=True)
-    parser.add_argument('-b', '--batch',      type=int, default=100000, help='Number of rows to process per batch. Use to limit memory usage with very large files. May affect performance but not results.', private=True)
+    parser.add_argument('-b', '--batch',      type=int, default=100000, help='Number of rows to process per batch, 0 for no limit. Use to limit memory usage with very large files. May affect performance but not results.', private=True)
+    parser.add_argument(      '--batch-memory', type=float, help='Adapt batch sizes to use about this many megabytes of input per batch. May affect performance but not results.', private=True)
+    parser.add_argument(      '--batch-time', type=float, help='Adapt batch sizes to take about this many seconds per batch. May affect performance but not results.', private=True)
+    parser.add_argument(      '--profile',    type=str, help='Write a JSON report of the time spent in each stage of processing to this file.', private=True)
+    parser.add_argument(      '--cprofile',   type=str, help='Write cProfile statistics for the filter, indexes and score code to this file.', private=True)
+    parser.add_argument(      '--metrics',    type=str, nargs='?', const='-', help='Report progress metrics to stderr, or append them as JSON lines to this file.', private=True)
+    parser.add_argument(      '--metrics-interval', type=float, default=10, help='Seconds between progress metrics reports.', private=True)
+    parser.add_argument(      '--backend',    type=str, choices=BACKENDS, help='How to run parallel tasks, default is pymp, or serial for a single job. May affect performance but not results.', private=True)
+    parser.add_argument(      '--column-cache', action='store_true', help='Read an input file through a columnar cache beside it, built on first use and whenever the file changes. May affect performance but not results.', private=True)
 
     parser.add_argument('-p', '--prelude',    type=str, nargs="*", help='Python code to execute before processing')
     parser.add_argument('-f', '--filter',     type=str, help='Python expression evaluated to determine whether row is included')
@@ -50,6 +77,9 @@ def csvCollect(arglist=None):
     parser.add_argument(      '--until',      type=str, help='Upper bound date/time in any sensible format.')
     parser.add_argument(      '--datecol',    type=str, help='Column containing date/time date', default='date')
     parser.add_argument('-l', '--limit',      type=int, help='Limit number of rows to process')
+    parser.add_argument(      '--sample',     type=float, help='Process a random sample of this fraction of rows, or of blocks of rows.')
+    parser.add_argument(      '--sample-block', type=int, help='Sample blocks of this many consecutive rows rather than single rows.')
+    parser.add_argument(      '--sample-seed', type=int, help='Seed for random sampling, default is 0.')
 
     parser.add_argument('-r', '--regexp',     type=str, help='Regular expression to create values to collect.')
     parser.add_argument('-c', '--column',     type=str, help='Column to apply regular expression, default is "text"')
@@ -59,6 +89,7 @@ def csvCollect(arglist=None):
 
     parser.add_argument('-sh', '--score-header', type=str, nargs="*", help='Names of columns to create for row scores.')
     parser.add_argument('-s', '--score',      type=str, nargs="*", default=['1'], help='Python expression(s) to evaluate row score(s), for example "1 + retweets + favorites"')
+    parser.add_argument('-a', '--aggregate',  type=str, nargs="*", choices=AGGREGATES, help='How to aggregate each score, default is sum. The first score is used for the threshold and sorting, so should be numeric.')
     parser.add_argument('-t', '--threshold',  type=float, help='Threshold (first) score for result to be output')
 
     parser.add_argument('-in', '--interval',  type=str, help='Interval for measuring frequency, for example "1 day".')
@@ -71,9 +102,15 @@ def csvCollect(arglist=None):
     parser.add_argument('--no-header',        action='store_true', help='Do not output CSV header with column names')
 
     parser.add_argument('-P', '--pipe', type=str,            help='Command to pipe input from')
-    parser.add_argument('infile',       type=str, nargs='?', help='Input CSV file, if neither input nor pipe is specified, stdin is used.', input=True)
+    parser.add_argument('infile',       type=str, nargs='*', help='Input CSV files or glob patterns, read in order as one input. If neither input nor pipe is specified, stdin is used.', input=True)
 
     args = parser.parse_args(arglist)
+    profiler = Profiler(args.profile, args.cprofile)
+
+    # Namespace for prelude and generated code, kept per call so that chained
+    # in-process stages do not overwrite each other's functions.
+    namespace = dict(globals())
+    namespace['args'] = args
 
     if (args.regexp is None) == (args.indexes is None):
         raise RuntimeError("Exactly one of 'indexes' and 'regexp' must be specified.")
@@ -81,17 +118,25 @@ def csvCollect(arglist=None):
     if args.regexp and not args.column:
         raise RuntimeError("'column' must be specified for regexp.")
 
-    if args.interval:   # Multiprocessing requires single thread
-        args.jobs = 1
+    if args.sample is not None and args.interval:
+        raise RuntimeError("Sampling cannot be used with an interval.")
+
+    # Scores that are all summed keep to the faster addition of score lists.
+    if args.aggregate and any(kind != 'sum' for kind in args.aggregate):
+        aggregates = Aggregates(args.aggregate, len(args.score))
+        if args.interval or args.sample is not None:
+            raise RuntimeError("Only summed scores can be used with an interval or sample.")
     else:
-        if args.jobs is None:
-            args.jobs = multiprocessing.cpu_count()
+        aggregates = None
 
-        if args.verbosity >= 1:
-            print("Using " + str(args.jobs) + " jobs.", file=sys.stderr)
+    if args.jobs is None:
+        args.jobs = multiprocessing.cpu_count()
 
-        if args.batch is None:
-            args.batch = sys.maxint
+    if args.verbosity >= 1:
+        print("Using " + str(args.jobs) + " jobs.", file=sys.stderr)
+
+    if args.batch == 0:
+        args.batch = sys.maxsize
 
     if args.prelude:
         if args.verbosity >= 1:
@@ -99,7 +144,7 @@ def csvCollect(arglist=None):
         if args.verbosity >= 2:
             print(os.linesep.join(args.prelude), file=sys.stderr)
 
-        exec(os.linesep.join(args.prelude), globals())
+        exec(os.linesep.join(args.prelude), namespace)
 
     fields = []
     if args.regexp:
@@ -124,50 +169,63 @@ def csvCollect(arglist=None):
         if args.verbosity >= 2:
             print("Interval is " + str(interval), file=sys.stderr)
 
-    if args.infile:
-        infile = open(args.infile, 'r')
-    elif args.pipe:
-        infile = peekable(subprocess.Popen(args.pipe, stdout=subprocess.PIPE, shell=True, text=True).stdout)
-    else:
-        infile = peekable(sys.stdin)
+    inreader = CSVReader(args.infile, args.pipe, source, args.column_cache, args.verbosity)
+    if args.sample is not None:
+        inreader.sample(args.sample, args.sample_block, args.sample_seed)
+    incomments = inreader.comments or ArgumentHelper.separator()
+    infieldnames = inreader.fieldnames
 
-    # Read comments at start of infile.
-    incomments = ArgumentHelper.read_comments(infile) or ArgumentHelper.separator()
-    infieldnames = next(csv.reader([next(infile)]))
-    inreader=csv.DictReader(infile, fieldnames=infieldnames)
+    if (since or until or args.interval) and args.datecol not in infieldnames:
+        raise RuntimeError("Column '" + args.datecol + "' not present in input data.")
+    if args.regexp and args.column not in infieldnames:
+        raise RuntimeError("Column '" + args.column + "' not present in input data.")
 
-    if args.outfile is None:
+    if pipeout:
+        outfile = None
+    elif args.outfile is None:
         outfile = sys.stdout
     else:
-        if os.path.exists(args.outfile):
+        if os.path.isfile(args.outfile):
             shutil.move(args.outfile, args.outfile + '.bak')
 
-        outfile = open(args.outfile, 'w')
+        outfile = open_text(args.outfile, 'w', args.jobs)
 
-    if not args.no_comments:
+    if outfile and not args.no_comments:
         outfile.write(parser.build_comments(args, args.outfile) + incomments)
 
     # Dynamic code for filter, data and score
     def clean(v):
         return re.sub(r"\W|^(?=\d)",'_', str(v))
 
+    # Only parse the columns used by expressions, the regexp and dates.
+    exprcolumns = expression_columns(([args.filter] if args.filter else []) + (args.indexes or []) + args.score, infieldnames, clean)
+    if exprcolumns is not None:
+        inreader.project(set(exprcolumns + ([args.column] if args.regexp else []) + ([args.datecol] if since or until or args.interval else [])))
+
+    fieldnames = inreader.fieldnames
+    cleanfieldnames = [clean(fieldname) for fieldname in fieldnames]
+    columnindex = inreader.fieldindex.get(args.column)
+    dateindex = inreader.fieldindex.get(args.datecol)
+
     if args.filter:
         if args.verbosity >= 2:
             print("\
-def evalfilter(" + ','.join([clean(fieldname) for fieldname in infieldnames]) + ",**kwargs):\n\
+def evalfilter(" + ','.join(cleanfieldnames + ['**kwargs']) + "):\n\
     return " + args.filter, file=sys.stderr)
         exec("\
-def evalfilter(" + ','.join([clean(fieldname) for fieldname in infieldnames]) + ",**kwargs):\n\
-    return " + args.filter, globals())
+def evalfilter(" + ','.join(cleanfieldnames + ['**kwargs']) + "):\n\
+    return " + args.filter, namespace)
+        evalfilter = namespace['evalfilter']
 
     if args.indexes:
         if args.verbosity >= 2:
             print("\
-def evalindexes(" + ','.join([clean(fieldname) for fieldname in infieldnames]) + ",**kwargs):\n\
+def evalindexes(" + ','.join(cleanfieldnames + ['**kwargs']) + "):\n\
     return (list(itertools.zip_longest(*[" + ','.join(args.indexes) + "])))", file=sys.stderr)
         exec("\
-def evalindexes(" + ','.join([clean(fieldname) for fieldname in infieldnames]) + ",**kwargs):\n\
-    return (list(itertools.zip_longest(*[" + ','.join(args.indexes) + "])))", globals())
+def evalindexes(" + ','.join(cleanfieldnames + ['**kwargs']) + "):\n\
+    return (list(itertools.zip_longest(*[" + ','.join(args.indexes) + "])))", namespace)
+        evalindexes = namespace['evalindexes']
 
     if args.score_header is None:
         if args.score == ['1']:
@@ -186,7 +244,8 @@ def evalsort(" + ','.join([clean(fieldname) for fieldname in fields+args.score_h
     return (" + args.sort + ")", file=sys.stderr)
         exec("\
 def evalsort(" + ','.join([clean(fieldname) for fieldname in fields+args.score_header]) + ",**kwargs):\n\
-    return (" + args.sort + ")", globals())
+    return (" + args.sort + ")", namespace)
+        evalsort = namespace['evalsort']
 
         def sortkey(row):
             rowargs = {clean(key): value for key, value in row.items()}
@@ -194,72 +253,55 @@ def evalsort(" + ','.join([clean(fieldname) for fieldname in fields+args.score_h
 
     if args.verbosity >= 2:
         print("\
-def evalscore(" + ','.join([clean(fieldname) for fieldname in infieldnames]) + ",**kwargs):\n\
+def evalscore(" + ','.join(cleanfieldnames + ['**kwargs']) + "):\n\
     return [" + ','.join(args.score) + "]", file=sys.stderr)
     exec("\
-def evalscore(" + ','.join([clean(fieldname) for fieldname in infieldnames]) + ",**kwargs):\n\
-    return [" + ','.join(args.score) + "]", globals())
+def evalscore(" + ','.join(cleanfieldnames + ['**kwargs']) + "):\n\
+    return [" + ','.join(args.score) + "]", namespace)
+    evalscore = namespace['evalscore']
 
     if args.verbosity >= 1:
         print("Loading CSV data.", file=sys.stderr)
 
-    inrowcount = 0
-    # NB Code for single- and multi-threaded processing is separate
-    mergedresult = {}
-    if args.jobs == 1:
-        rows=[]
-        if args.interval:
-            runningresult = {}
-        while True:
-            if args.limit and inrowcount == args.limit:
-                break
-
-            try:
-                while True:
-                    row = next(inreader)
-                    inrowcount += 1
-                    rowargs = {clean(key): value for key, value in row.items()}
-                    keep = True
-                    if args.filter:
-                        if args.verbosity >= 2:
-                            print("evalfilter(" + repr(rowargs) + ")", file=sys.stderr)
-                        keep = evalfilter(**rowargs) or False
-                        if args.verbosity >= 2:
-                            print("    --> " + repr(keep), file=sys.stderr)
-                    if keep and (since or until):
-                        date = row.get(args.datecol)
-                        if date:
-                            date = dateparser.parse(date)
-                            if until and date >= until:
-                                keep = False
-                            elif since and date < since:
-                                keep = False
-
-                    if keep:
-                        break
-
-            except StopIteration:
-                break
-
-            # Deal with frequency calculation using column args.datecol
-            if args.interval:
-                row['datesecs'] = calendar.timegm(dateparser.parse(row[args.datecol]).timetuple())
-                firstrow = rows[0] if len(rows) else None
-                while firstrow and firstrow['datesecs'] - row['datesecs'] > interval:
-                    indexes  = firstrow['indexes']
-                    rowscore = firstrow['score']
-                    for index in indexes:
-                        runningresult[index] = list(map(sub, runningresult[index], rowscore))
-
-                    del rows[0]
-                    firstrow = rows[0] if len(rows) else None
+    # Scores summed by index, followed for a sample by their sums in each group.
+    scorewidth = len(args.score) * (1 + SAMPLE_GROUPS if args.sample is not None else 1)
+
+    def samplescore(rowscore, unit):
+        group = unit % SAMPLE_GROUPS
+        return rowscore + [0] * (len(rowscore) * group) + rowscore + [0] * (len(rowscore) * (SAMPLE_GROUPS - group - 1))
+
+    # Score rows[start:stop]. With an interval, returns (datesecs, indexes, rowscore)
+    # for each row that passes the filter, in order, for the parent to accumulate
+    # over a moving window; otherwise returns the row scores summed by index.
+    def collectkernel(rows, start, stop):
+        getrow = profiler.timed('parse', rows.__getitem__)
+        result = [] if args.interval else {}
+        for rowindex in range(start, stop):
+            row = getrow(rowindex)
+            rowargs = buildargs(zip(cleanfieldnames, row))
+            keep = True
+            if args.filter:
+                if args.verbosity >= 2:
+                    print("evalfilter(" + repr(rowargs) + ")", file=sys.stderr)
+                keep = evalfilter(**rowargs) or False
+                if args.verbosity >= 2:
+                    print("    --> " + repr(keep), file=sys.stderr)
+            if keep and (since or until):
+                date = row[dateindex]
+                if date:
+                    date = parsedate(date)
+                    if until and date >= until:
+                        keep = False
+                    elif since and date < since:
+                        keep = False
+
+            if not keep:
+                continue
 
             rowscore = None
             indexes = []
             if args.regexp:
-                matches = regexp.finditer(row[args.column])
-
-                for match in matches:
+                for match in finditer(row[columnindex]):
                     if not rowscore:
                         if args.verbosity >= 2:
                             print("evalscore(" + repr(rowargs) + ")", file=sys.stderr)
@@ -268,19 +310,9 @@ def evalscore(" + ','.join([clean(fieldname) for fieldname in infieldnames]) + "
                             print("    --> " + repr(rowscore), file=sys.stderr)
 
                     if args.ignorecase:
-                        index = tuple(value.lower() for value in match.groupdict().values())
+                        indexes.append(tuple(value.lower() for value in match.groupdict().values()))
                     else:
-                        index = tuple(match.groupdict().values())
-
-                    if args.interval:
-                        if args.verbosity >= 2:
-                            print("index = " + repr(index), file=sys.stderr)
-                        indexes.append(index)
-                        runningresult[index] = list(map(add, runningresult.get(index, [0] * len(args.score)), rowscore))
-                        curmergedresult = mergedresult.get(index, [0] * len(args.score))
-                        mergedresult[index] = [max(curmergedresult[idx], runningresult[index][idx]) for idx in range(len(args.score))]
-                    else:
-                        mergedresult[index] = list(map(add, mergedresult.get(index, [0] * len(args.score)), rowscore))
+                        indexes.append(tuple(match.groupdict().values()))
 
             if args.indexes:
                 if args.verbosity >= 2:
@@ -301,170 +333,174 @@ def evalscore(" + ','.join([clean(fieldname) for fieldname in infieldnames]) + "
                             print("    --> " + repr(rowscore), file=sys.stderr)
 
                     if args.ignorecase:
-                        index = match.lower()
+                        indexes.append(match.lower())
                     else:
-                        index = match
+                        indexes.append(match)
 
-                    if args.interval:
-                        if args.verbosity >= 2:
-                            print("index = " + repr(index), file=sys.stderr)
-                        indexes.append(index)
-                        runningresult[index] = list(map(add, runningresult.get(index, [0] * len(args.score)), rowscore))
-                        curmergedresult = mergedresult.get(index, [0] * len(args.score))
-                        mergedresult[index] = [max(curmergedresult[idx], runningresult[index][idx]) for idx in range(len(args.score))]
+            if args.interval:
+                datesecs = calendar.timegm(parsedate(row[dateindex]).timetuple())
+                result.append((datesecs, indexes, rowscore))
+            else:
+                if indexes and args.sample is not None:
+                    rowscore = samplescore(rowscore, rows.units[rowindex])
+                for index in indexes:
+                    if aggregates:
+                        aggregates.add(result[index] if index in result else result.setdefault(index, aggregates.new()), rowscore)
                     else:
-                        mergedresult[index] = list(map(add, mergedresult.get(index, [0] * len(args.score)), rowscore))
+                        result[index] = list(map(add, result.get(index, [0] * scorewidth), rowscore))
 
-            if args.interval and rowscore:
-                row['score']   = rowscore
-                row['indexes'] = indexes
-                rows.append(row)
+        return result
 
-    else:
-        while True:
-            if args.verbosity >= 2:
-                print("Loading CSV batch.", file=sys.stderr)
-
-            rows = []
-            batchcount = 0
-            while batchcount < args.batch:
-                if args.limit and inrowcount == args.limit:
-                    break
-                try:
-                    rows.append(next(inreader))
-                    inrowcount += 1
-                    batchcount += 1
-                except StopIteration:
-                    break
-
-            if batchcount == 0:
-                break
-
-            if args.verbosity >= 2:
-                print("Processing CSV batch.", file=sys.stderr)
-
-            rowcount = len(rows)
-            results = pymp.shared.list()
-            with pymp.Parallel(args.jobs) as p:
-                result = {}
-                for rowindex in p.range(0, rowcount):
-                    row = rows[rowindex]
-                    rowargs = {clean(key): value for key, value in row.items()}
-                    keep = True
-                    if args.filter:
-                        if args.verbosity >= 2:
-                            print("evalfilter(" + repr(rowargs) + ")", file=sys.stderr)
-                        keep = evalfilter(**rowargs) or False
-                        if args.verbosity >= 2:
-                            print("    --> " + repr(keep), file=sys.stderr)
-                    if keep and (since or until):
-                        date = row.get(args.datecol)
-                        if date:
-                            date = dateparser.parse(date)
-                            if until and date >= until:
-                                keep = False
-                            elif since and date < since:
-                                keep = False
-
-                    if not keep:
-                        continue
-
-                    rowscore = None
-                    if args.regexp:
-                        matches = regexp.finditer(row[args.column])
-                        rowscore = None
-                        for match in matches:
-                            if not rowscore:
-                                if args.verbosity >= 2:
-                                    print("evalscore(" + repr(rowargs) + ")", file=sys.stderr)
-                                rowscore = evalscore(**rowargs)
-                                if args.verbosity >= 2:
-                                    print("    --> " + repr(rowscore), file=sys.stderr)
-
-                            if args.ignorecase:
-                                index = tuple(value.lower() for value in match.groupdict().values())
-                            else:
-                                index = tuple(match.groupdict().values())
-
-                            result[index] = list(map(add, result.get(index, [0] * len(args.score)), rowscore))
-
-                    if args.indexes:
-                        if args.verbosity >= 2:
-                            print("evalindexes(" + repr(rowargs) + ")", file=sys.stderr)
-                        matches = evalindexes(**rowargs)
-                        if args.verbosity >= 2:
-                            print("    --> " + repr(matches), file=sys.stderr)
-                        if args.verbosity >= 1:
-                            if type(matches) != list:
-                                print("WARNING: evalindexes should return a list, your 'indexes' argument is probably incorrect!", file=sys.stderr)
-
-                        for match in matches:
-                            if not rowscore:
-                                if args.verbosity >= 2:
-                                    print("evalscore(" + repr(rowargs) + ")", file=sys.stderr)
-                                rowscore = evalscore(**rowargs)
-                                if args.verbosity >= 2:
-                                    print("    --> " + repr(rowscore), file=sys.stderr)
-
-                            if args.ignorecase:
-                                index = match.lower()
-                            else:
-                                index = match
-
-                            result[index] = list(map(add, result.get(index, [0] * len(args.score)), rowscore))
+    # Stages of processing, timed when profiling. Matches are listed so that the
+    # regexp time is not counted in whatever consumes them.
+    buildargs = profiler.timed('args', dict)
+    parsedate = profiler.timed('date', dateparser.parse)
+    if args.regexp:
+        finditer = profiler.timed('regexp', (lambda text: list(regexp.finditer(text))) if profiler.enabled else regexp.finditer)
+    if args.filter:
+        evalfilter = profiler.timed('evalfilter', evalfilter, user=True)
+    if args.indexes:
+        evalindexes = profiler.timed('evalindexes', evalindexes, user=True)
+    evalscore = profiler.timed('evalscore', evalscore, user=True)
 
-                if args.verbosity >= 2:
-                    print("Thread " + str(p.thread_num) + " found " + str(len(result)) + " results.", file=sys.stderr)
+    backend = Backend(args.backend, args.jobs, collectkernel, args.verbosity, profiler)
+    sizer = BatchSizer(args.batch, args.batch_memory, args.batch_time, args.limit, verbosity=args.verbosity)
+    metrics = Metrics(args.metrics, args.metrics_interval, parser.prog, inreader)
 
-                with p.lock:
-                    results.append(result)
+    inrowcount = 0
+    mergedresult = {}
+    if args.interval:
+        runningresult = {}
+        # Scored rows within the current interval as (datesecs, indexes, rowscore)
+        window = []
+    while True:
+        if args.verbosity >= 2:
+            print("Loading CSV batch.", file=sys.stderr)
+
+        with profiler.stage('read'):
+            rows = backend.batch(inreader, sizer.size(inrowcount))
+        inrowcount += len(rows)
+        if len(rows) == 0:
+            break
+
+        if args.verbosity >= 2:
+            print("Processing CSV batch.", file=sys.stderr)
 
+        results = backend.map(rows)
+        with profiler.stage('merge'):
             for result in results:
-                for index in result:
-                    mergedresult[index] = list(map(add, mergedresult.get(index, [0] * len(args.score)), result[index]))
+                if args.interval:
+                    # Deal with frequency calculation using column args.datecol
+                    for (datesecs, indexes, rowscore) in result:
+                        while window and window[0][0] - datesecs > interval:
+                            (firstsecs, firstindexes, firstscore) = window.pop(0)
+                            for index in firstindexes:
+                                runningresult[index] = list(map(sub, runningresult[index], firstscore))
+
+                        for index in indexes:
+                            if args.verbosity >= 2:
+                                print("index = " + repr(index), file=sys.stderr)
+                            runningresult[index] = list(map(add, runningresult.get(index, [0] * len(args.score)), rowscore))
+                            curmergedresult = mergedresult.get(index, [0] * len(args.score))
+                            mergedresult[index] = [max(curmergedresult[idx], runningresult[index][idx]) for idx in range(len(args.score))]
+
+                        if rowscore:
+                            window.append((datesecs, indexes, rowscore))
+                else:
+                    for index in result:
+                        if not aggregates:
+                            mergedresult[index] = list(map(add, mergedresult.get(index, [0] * scorewidth), result[index]))
+                        elif index in mergedresult:
+                            aggregates.merge(mergedresult[index], result[index])
+                        else:
+                            mergedresult[index] = result[index]
+
+        sizer.record(rows)
+        metrics.batch(rows, backend, inrowcount)
+        if isinstance(rows, RowBatch):
+            rows.close()
+
+    metrics.close()
+    backend.close()
+    inreader.close()
+
+    if aggregates:
+        for index in mergedresult:
+            mergedresult[index] = aggregates.values(mergedresult[index])
+
+    # Scale a sample's totals to estimates of the full totals, with confidence
+    # intervals from the spread of the group totals, narrowed by the finite
+    # population correction so that a full sample has none.
+    if args.sample is not None:
+        scorecount = len(args.score)
+        for index, scores in mergedresult.items():
+            estimates = []
+            for idx in range(scorecount):
+                total = float(scores[idx]) / args.sample
+                groups = [SAMPLE_GROUPS * float(scores[scorecount * (group + 1) + idx]) / args.sample for group in range(SAMPLE_GROUPS)]
+                halfwidth = SAMPLE_T95 * math.sqrt((1 - args.sample) * sum((groupest - total) ** 2 for groupest in groups) / (SAMPLE_GROUPS * (SAMPLE_GROUPS - 1)))
+                values = [total, total - halfwidth, total + halfwidth]
+                if type(scores[idx]) == int:
+                    values = [round(value) for value in values]
+                estimates += values
+
+            mergedresult[index] = estimates
+
+        scoreheader = [header + suffix for header in args.score_header for suffix in ('', '_low', '_high')]
+    else:
+        scoreheader = args.score_header
 
     if args.verbosity >= 1:
         print("Sorting " + str(len(mergedresult)) + " results.", file=sys.stderr)
     if args.verbosity >= 2:
         print("    --> " +repr(mergedresult), file=sys.stderr)
 
-    if args.sort:
-        results = []
-        for match in mergedresult.keys():
-            if mergedresult[match][0] >= (args.threshold or 0):
-                result = {}
-                for idx in range(len(fields)):
-                    result[fields[idx]] = match[idx]
-                for idx in range(len(args.score)):
-                    result[args.score_header[idx]] = mergedresult[match][idx]
+    with profiler.stage('sort'):
+        if args.sort:
+            results = []
+            for match in mergedresult.keys():
+                if mergedresult[match][0] >= (args.threshold or 0):
+                    result = {}
+                    for idx in range(len(fields)):
+                        result[fields[idx]] = match[idx]
+                    for idx in range(len(scoreheader)):
+                        result[scoreheader[idx]] = mergedresult[match][idx]
 
-            results.append(result)
+                    results.append(result)
 
-        sortedresult = sorted(results, key=sortkey)
-        if args.number:
-            sortedresult = sortedresult[0:args.number]
-    else:
-        # Sort on first score value
-        sortedresult = sorted([{'match': match, 'score':mergedresult[match]}
-                                for match in mergedresult.keys() if mergedresult[match][0] >= (args.threshold or 0)],
-                                key=lambda item: (-item['score'][0], item['match']))
+            sortedresult = sorted(results, key=sortkey)
+            if args.number:
+                sortedresult = sortedresult[0:args.number]
+        else:
+            # Sort on first score value
+            sortedresult = sorted([{'match': match, 'score':mergedresult[match]}
+                                    for match in mergedresult.keys() if mergedresult[match][0] >= (args.threshold or 0)],
+                                    key=lambda item: (-item['score'][0], item['match']))
+
+            if args.number:
+                sortedresult = sortedresult[0:args.number]
 
-        if args.number:
-            sortedresult = sortedresult[0:args.number]
+            for result in sortedresult:
+                for idx in range(len(fields)):
+                    result[fields[idx]] = result['match'][idx]
+                for idx in range(len(scoreheader)):
+                    result[scoreheader[idx]] = result['score'][idx]
 
-        for result in sortedresult:
-            for idx in range(len(fields)):
-                result[fields[idx]] = result['match'][idx]
-            for idx in range(len(args.score)):
-                result[args.score_header[idx]] = result['score'][idx]
+    if pipeout:
+        profiler.write(parser.prog)
+        return RowStream('' if args.no_comments else parser.build_comments(args) + incomments,
+                         fields + scoreheader, sortedresult, len(fields))
 
-    outcsv=csv.DictWriter(outfile, fieldnames=fields + args.score_header,
+    outcsv=csv.DictWriter(outfile, fieldnames=fields + scoreheader,
                           extrasaction='ignore', lineterminator=os.linesep)
     if not args.no_header:
         outcsv.writeheader()
     if len(sortedresult) > 0:
-        outcsv.writerows(sortedresult)
+        with profiler.stage('write'):
+            outcsv.writerows(sortedresult)
     outfile.close()
+    write_stats(args.outfile, parser.prog, starttime, rowsin=inrowcount, rowsout=len(sortedresult))
+    profiler.write(parser.prog)
 
 if __name__ == '__main__':
     csvCollect(None)
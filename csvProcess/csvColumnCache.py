@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os
+import csv
+import json
+import mmap
+import shutil
+from array import array
+from csvProcess.csvIO import open_text, read_header
+
+CACHE_VERSION = 1
+CHUNK_ROWS = 65536
+
+# Open caches by directory, inherited by forked workers so that batches passed to
+# them refer to the cache by name.
+caches = {}
+
+def cache_dirname(infilename):
+    return infilename + '.columns'
+
+class ColumnCache:
+    # Parsed values of a CSV file stored beside it, one pair of files per column:
+    # the UTF-8 values end to end, and an array of their offsets. Files are memory
+    # mapped as their columns are needed, so a run reads only the columns it uses
+    # and does no CSV parsing. Rows shorter than the header are recorded with their
+    # widths, so that their missing values read as None. The cache is rebuilt when
+    # the size, modification time or header of the CSV file changes.
+
+    def __init__(self, dirname, meta):
+        self.dirname = dirname
+        self.comments = meta['comments']
+        self.fieldnames = meta['header']
+        self.rowcount = meta['rows']
+        self.widths = self.maparray('widths', 'i') if meta['short'] else None
+        self.columns = {}
+
+    @staticmethod
+    def open(infilename, verbosity=1):
+        # The cache of a CSV file, built first if missing or out of date.
+        dirname = cache_dirname(infilename)
+        if dirname in caches:
+            return caches[dirname]
+
+        status = os.stat(infilename)
+        with open_text(infilename) as infile:
+            (comments, header) = read_header(infile)
+        if header is None:
+            raise RuntimeError("Input " + infilename + " has no header.")
+
+        meta = None
+        try:
+            with open(os.path.join(dirname, 'meta.json'), 'r') as metafile:
+                meta = json.load(metafile)
+        except (OSError, ValueError):
+            pass
+
+        if not meta or meta.get('version') != CACHE_VERSION or meta['size'] != status.st_size or meta['mtime'] != status.st_mtime_ns or meta['header'] != header:
+            if verbosity >= 1:
+                print("Building column cache for " + infilename + ".", file=sys.stderr)
+            meta = ColumnCache.build(infilename, dirname, status)
+
+        caches[dirname] = ColumnCache(dirname, meta)
+        return caches[dirname]
+
+    @staticmethod
+    def build(infilename, dirname, status):
+        # Parse the CSV file into a new cache directory, then replace any old one.
+        tempdirname = dirname + '.' + str(os.getpid())
+        os.makedirs(tempdirname)
+        try:
+            with open_text(infilename) as infile:
+                (comments, header) = read_header(infile)
+                width = len(header)
+                datafiles = [open(os.path.join(tempdirname, str(column) + '.data'), 'wb') for column in range(width)]
+                offsetfiles = [open(os.path.join(tempdirname, str(column) + '.offsets'), 'wb') for column in range(width)]
+                positions = [0] * width
+                offsets = [array('q', [0]) for column in range(width)]
+                widths = array('i')
+                short = False
+                rowcount = 0
+                # Blank lines are skipped, as CSVReader does.
+                for row in csv.reader(infile):
+                    if row == []:
+                        continue
+
+                    rowcount += 1
+                    widths.append(min(len(row), width))
+                    if len(row) < width:
+                        short = True
+                    for column in range(width):
+                        if column < len(row):
+                            value = row[column].encode('utf-8')
+                            datafiles[column].write(value)
+                            positions[column] += len(value)
+                        offsets[column].append(positions[column])
+
+                    if rowcount % CHUNK_ROWS == 0:
+                        for column in range(width):
+                            offsets[column].tofile(offsetfiles[column])
+                            offsets[column] = array('q')
+
+                for column in range(width):
+                    offsets[column].tofile(offsetfiles[column])
+                    datafiles[column].close()
+                    offsetfiles[column].close()
+
+            if short:
+                with open(os.path.join(tempdirname, 'widths'), 'wb') as widthsfile:
+                    widths.tofile(widthsfile)
+
+            meta = {'version':  CACHE_VERSION,
+                    'size':     status.st_size,
+                    'mtime':    status.st_mtime_ns,
+                    'header':   header,
+                    'comments': comments,
+                    'rows':     rowcount,
+                    'short':    short}
+            with open(os.path.join(tempdirname, 'meta.json'), 'w') as metafile:
+                json.dump(meta, metafile)
+
+            if os.path.isdir(dirname):
+                shutil.rmtree(dirname)
+            os.rename(tempdirname, dirname)
+        except BaseException:
+            shutil.rmtree(tempdirname, ignore_errors=True)
+            raise
+
+        return meta
+
+    def mapfile(self, name):
+        with open(os.path.join(self.dirname, name), 'rb') as mapped:
+            if os.fstat(mapped.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(mapped.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def maparray(self, name, typecode):
+        return memoryview(self.mapfile(name)).cast(typecode)
+
+    def column(self, column):
+        # The (offsets, data) of a column, mapped on first use.
+        if column not in self.columns:
+            self.columns[column] = (self.maparray(str(column) + '.offsets', 'q'), self.mapfile(str(column) + '.data'))
+        return self.columns[column]
+
+    def columnlist(self, indexes):
+        return [self.column(column) for column in (range(len(self.fieldnames)) if indexes is None else indexes)]
+
+    def row(self, rowindex, columns, indexes):
+        # A row as a tuple of the values in the given columns, as from columnlist().
+        row = tuple(str(data[offsets[rowindex]:offsets[rowindex + 1]], 'utf-8') for (offsets, data) in columns)
+        if self.widths and self.widths[rowindex] < len(self.fieldnames):
+            width = self.widths[rowindex]
+            row = tuple(None if column >= width else value
+                        for (column, value) in zip(range(len(self.fieldnames)) if indexes is None else indexes, row))
+        return row
+
+class ColumnBatch:
+    # A batch of rows read from a ColumnCache, passed to workers as the cache name
+    # and row range. Like RowBatch, rows are only decoded by the job that uses them.
+    # A sample's batch is given the indexes of its rows and their sample units in
+    # place of a range.
+
+    def __init__(self, cache, start, stop, indexes, rowindexes=None, units=None):
+        self.cache = cache
+        self.start = start
+        self.stop = stop
+        self.indexes = indexes
+        self.rowindexes = rowindexes
+        self.units = units
+        self.columns = cache.columnlist(indexes)
+
+    def __getstate__(self):
+        return (self.cache.dirname, self.start, self.stop, self.indexes, self.rowindexes, self.units)
+
+    def __setstate__(self, state):
+        (dirname, start, stop, indexes, rowindexes, units) = state
+        self.__init__(caches[dirname], start, stop, indexes, rowindexes, units)
+
+    def __len__(self):
+        return self.stop - self.start if self.rowindexes is None else len(self.rowindexes)
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+
+        rowindex = self.start + index if self.rowindexes is None else self.rowindexes[index]
+        return self.cache.row(rowindex, self.columns, self.indexes)
+
+    def nbytes(self):
+        if self.rowindexes is None:
+            return sum(offsets[self.stop] - offsets[self.start] for (offsets, data) in self.columns)
+        return sum(offsets[rowindex + 1] - offsets[rowindex] for (offsets, data) in self.columns for rowindex in self.rowindexes)
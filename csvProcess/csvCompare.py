@@ -22,14 +22,77 @@ import os
 import shutil
 import csv
 import re
+import time
+import heapq
+import pickle
+import tempfile
+import multiprocessing
+import itertools
+import bisect
+from more_itertools import peekable
+from csvProcess.csvReader import CSVReader, RowBatch, expression_columns
+from csvProcess.csvBackend import Backend, BatchSizer, BACKENDS
+from csvProcess.csvStats import write_stats
+from csvProcess.csvIO import open_text
+from csvProcess.csvLookup import lookup
 
-def csvCompare(arglist):
-    parser = ArgumentRecorder(description='Compare two CSV files.',
+class UnsortedInput(RuntimeError):
+    def __init__(self, message, fileindex):
+        super().__init__(message)
+        self.fileindex = fileindex
+
+def external_sort(items, batch):
+    # Sort items using at most batch items in memory, spilling sorted runs to
+    # temporary files and merging them.
+    runs = []
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == batch:
+            chunk.sort()
+            run = tempfile.TemporaryFile()
+            for runitem in chunk:
+                pickle.dump(runitem, run, pickle.HIGHEST_PROTOCOL)
+            run.seek(0)
+            runs.append(run)
+            chunk = []
+
+    chunk.sort()
+    if not runs:
+        yield from chunk
+        return
+
+    def readrun(run):
+        try:
+            while True:
+                yield pickle.load(run)
+        except EOFError:
+            run.close()
+
+    yield from heapq.merge(*([readrun(run) for run in runs] + [iter(chunk)]))
+
+def scoredelta(score1, score2):
+    # Same arithmetic as the in-memory comparison, where a missing score is None.
+    if score2 is None:
+        return - score1 if score1 is not None else None
+    elif not score1:
+        return score2
+    elif score2:
+        return score2 - score1
+    else:
+        return - score1
+
+def csvCompare(arglist=None):
+    starttime = time.time()
+    parser = ArgumentRecorder(description='Compare CSV files.',
                               fromfile_prefix_chars='@')
 
     parser.add_argument('-v', '--verbosity', type=int, default=1, private=True)
     parser.add_argument('-j', '--jobs',      type=int, help='Number of parallel tasks, default is number of CPUs')
-    parser.add_argument('-b', '--batch',     type=int, default=100000, help='Number of rows to process per batch. Use to limit memory usage with very large files. May affect performance but not results.')
+    parser.add_argument('-b', '--batch',     type=int, default=100000, help='Number of rows to process per batch, 0 for no limit. Use to limit memory usage with very large files. May affect performance but not results.')
+    parser.add_argument(      '--batch-memory', type=float, help='Adapt batch sizes to use about this many megabytes of input per batch. May affect performance but not results.', private=True)
+    parser.add_argument(      '--batch-time', type=float, help='Adapt batch sizes to take about this many seconds per batch. May affect performance but not results.', private=True)
+    parser.add_argument(      '--backend',   type=str, choices=BACKENDS, help='How to run parallel tasks, default is pymp, or serial for a single job. May affect performance but not results.', private=True)
 
     parser.add_argument('-p', '--prelude',   type=str, nargs="*", help='Python code to execute before processing')
     parser.add_argument('-l', '--limit',     type=int, help='Limit number of rows to process')
@@ -37,10 +100,14 @@ def csvCompare(arglist):
     parser.add_argument('-c', '--column',    type=str, default='word', help='Text column')
     parser.add_argument('-s', '--score',     type=str, help='Python expression for score')
 
+    parser.add_argument('-m', '--merge',     action='store_true', help='Stream files in key order rather than loading them into memory. Files that are not already sorted by key are sorted externally, in runs of batch rows.')
+    parser.add_argument('-M', '--matrix',    action='store_true', help='Output the score from each file and the deltas for every key, in key order. Implied by more than two input files.')
+    parser.add_argument('-B', '--baseline',  type=int, help='Number of the input file to compute deltas against, otherwise deltas are between consecutive files.')
+    parser.add_argument('-n', '--number',    type=int, help='Maximum number of results to output')
+
     parser.add_argument('-o', '--outfile',    type=str, help='Output CSV file, otherwise use stdout.')
 
-    parser.add_argument('infile1', type=str, help='Input CSV files to compare.', input=True)
-    parser.add_argument('infile2', type=str, help='Input CSV files to compare.', input=True)
+    parser.add_argument('infile', type=str, nargs='+', help='Input CSV files to compare.', input=True)
 
     parser.add_argument('--no-comments',     action='store_true',
                                               help='Do not produce a comments logfile')
@@ -48,83 +115,279 @@ def csvCompare(arglist):
 
     args = parser.parse_args(arglist)
 
+    if len(args.infile) < 2:
+        raise RuntimeError("At least two input files must be specified.")
+    if args.baseline is not None and not 1 <= args.baseline <= len(args.infile):
+        raise RuntimeError("Baseline must be between 1 and the number of input files.")
+
+    matrix = args.matrix or len(args.infile) > 2
+
+    if args.jobs is None:
+        args.jobs = multiprocessing.cpu_count()
+
+    if args.verbosity >= 1:
+        print("Using " + str(args.jobs) + " jobs.", file=sys.stderr)
+
+    if args.batch == 0:
+        args.batch = sys.maxsize
+
+    # Namespace for prelude and generated code, kept per call.
+    namespace = dict(globals())
+    namespace['args'] = args
+
     if args.prelude:
         if args.verbosity >= 1:
             print("Executing prelude code.", file=sys.stderr)
 
-        exec(os.linesep.join(args.prelude), globals())
-
-    infile1 = open(args.infile1, 'r')
-    infile2 = open(args.infile2, 'r')
+        exec(os.linesep.join(args.prelude), namespace)
 
-    # Read comments at start of infiles.
-    incomments1 = ArgumentHelper.read_comments(infile1)
-    infieldnames1 = next(csv.reader([next(infile1)]))
-    inreader1=csv.DictReader(infile1, fieldnames=infieldnames1)
+    # Read comments and header at start of infiles.
+    readers = []
+    incomments = ''
+    for infilename in args.infile:
+        reader = CSVReader(infilename)
+        incomments += reader.comments
+        if args.column not in reader.fieldnames:
+            raise RuntimeError("Column '" + args.column + "' not present in " + infilename + ".")
 
-    incomments2 = ArgumentHelper.read_comments(infile2)
-    infieldnames2 = next(csv.reader([next(infile2)]))
-    inreader2=csv.DictReader(infile2, fieldnames=infieldnames2)
+        readers.append(reader)
 
     if args.outfile is None:
         outfile = sys.stdout
     else:
-        if os.path.exists(args.outfile):
+        if os.path.isfile(args.outfile):
             shutil.move(args.outfile, args.outfile + '.bak')
 
-        outfile = open(args.outfile, 'w')
+        outfile = open_text(args.outfile, 'w', args.jobs)
 
     if not args.no_comments:
-        outfile.write(parser.build_comments(args, args.outfile) + ((incomments1 + incomments2) or ArgumentHelper.separator()))
+        outfile.write(parser.build_comments(args, args.outfile) + (incomments or ArgumentHelper.separator()))
 
     def clean(v):
         return re.sub(r"\W|^(?=\d)",'_', v)
 
-    exec("\
-def evalscore1(" + ','.join([clean(fieldname) for fieldname in infieldnames1]) + ",**kwargs):\n\
-    return " + args.score, globals())
-
-    exec("\
-def evalscore2(" + ','.join([clean(fieldname) for fieldname in infieldnames2]) + ",**kwargs):\n\
-    return " + args.score, globals())
-
-    dict1 = {}
-    index = 0
-    for row in inreader1:
-        rowargs = {clean(key): value for key, value in row.items()}
-        dict1[row[args.column]] = evalscore1(**rowargs)
-        index += 1
-    dict2 = {}
-    index = 0
-    for row in inreader2:
-        rowargs = {clean(key): value for key, value in row.items()}
-        dict2[row[args.column]] = evalscore2(**rowargs)
-        index += 1
-
-    diff = {}
-    for key, score1 in dict1.items():
-        score2 = dict2.get(key, None)
-        if score2:
-            diff[key] = score2 - score1
+    # Only parse the key column and the columns used by the score expression.
+    projections = []
+    for reader in readers:
+        exprcolumns = expression_columns([args.score], reader.infieldnames, clean)
+        projections.append(None if exprcolumns is None else set(exprcolumns + [args.column]))
+        reader.project(projections[-1])
+
+    evalscores = []
+    for reader in readers:
+        exec("\
+def evalscore(" + ','.join([clean(fieldname) for fieldname in reader.fieldnames]) + ",**kwargs):\n\
+    return " + args.score, namespace)
+        evalscores.append(namespace['evalscore'])
+
+    filecount = len(args.infile)
+    counts = {'rowsin': 0}
+
+    cleanfieldnames = [[clean(fieldname) for fieldname in reader.fieldnames] for reader in readers]
+    keycolumns = [reader.fieldindex[args.column] for reader in readers]
+
+    # A row too short to have the key column has an empty key, as it would be
+    # written, so that keys can always be ordered.
+    def scorerow(fileindex, row):
+        rowargs = dict(zip(cleanfieldnames[fileindex], row))
+        key = row[keycolumns[fileindex]]
+        return '' if key is None else key, evalscores[fileindex](**rowargs)
+
+    # Score rows start to stop of the batches from all files taken together, so that
+    # the files are scored concurrently. Returns (key, score) for each row in order.
+    def scorekernel(batches, start, stop):
+        offsets = list(itertools.accumulate([0] + [len(rows) for rows in batches]))
+        result = []
+        for index in range(start, stop):
+            fileindex = bisect.bisect_right(offsets, index) - 1
+            result.append(scorerow(fileindex, batches[fileindex][index - offsets[fileindex]]))
+
+        return result
+
+    backend = Backend(args.backend, args.jobs, scorekernel, args.verbosity)
+
+    # Score a batch of rows from each file. Returns lists of (key, score) in input order.
+    def scorebatch(batches):
+        offsets = list(itertools.accumulate([0] + [len(rows) for rows in batches]))
+        scored = list(itertools.chain(*backend.map(batches, offsets[-1])))
+        return [scored[offsets[fileindex]:offsets[fileindex+1]] for fileindex in range(len(batches))]
+
+    def closebatches(batches):
+        for rows in batches:
+            if isinstance(rows, RowBatch):
+                rows.close()
+
+    # Each file is read in batches sized for its share of the memory budget.
+    def batchsizer():
+        return BatchSizer(args.batch, args.batch_memory, args.batch_time, args.limit, filecount, args.verbosity)
+
+    def keyedscores(fileindex, presorted):
+        reader = CSVReader(args.infile[fileindex])
+        reader.project(projections[fileindex])
+        sizer = batchsizer()
+        seq = 0
+        lastkey = None
+        while True:
+            rows = backend.batch(reader, sizer.size(seq))
+            if not rows:
+                break
+
+            counts['rowsin'] += len(rows)
+            batches = [[]] * filecount
+            batches[fileindex] = rows
+            for key, score in scorebatch(batches)[fileindex]:
+                if presorted:
+                    if lastkey is not None and key < lastkey:
+                        closebatches([rows])
+                        reader.close()
+                        raise UnsortedInput(args.infile[fileindex] + " is not sorted on column " + args.column, fileindex)
+                    lastkey = key
+                yield (key, seq, score)
+                seq += 1
+
+            sizer.record(rows)
+            closebatches([rows])
+
+        reader.close()
+
+    def keyorder(scores):
+        # Collapse duplicate keys, keeping the last score as the in-memory comparison
+        # does, and the position of the first as (key, seq, score).
+        firstitem = lastitem = next(scores, None)
+        for item in scores:
+            if item[0] != lastitem[0]:
+                yield lastitem[0], firstitem[1], lastitem[2]
+                firstitem = item
+            lastitem = item
+        if lastitem is not None:
+            yield lastitem[0], firstitem[1], lastitem[2]
+
+    def mergescores(iters):
+        # Join streams of (key, seq, score) in key order, yielding (key, [score per
+        # file], position), the position being (file, seq) of the key's first row
+        # in the first file that has it. The in-memory comparison orders keys so.
+        def tagged(fileindex, scores):
+            for key, seq, score in scores:
+                yield key, fileindex, seq, score
+
+        merged = heapq.merge(*[tagged(fileindex, scores) for fileindex, scores in enumerate(iters)],
+                             key=lambda item: (item[0], item[1]))
+        for key, items in itertools.groupby(merged, key=lambda item: item[0]):
+            scores = [None] * filecount
+            position = None
+            for item in items:
+                scores[item[1]] = item[3]
+                position = position or (item[1], item[2])
+            yield key, scores, position
+
+    if args.baseline:
+        deltapairs = [(args.baseline - 1, fileindex) for fileindex in range(filecount) if fileindex != args.baseline - 1]
+    else:
+        deltapairs = [(fileindex - 1, fileindex) for fileindex in range(1, filecount)]
+
+    def deltas(scores):
+        return [scoredelta(scores[first], scores[second]) for (first, second) in deltapairs]
+
+    if matrix:
+        fieldnames = [args.column] + args.infile + [args.infile[second] + ' - ' + args.infile[first] for (first, second) in deltapairs]
+    else:
+        fieldnames = [args.column, args.score]
+
+    def outputrows(keyscores):
+        if matrix:
+            # Every key is taken, so that merging checks that the whole of each input
+            # is sorted, but only the first number are output.
+            return ([key] + scores + deltas(scores) for rank, (key, scores, position) in enumerate(keyscores)
+                    if args.number is None or rank < args.number)
         else:
-            diff[key] = - score1
+            # Equal deltas keep the order of the in-memory comparison's stable sort.
+            keydeltas = ((deltas(scores)[0], position, key) for key, scores, position in keyscores)
+            if args.number:
+                return ([key, delta] for delta, position, key in heapq.nsmallest(args.number, keydeltas))
+            else:
+                return ([key, delta] for delta, position, key in external_sort(keydeltas, args.batch))
 
-    for key, score2 in dict2.items():
-        score1 = dict1.get(key, None)
-        if not score1:
-            diff[key] = score2
+    if args.merge:
+        presorted = [True] * filecount
+        while True:
+            counts['rowsin'] = 0
+            keyscores = mergescores([keyorder(keyedscores(fileindex, presorted[fileindex]) if presorted[fileindex]
+                                              else external_sort(keyedscores(fileindex, False), args.batch))
+                                     for fileindex in range(filecount)])
+            # Spool the output so that an unsorted input is detected before anything
+            # is written.
+            spoolfile = tempfile.TemporaryFile('w+', newline='')
+            try:
+                csv.writer(spoolfile, lineterminator=os.linesep).writerows(outputrows(keyscores))
+                break
+            except UnsortedInput as error:
+                spoolfile.close()
+                if args.verbosity >= 1:
+                    print("WARNING: " + str(error) + ", sorting externally.", file=sys.stderr)
+                presorted[error.fileindex] = False
+
+        spoolfile.seek(0)
+        outrows = csv.reader(spoolfile)
+    else:
+        if args.verbosity >= 1:
+            print("Loading CSV data.", file=sys.stderr)
+
+        sizers = [batchsizer() for fileindex in range(filecount)]
+        rowcounts = [0] * filecount
+        dicts = [{} for fileindex in range(filecount)]
+        while True:
+            if args.verbosity >= 2:
+                print("Loading batch.", file=sys.stderr)
+
+            batches = [backend.batch(reader, sizers[fileindex].size(rowcounts[fileindex])) for fileindex, reader in enumerate(readers)]
+            if not any(batches):
+                break
+
+            if args.verbosity >= 2:
+                print("Processing batch.", file=sys.stderr)
+
+            for fileindex, scored in enumerate(scorebatch(batches)):
+                rowcounts[fileindex] += len(batches[fileindex])
+                for key, score in scored:
+                    dicts[fileindex][key] = score
+
+            for fileindex, rows in enumerate(batches):
+                sizers[fileindex].record(rows)
+            closebatches(batches)
+
+        counts['rowsin'] = sum(rowcounts)
+
+        # Build the shared key index file by file, so that keys are ordered as they
+        # first appear in the first file, then the second and so on.
+        index = {}
+        for fileindex in range(filecount):
+            for key, score in dicts[fileindex].items():
+                index.setdefault(key, [None] * filecount)[fileindex] = score
+            dicts[fileindex] = None
+
+        if matrix:
+            outrows = outputrows((key, scores, None) for key, scores in sorted(index.items()))
+        elif args.number:
+            outrows = ([key, delta] for key, delta in heapq.nsmallest(args.number, ((key, deltas(scores)[0]) for key, scores in index.items()),
+                                                                      key=lambda item: item[1]))
+        else:
+            outrows = ([key, delta] for key, delta in sorted([(key, deltas(scores)[0]) for key, scores in index.items()],
+                                                             key=lambda item: item[1]))
 
-    sorteddiff = sorted([(key, delta) for key, delta in diff.items()],
-                        key=lambda item: item[1])
+    backend.close()
+    for reader in readers:
+        reader.close()
 
-    outcsv=csv.DictWriter(outfile, fieldnames=[args.column, args.score],
-                          extrasaction='ignore', lineterminator=os.linesep)
+    outcsv=csv.writer(outfile, lineterminator=os.linesep)
     if not args.no_header:
-        outcsv.writeheader()
-    for diff in sorteddiff:
-        outcsv.writerow({args.column: diff[0], args.score: diff[1]})
+        outcsv.writerow(fieldnames)
+    outrowcount = 0
+    for outrow in outrows:
+        outcsv.writerow(outrow)
+        outrowcount += 1
 
     outfile.close()
+    write_stats(args.outfile, parser.prog, starttime, rowsin=counts['rowsin'], rowsout=outrowcount)
 
 
 if __name__ == '__main__':
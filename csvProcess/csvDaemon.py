@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import sys
+import os
+import json
+import socket
+import signal
+import atexit
+import traceback
+import multiprocessing
+from dateutil import parser as dateparser
+from csvProcess.csvClient import TOOLS, MESSAGE_SIZE, default_socket, tool_function
+
+def runjob(connection, tools, verbosity):
+    # Run one request in a process forked from the daemon. The request is a JSON
+    # line with the tool, its arguments, and the client's working directory and
+    # environment, sent with the client's stdin, stdout and stderr, so that the
+    # tool reads and writes them directly. The reply is a JSON line with the exit
+    # status.
+    (message, fds, flags, address) = socket.recv_fds(connection, MESSAGE_SIZE, 3)
+    while message and not message.endswith(b'\n'):
+        data = connection.recv(MESSAGE_SIZE)
+        if not data:
+            break
+        message += data
+
+    request = json.loads(message)
+    if verbosity >= 1:
+        print("Running " + request['tool'] + ' ' + ' '.join(request['args']), file=sys.stderr)
+        sys.stderr.flush()
+
+    for (fd, target) in zip(fds, (0, 1, 2)):
+        os.dup2(fd, target)
+        os.close(fd)
+
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+
+    status = 0
+    try:
+        if request['tool'] not in tools:
+            raise RuntimeError("Tool '" + request['tool'] + "' not available.")
+
+        (filename, function) = tools[request['tool']]
+        sys.argv = [filename] + request['args']
+        function(request['args'])
+    except SystemExit as exit:
+        status = exit.code if isinstance(exit.code, int) else 0 if exit.code is None else 1
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    connection.sendall((json.dumps({'status': status}) + '\n').encode('utf-8'))
+
+def csvDaemon(arglist=None):
+    parser = argparse.ArgumentParser(description='Keep the csvProcess tools loaded, and run requests from csvClient in processes forked from this one.',
+                                     fromfile_prefix_chars='@')
+
+    parser.add_argument('-v', '--verbosity', type=int, default=1)
+    parser.add_argument('-s', '--socket',    type=str, help='Unix socket to listen on, default is csvProcess-<uid>.sock in the runtime or temporary directory.')
+
+    args = parser.parse_args(arglist)
+    socketname = args.socket or default_socket()
+
+    # Do the work that every run would otherwise repeat: imports, the CPU count
+    # and the date parser's first use.
+    tools = {}
+    for tool in TOOLS:
+        try:
+            tools[tool] = tool_function(tool)
+        except ImportError as error:
+            if args.verbosity >= 1:
+                print("Tool " + tool + " not available: " + str(error), file=sys.stderr)
+    multiprocessing.cpu_count()
+    dateparser.parse('2019-01-01 00:00:00')
+
+    if os.path.exists(socketname):
+        try:
+            socket.socket(socket.AF_UNIX).connect(socketname)
+            raise RuntimeError("A daemon is already listening on " + socketname + ".")
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(socketname)
+
+    listener = socket.socket(socket.AF_UNIX)
+    oldumask = os.umask(0o177)
+    try:
+        listener.bind(socketname)
+    finally:
+        os.umask(oldumask)
+    listener.listen()
+    listener.settimeout(1)
+
+    if args.verbosity >= 1:
+        print("Listening on " + socketname, file=sys.stderr)
+
+    # Terminating the daemon removes its socket; running jobs are left to finish.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        while True:
+            # Finished jobs are reaped between requests, or each second when idle.
+            try:
+                while os.waitpid(-1, os.WNOHANG)[0]:
+                    pass
+            except ChildProcessError:
+                pass
+
+            try:
+                (connection, address) = listener.accept()
+            except socket.timeout:
+                continue
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if os.fork() == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                listener.close()
+                try:
+                    runjob(connection, tools, args.verbosity)
+                finally:
+                    # The job leaves by os._exit so as not to run the daemon's own
+                    # cleanup, but first runs the exit handlers of what it started,
+                    # such as the manager process behind pymp's shared dict, which
+                    # would otherwise outlive it holding the client's output open.
+                    try:
+                        atexit._run_exitfuncs()
+                    finally:
+                        os._exit(0)
+
+            connection.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.remove(socketname)
+
+if __name__ == '__main__':
+    csvDaemon(None)
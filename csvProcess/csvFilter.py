@@ -23,26 +23,95 @@ import shutil
 import csv
 import string
 import multiprocessing
-import pymp
 import re
 from dateutil import parser as dateparser
 import datetime
 import calendar
 import subprocess
+import time
 from decimal import *
 import itertools
-from more_itertools import peekable
 import builtins
-
-def csvFilter(arglist=None):
+import shlex
+import copy
+import ast
+import inspect
+from collections.abc import Iterator
+from csvProcess.csvPipeline import RowStream
+from csvProcess.csvReader import CSVReader, RowBatch, expression_columns
+from csvProcess.csvBackend import Backend, BatchSizer, BACKENDS
+from csvProcess.csvStats import write_stats
+from csvProcess.csvProfile import Profiler
+from csvProcess.csvMetrics import Metrics
+from csvProcess.csvIO import open_text
+from csvProcess.csvLookup import lookup
+
+def zipdata(*items):
+    # Rows of items from several data expressions. Lists and iterators are zipped
+    # together, and any other value stands for a list of itself. The rows are an
+    # iterator if any item is one.
+    iterables = [item if type(item) == list or isinstance(item, Iterator) else [item] for item in items]
+    rows = itertools.zip_longest(*iterables)
+    return rows if any(isinstance(item, Iterator) for item in items) else list(rows)
+
+def lazyexpression(expression, namespace):
+    # Whether a data expression evidently returns an iterator: a generator
+    # expression, or a call of a generator function such as one defined by the
+    # prelude.
+    try:
+        node = ast.parse(expression.strip(), mode='eval').body
+    except SyntaxError:
+        return False
+    if isinstance(node, ast.GeneratorExp):
+        return True
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and inspect.isgeneratorfunction(namespace.get(node.func.id))
+
+# Options of the command line that a query may not change.
+GLOBAL_OPTIONS = ['verbosity', 'jobs', 'batch', 'batch_memory', 'batch_time', 'profile', 'cprofile', 'metrics', 'metrics_interval',
+                  'backend', 'column_cache', 'prelude', 'limit', 'sample', 'sample_block', 'sample_seed', 'pipe']
+
+class Query:
+    # The options and state of one query. A command line without a query file is
+    # a single query; with one, every query is evaluated for each row read.
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.regexp = None
+        self.regexpfields = None
+        self.evalfilter = None
+        self.evaldata = None
+        self.lazydata = False
+        self.datafieldnames = []
+        self.outfile = None
+        self.rejfile = None
+        self.outrowcount = 0
+        self.rejrowcount = 0
+
+    def done(self):
+        return bool(self.args.number) and self.outrowcount == self.args.number
+
+# If source is given, it is read in place of infile, pipe or stdin; it may be a text
+# stream or the RowStream of an upstream tool. If pipeout is true, output rows are
+# returned as a RowStream rather than written to outfile.
+def csvFilter(arglist=None, source=None, pipeout=False):
+    starttime = time.time()
 
     parser = ArgumentRecorder(description='Multi-functional CSV file filter.',
                               fromfile_prefix_chars='@')
 
     parser.add_argument('-v', '--verbosity',  type=int, default=1, private=True)
     parser.add_argument('-j', '--jobs',       type=int, help='Number of parallel tasks, default is number of CPUs. May affect performance but not results.', private=True)
-    parser.add_argument('-b', '--batch',      type=int, default=100000, help='Number of rows to process per batch. Use to limit memory usage with very large files. May affect performance but not results.', private=True)
-
+    parser.add_argument('-b', '--batch',      type=int, default=100000, help='Number of rows to process per batch, 0 for no limit. Use to limit memory usage with very large files. May affect performance but not results.', private=True)
+    parser.add_argument(      '--batch-memory', type=float, help='Adapt batch sizes to use about this many megabytes of input per batch. May affect performance but not results.', private=True)
+    parser.add_argument(      '--batch-time', type=float, help='Adapt batch sizes to take about this many seconds per batch. May affect performance but not results.', private=True)
+    parser.add_argument(      '--profile',    type=str, help='Write a JSON report of the time spent in each stage of processing to this file.', private=True)
+    parser.add_argument(      '--cprofile',   type=str, help='Write cProfile statistics for the filter and data code to this file.', private=True)
+    parser.add_argument(      '--metrics',    type=str, nargs='?', const='-', help='Report progress metrics to stderr, or append them as JSON lines to this file.', private=True)
+    parser.add_argument(      '--metrics-interval', type=float, default=10, help='Seconds between progress metrics reports.', private=True)
+    parser.add_argument(      '--backend',    type=str, choices=BACKENDS, help='How to run parallel tasks, default is pymp, or serial for a single job. May affect performance but not results.', private=True)
+    parser.add_argument(      '--column-cache', action='store_true', help='Read an input file through a columnar cache beside it, built on first use and whenever the file changes. May affect performance but not results.', private=True)
+
+    parser.add_argument('-q', '--queries',    type=str, help='File of queries to evaluate in one pass over the input, one per line as a name, a colon and filter and output options including --outfile. Other options of the command line apply to every query unless overridden.')
     parser.add_argument('-p', '--prelude',    type=str, nargs="*", help='Python code to execute before processing')
     parser.add_argument('-f', '--filter',     type=str, help='Python expression evaluated to determine whether row is included')
     parser.add_argument('-c', '--column',     type=str, default='text', help='Column to apply regular expression')
@@ -54,11 +123,14 @@ def csvFilter(arglist=None):
     parser.add_argument(      '--until',      type=str, help='Upper bound date/time in any sensible format')
     parser.add_argument(      '--datecol',    type=str, help='Column containing date/time date', default='date')
     parser.add_argument('-l', '--limit',      type=int, help='Limit number of rows to process')
+    parser.add_argument(      '--sample',     type=float, help='Process a random sample of this fraction of rows, or of blocks of rows.')
+    parser.add_argument(      '--sample-block', type=int, help='Sample blocks of this many consecutive rows rather than single rows.')
+    parser.add_argument(      '--sample-seed', type=int, help='Seed for random sampling, default is 0.')
 
     parser.add_argument('-C', '--copy',       type=str, nargs="*", help='Columns to copy from input file; if none specified then copy all columns.')
     parser.add_argument('-x', '--exclude',    type=str, nargs="*", help='Columns to exclude from copy')
     parser.add_argument('-H', '--header',     type=str, nargs="*", help='Column names to create.')
-    parser.add_argument('-d', '--data',       type=str, nargs="*", help='Python code to produce lists of values to output as columns.')
+    parser.add_argument('-d', '--data',       type=str, nargs="*", help='Python code to produce lists of values to output as columns. Values produced by a generator expression are output as they are generated.')
 
     parser.add_argument('-o', '--outfile',    type=str, help='Output CSV file, otherwise use stdout.', output=True)
     parser.add_argument(      '--rejfile',    type=str, help='Output CSV file for rejected rows')
@@ -67,10 +139,15 @@ def csvFilter(arglist=None):
     parser.add_argument('--no-header',        action='store_true', help='Do not output CSV header with column names')
 
     parser.add_argument('-P', '--pipe', type=str,            help='Command to pipe input from')
-    parser.add_argument('infile',       type=str, nargs='?', help='Input CSV file, if neither input nor pipe is specified, stdin is used.', input=True)
+    parser.add_argument('infile',       type=str, nargs='*', help='Input CSV files or glob patterns, read in order as one input. If neither input nor pipe is specified, stdin is used.', input=True)
 
-    global args
     args = parser.parse_args(arglist)
+    profiler = Profiler(args.profile, args.cprofile)
+
+    # Namespace for prelude and generated code, kept per call so that chained
+    # in-process stages do not overwrite each other's functions.
+    namespace = dict(globals())
+    namespace['args'] = args
 
     if args.jobs is None:
         args.jobs = multiprocessing.cpu_count()
@@ -78,8 +155,8 @@ def csvFilter(arglist=None):
     if args.verbosity >= 1:
         print("Using " + str(args.jobs) + " jobs.", file=sys.stderr)
 
-    if args.batch is None:
-        args.batch = sys.maxint
+    if args.batch == 0:
+        args.batch = sys.maxsize
 
     if args.prelude:
         if args.verbosity >= 1:
@@ -87,107 +164,165 @@ def csvFilter(arglist=None):
         if args.verbosity >= 2:
             print(os.linesep.join(args.prelude), file=sys.stderr)
 
-        exec(os.linesep.join(args.prelude), globals())
-
-    if args.regexp:
-        regexp = re.compile(args.regexp, re.IGNORECASE if args.ignorecase else 0)
-        regexpfields = list(regexp.groupindex)
+        exec(os.linesep.join(args.prelude), namespace)
+
+    # Each query is the command line's filter and output options, overridden by the
+    # options of a line of the query file. Its comments record the equivalent single
+    # query command.
+    if args.queries:
+        if pipeout:
+            raise RuntimeError("Queries cannot be piped to another tool.")
+
+        queries = []
+        with open(args.queries, 'r') as queryfile:
+            for (lineno, line) in enumerate(queryfile, 1):
+                if not line.strip() or line.lstrip()[:1] == '#':
+                    continue
+                (name, colon, options) = line.partition(':')
+                if not colon or not name.strip():
+                    raise RuntimeError("Line " + str(lineno) + " of " + args.queries + " has no query name.")
+
+                queryargs = parser.parse_args(shlex.split(options), namespace=copy.copy(args))
+                if queryargs.infile:
+                    raise RuntimeError("Query " + name.strip() + " names input files.")
+                (queryargs.queries, queryargs.infile) = (None, args.infile)
+                for option in GLOBAL_OPTIONS:
+                    if getattr(queryargs, option) != getattr(args, option):
+                        raise RuntimeError("Option " + option + " of query " + name.strip() + " applies to all queries.")
+
+                queries.append(Query(name.strip(), queryargs))
+
+        outfilenames = [outfilename for query in queries for outfilename in (query.args.outfile, query.args.rejfile) if outfilename]
+        if any(query.args.outfile is None for query in queries):
+            raise RuntimeError("Every query needs an outfile.")
+        if len(set(outfilenames)) != len(outfilenames):
+            raise RuntimeError("Queries must have different output files.")
     else:
-        regexpfields = None
+        queries = [Query(None, args)]
+
+    inreader = CSVReader(args.infile, args.pipe, source, args.column_cache, args.verbosity)
+    if args.sample is not None:
+        inreader.sample(args.sample, args.sample_block, args.sample_seed)
+    incomments = inreader.comments or ArgumentHelper.separator()
+    infieldnames = inreader.fieldnames
+
+    for query in queries:
+        queryargs = query.args
+        if queryargs.regexp:
+            query.regexp = re.compile(queryargs.regexp, re.IGNORECASE if queryargs.ignorecase else 0)
+            query.regexpfields = list(query.regexp.groupindex)
+
+        query.until = dateparser.parse(queryargs.until) if queryargs.until else None
+        query.since = dateparser.parse(queryargs.since) if queryargs.since else None
+
+        if (query.since or query.until) and queryargs.datecol not in infieldnames:
+            raise RuntimeError("Column '" + queryargs.datecol + "' not present in input data.")
+        if queryargs.regexp and queryargs.column not in infieldnames:
+            raise RuntimeError("Column '" + queryargs.column + "' not present in input data.")
+
+        if pipeout:
+            query.outfile = None
+        elif queryargs.outfile is None:
+            query.outfile = sys.stdout
+        else:
+            if os.path.isfile(queryargs.outfile):
+                shutil.move(queryargs.outfile, queryargs.outfile + '.bak')
 
-    until = dateparser.parse(args.until) if args.until else None
-    since = dateparser.parse(args.since) if args.since else None
+            query.outfile = open_text(queryargs.outfile, 'w', args.jobs)
 
-    if args.infile:
-        infile = open(args.infile, 'r')
-    elif args.pipe:
-        infile = peekable(subprocess.Popen(args.pipe, stdout=subprocess.PIPE, shell=True, text=True).stdout)
-    else:
-        infile = peekable(sys.stdin)
+        if queryargs.rejfile:
+            if os.path.isfile(queryargs.rejfile):
+                shutil.move(queryargs.rejfile, queryargs.rejfile + '.bak')
 
-    # Read comments at start of infile.
-    incomments = ArgumentHelper.read_comments(infile) or ArgumentHelper.separator()
-    infieldnames = next(csv.reader([next(infile)]))
-    inreader=csv.DictReader(infile, fieldnames=infieldnames)
+            query.rejfile = open_text(queryargs.rejfile, 'w', args.jobs)
 
-    if (since or until) and args.datecol not in infieldnames:
-        raise RuntimeError("Column '" + args.datecol + "' not present in input data.")
+        if not queryargs.no_comments:
+            if query.outfile:
+                query.outfile.write(parser.build_comments(queryargs, queryargs.outfile) + incomments)
+            if queryargs.rejfile:
+                query.rejfile.write(parser.build_comments(queryargs, queryargs.rejfile) + incomments)
 
-    if args.outfile is None:
-        outfile = sys.stdout
-    else:
-        if os.path.exists(args.outfile):
-            shutil.move(args.outfile, args.outfile + '.bak')
-
-        outfile = open(args.outfile, 'w')
+        if queryargs.copy is not None:
+            query.outfieldnames = [fieldname for fieldname in (queryargs.copy if queryargs.copy else infieldnames) if fieldname not in (queryargs.exclude or [])]
+        else:
+            query.outfieldnames = []
 
-    if args.rejfile:
-        if os.path.exists(args.rejfile):
-            shutil.move(args.rejfile, args.rejfile + '.bak')
+        if queryargs.data:
+            if queryargs.header:
+                #if len(queryargs.header) != len(queryargs.data):
+                    #raise RuntimeError("Number of headers must equal number of data items.")
 
-        rejfile = open(args.rejfile, 'w')
+                query.datafieldnames = [fieldname for fieldname in queryargs.header]
+            else:
+                query.datafieldnames = [fieldname for fieldname in queryargs.data]
 
-    if not args.no_comments:
-        outfile.write(parser.build_comments(args, args.outfile) + incomments)
-        if args.rejfile:
-            rejfile.write(parser.build_comments(args, args.rejfile) + incomments)
+            query.outfieldnames += [fieldname for fieldname in query.datafieldnames if fieldname not in query.outfieldnames]
 
-    if args.copy is not None:
-        outfieldnames = [fieldname for fieldname in (args.copy if args.copy else infieldnames) if fieldname not in (args.exclude or [])]
-    else:
-        outfieldnames = []
+        if query.regexpfields:
+            query.outfieldnames += [fieldname for fieldname in query.regexpfields if fieldname not in query.outfieldnames]
 
-    if args.data:
-        if args.header:
-            #if len(args.header) != len(args.data):
-                #raise RuntimeError("Number of headers must equal number of data items.")
+        if query.outfile:
+            query.outcsv=csv.DictWriter(query.outfile, fieldnames=query.outfieldnames, extrasaction='ignore', lineterminator=os.linesep)
 
-            datafieldnames = [fieldname for fieldname in args.header]
-        else:
-            datafieldnames = [fieldname for fieldname in args.data]
+            if not queryargs.no_header:
+                query.outcsv.writeheader()
 
-        outfieldnames += [fieldname for fieldname in datafieldnames if fieldname not in outfieldnames]
+        if queryargs.rejfile:
+            query.rejcsv=csv.DictWriter(query.rejfile, fieldnames=query.outfieldnames, extrasaction='ignore', lineterminator=os.linesep)
+            if not queryargs.no_header:
+                query.rejcsv.writeheader()
 
-    if regexpfields:
-        outfieldnames += [fieldname for fieldname in regexpfields if fieldname not in outfieldnames]
+    def clean(v):
+        return re.sub(r"\W|^(?=\d)",'_', v)
 
-    outcsv=csv.DictWriter(outfile, fieldnames=outfieldnames, extrasaction='ignore', lineterminator=os.linesep)
+    # Only parse the columns that are output or used by expressions of any query.
+    projection = set()
+    for query in queries:
+        queryargs = query.args
+        exprcolumns = expression_columns(([queryargs.filter] if queryargs.filter else []) + (queryargs.data or []), infieldnames, clean)
+        if exprcolumns is None:
+            projection = None
+            break
+        projection.update(exprcolumns + query.outfieldnames + ([queryargs.column] if queryargs.regexp else []) + ([queryargs.datecol] if query.since or query.until else []))
 
-    if not args.no_header:
-        outcsv.writeheader()
+    if projection is not None:
+        inreader.project(projection)
 
-    if args.rejfile:
-        rejcsv=csv.DictWriter(rejfile, fieldnames=outfieldnames, extrasaction='ignore', lineterminator=os.linesep)
-        if not args.no_header:
-            rejcsv.writeheader()
+    fieldnames = inreader.fieldnames
+    cleanfieldnames = [clean(fieldname) for fieldname in fieldnames]
 
-    def clean(v):
-        return re.sub(r"\W|^(?=\d)",'_', v)
+    for query in queries:
+        queryargs = query.args
+        query.columnindex = inreader.fieldindex.get(queryargs.column)
+        query.dateindex = inreader.fieldindex.get(queryargs.datecol)
 
-    if args.filter:
-        if args.verbosity >= 2:
-            print("\
-def evalfilter(" + ','.join([clean(fieldname) for fieldname in infieldnames]) + ",**kwargs):\n\
-    return " + args.filter, file=sys.stderr)
-        exec("\
-def evalfilter(" + ','.join([clean(fieldname) for fieldname in infieldnames]) + ",**kwargs):\n\
-    return " + args.filter, globals())
-
-    if args.data:
-        evaldatacode = "\
-def evaldata(" + ','.join([clean(fieldname) for fieldname in infieldnames]) + ",**kwargs):\n"
-        if len(args.data) > 1:
-            evaldatacode += "\
-    return (list(itertools.zip_longest(*[" + ','.join(["(" + item + " if builtins.type(" + item + ") == list else [" + item + "])" for item in args.data])+"])))"
-        else:
-            evaldatacode += "\
-    return (" + args.data[0] + ")"
+        if queryargs.filter:
+            if args.verbosity >= 2:
+                print("\
+def evalfilter(" + ','.join(cleanfieldnames + ['**kwargs']) + "):\n\
+    return " + queryargs.filter, file=sys.stderr)
+            exec("\
+def evalfilter(" + ','.join(cleanfieldnames + ['**kwargs']) + "):\n\
+    return " + queryargs.filter, namespace)
+            query.evalfilter = namespace['evalfilter']
+
+        if queryargs.data:
+            evaldatacode = "\
+def evaldata(" + ','.join(cleanfieldnames + ['**kwargs']) + "):\n"
+            if len(queryargs.data) > 1:
+                evaldatacode += "\
+    return zipdata(" + ','.join(queryargs.data) + ")"
+            else:
+                evaldatacode += "\
+    return (" + queryargs.data[0] + ")"
 
-        if args.verbosity >= 2:
-            print(evaldatacode, file=sys.stderr)
-        exec(evaldatacode, globals())
+            if args.verbosity >= 2:
+                print(evaldatacode, file=sys.stderr)
+            exec(evaldatacode, namespace)
+            query.evaldata = namespace['evaldata']
+            query.lazydata = any(lazyexpression(data, namespace) for data in queryargs.data)
 
-    def loadrowdata(outrow, rowdata):
+    def loadrowdata(outrow, rowdata, datafieldnames):
         if type(rowdata) == dict:
             for key, value in rowdata.items():
                 outrow[key] = rowdata[key]
@@ -202,208 +337,170 @@ def evaldata(" + ','.join([clean(fieldname) for fieldname in infieldnames]) + ",
     if args.verbosity >= 1:
         print("Loading CSV data.", file=sys.stderr)
 
-    inrowcount = 0
-    outrowcount = 0
-    rejrowcount = 0
-    # NB Code for single- and multi-threaded processing is separate
-    if args.jobs == 1:
-        for row in inreader:
-            if args.limit and inrowcount == args.limit:
-                break
-            inrowcount += 1
-
-            rowargs = {clean(key): value for key, value in row.items()}
-            keep = True
-            if args.filter:
-                if args.verbosity >= 2:
-                    print("evalfilter(" + repr(rowargs) + ")", file=sys.stderr)
-                keep = evalfilter(**rowargs) or False
-                if args.verbosity >= 2:
-                    print("    --> " + repr(keep), file=sys.stderr)
-            if keep and args.regexp:
-                regexpmatch = regexp.match(row[args.column])
-                keep = regexpmatch or False
-            if keep and (since or until):
-                date = row.get(args.datecol)
-                if date:
-                    date = dateparser.parse(date)
-                    if until and date >= until:
-                        keep = False
-                    elif since and date < since:
-                        keep = False
-
-            if keep == args.invert and not args.rejfile:
-                continue
-
-            outrow = row.copy()
-            if args.regexp and regexpmatch:
-                outrow.update({regexpfield: regexpmatch.group(regexpfield) for regexpfield in regexpfields})
-            if args.data:
-                if args.verbosity >= 2:
-                    print("evaldata(**" + repr(rowargs) + ")", file=sys.stderr)
-                rowdata = evaldata(**rowargs)
-                if args.verbosity >= 2:
-                    print("    --> " + repr(rowdata), file=sys.stderr)
-
-                if type(rowdata) != list:
-                    rowdata = [rowdata]
-            else:
-                rowdata = [None]
-
-            if keep != args.invert:
-                for rowdataitem in rowdata:
-                    loadrowdata(outrow, rowdataitem)
-                    outcsv.writerow(outrow)
-                    outrowcount += 1
-                    if args.number and outrowcount == args.number:
-                        break
-            else:
-                for rowdataitem in rowdata:
-                    loadrowdata(outrow, rowdataitem)
-                    rejcsv.writerow(outrow)
-                    rejrowcount += 1
-
-            if args.number and outrowcount == args.number:
-                break
-
-        outfile.close()
-        if args.rejfile:
-            rejfile.close()
-    else:
-        while True:
+    # Filter rows[start:stop] through every query, returning (rowindex, queryindex,
+    # keep, groups, rowdata) for each row to be output or rejected by a query:
+    # whether it passed, its regexp groups and its list of data results. The parent
+    # recreates the copied columns from the batch. Rows are parsed, and their dates
+    # parsed, once for all queries. Data that evidently returns an iterator, such as
+    # a generator expression, is not evaluated here; rowdata is None and the parent
+    # evaluates the data as it writes the row, so that a row exploding into many
+    # items is never held whole or sent between processes. Other data returning an
+    # iterator is expanded here.
+    def filterkernel(rows, start, stop):
+        getrow = profiler.timed('parse', rows.__getitem__)
+        result = []
+        for rowindex in range(start, stop):
+            row = getrow(rowindex)
+
+            rowargs = buildargs(zip(cleanfieldnames, row))
+            dates = {}
+            for (queryindex, query) in enumerate(queries):
+                keep = True
+                regexpmatch = None
+                if query.evalfilter:
+                    if args.verbosity >= 2:
+                        print("evalfilter(" + repr(rowargs) + ")", file=sys.stderr)
+                    keep = bool(query.evalfilter(**rowargs))
+                    if args.verbosity >= 2:
+                        print("    --> " + repr(keep), file=sys.stderr)
+                if keep and query.regexp:
+                    regexpmatch = query.matchregexp(row[query.columnindex])
+                    keep = bool(regexpmatch)
+                if keep and (query.since or query.until):
+                    date = row[query.dateindex]
+                    if date:
+                        if query.dateindex not in dates:
+                            dates[query.dateindex] = parsedate(date)
+                        date = dates[query.dateindex]
+                        if query.until and date >= query.until:
+                            keep = False
+                        elif query.since and date < query.since:
+                            keep = False
+
+                if keep == query.args.invert and not query.args.rejfile:
+                    continue
+
+                if regexpmatch:
+                    groups = {regexpfield: regexpmatch.group(regexpfield) for regexpfield in query.regexpfields}
+                else:
+                    groups = None
+                if query.lazydata:
+                    rowdata = None
+                elif query.evaldata:
+                    if args.verbosity >= 2:
+                        print("evaldata(" + repr(rowargs) + ")", file=sys.stderr)
+                    rowdata = query.evaldata(**rowargs)
+                    if args.verbosity >= 2:
+                        print("    --> " + repr(rowdata), file=sys.stderr)
+                    if isinstance(rowdata, Iterator):
+                        rowdata = list(rowdata)
+                    elif type(rowdata) != list:
+                        rowdata = [rowdata]
+                else:
+                    rowdata = [None]
+
+                result.append((rowindex, queryindex, keep != query.args.invert, groups, rowdata))
+
+        return result
+
+    # Stages of processing, timed when profiling.
+    buildargs = profiler.timed('args', dict)
+    parsedate = profiler.timed('date', dateparser.parse)
+    for query in queries:
+        if query.regexp:
+            query.matchregexp = profiler.timed('regexp', query.regexp.match)
+        if query.evalfilter:
+            query.evalfilter = profiler.timed('evalfilter', query.evalfilter, user=True)
+        if query.evaldata:
+            query.evaldata = profiler.timed('evaldata', query.evaldata, user=True)
+        if query.outfile:
+            query.writerow = profiler.timed('write', query.outcsv.writerow)
+        if query.rejfile:
+            query.writereject = profiler.timed('write', query.rejcsv.writerow)
+    makerow = profiler.timed('merge', dict)
+    loadrowdata = profiler.timed('merge', loadrowdata)
+
+    backend = Backend(args.backend, args.jobs, filterkernel, args.verbosity, profiler)
+    sizer = BatchSizer(args.batch, args.batch_memory, args.batch_time, args.limit, verbosity=args.verbosity)
+    metrics = Metrics(args.metrics, args.metrics_interval, parser.prog, inreader)
+
+    # Yields (query, outrow) for each row output by a query, until every query has
+    # reached its number of results or the input ends.
+    def filterrows():
+        inrowcount = 0
+        while not all(query.done() for query in queries):
             if args.verbosity >= 2:
                 print("Loading batch.", file=sys.stderr)
 
-            rows = []
-            batchcount = 0
-            while batchcount < args.batch:
-                if args.limit and inrowcount == args.limit:
-                    break
-                try:
-                    row = next(inreader)
-                    inrowcount += 1
-                    row['_Id'] = batchcount
-                    rows.append(row)
-                    batchcount += 1
-                except StopIteration:
-                    break
-
-            if batchcount == 0:
+            with profiler.stage('read'):
+                rows = backend.batch(inreader, sizer.size(inrowcount))
+            inrowcount += len(rows)
+            if len(rows) == 0:
                 break
 
             if args.verbosity >= 2:
                 print("Processing batch.", file=sys.stderr)
 
-            rowcount = len(rows)
-            results = pymp.shared.list()
-            if args.rejfile:
-                rejects = pymp.shared.list()
-            with pymp.Parallel(args.jobs) as p:
-                result = {}
-                if args.rejfile:
-                    reject = {}
-                for rowindex in p.range(0, rowcount):
-                    row = rows[rowindex]
-
-                    rowargs = {clean(key): value for key, value in row.items()}
-                    keep = True
-                    if args.filter:
-                        if args.verbosity >= 2:
-                            print("evalfilter(" + repr(rowargs) + ")", file=sys.stderr)
-                        keep = evalfilter(**rowargs) or False
-                        if args.verbosity >= 2:
-                            print("    --> " + repr(keep), file=sys.stderr)
-                    if keep and args.regexp:
-                        regexpmatch = regexp.match(row[args.column])
-                        keep = regexpmatch or False
-                    if keep and (since or until):
-                        date = row.get(args.datecol)
-                        if date:
-                            date = dateparser.parse(date)
-                            if until and date >= until:
-                                keep = False
-                            elif since and date < since:
-                                keep = False
-
-                    if keep == args.invert and not args.rejfile:
+            getrow = profiler.timed('parse', rows.__getitem__)
+            for result in backend.map(rows):
+                for (rowindex, queryindex, keep, groups, rowdata) in result:
+                    query = queries[queryindex]
+                    if query.done():
                         continue
 
-                    outrow = row.copy()
-                    if args.regexp and regexpmatch:
-                        outrow.update({regexpfield: regexpmatch.group(regexpfield) for regexpfield in regexpfields})
-                    if args.data:
-                        if args.verbosity >= 2:
-                            print("evaldata(" + repr(rowargs) + ")", file=sys.stderr)
-                        rowdata = evaldata(**rowargs)
-                        if args.verbosity >= 2:
-                            print("    --> " + repr(rowdata), file=sys.stderr)
-                        if type(rowdata) == list:
-                            outrow['_rowdata'] = list(rowdata)
-                        else:
-                            loadrowdata(outrow, rowdata)
-                            outrow['_rowdata'] = [None]
+                    row = getrow(rowindex)
+                    outrow = makerow(zip(fieldnames, row))
+                    if groups:
+                        outrow.update(groups)
+                    # Lazy data is evaluated once, here, for rows that are written:
+                    # rejected rows only come back when there is a reject file.
+                    if rowdata is None:
+                        rowdata = query.evaldata(**buildargs(zip(cleanfieldnames, row)))
+
+                    if keep:
+                        for rowdataitem in rowdata:
+                            loadrowdata(outrow, rowdataitem, query.datafieldnames)
+                            yield (query, outrow)
+                            query.outrowcount += 1
+                            if query.done():
+                                break
                     else:
-                        outrow['_rowdata'] = [None]
+                        for rowdataitem in rowdata:
+                            loadrowdata(outrow, rowdataitem, query.datafieldnames)
+                            query.writereject(outrow)
+                            query.rejrowcount += 1
 
-                    if keep != args.invert:
-                        result[row['_Id']] = outrow
-                    else:
-                        reject[row['_Id']] = outrow
-
-                if args.verbosity >= 2:
-                    print("Thread " + str(p.thread_num) + " returned " + str(len(result)) + " results.", file=sys.stderr)
-
-                with p.lock:
-                    results.append(result)
-                    if args.rejfile:
-                        rejects.append(reject)
-
-            if args.verbosity >= 2:
-                print("Merging batch.", file=sys.stderr)
-
-            mergedresult = {}
-            for result in results:
-                mergedresult.update(result)
-
-            if args.rejfile:
-                mergedreject = {}
-                for reject in rejects:
-                    mergedreject.update(reject)
-
-            if args.verbosity >= 2:
-                print("Outputting batch.", file=sys.stderr)
-
-            endindex = None
-            for index in sorted(mergedresult.keys()):
-                outrow = mergedresult[index]
-                rowdata = outrow.get('_rowdata')
-                for rowdataitem in rowdata:
-                    loadrowdata(outrow, rowdataitem)
-                    outcsv.writerow(mergedresult[index])
-                    outrowcount += 1
-                    if args.number and outrowcount == args.number:
-                        break
-
-                if args.number and outrowcount == args.number:
-                    endindex = index
+                if all(query.done() for query in queries):
                     break
 
-            if args.rejfile:
-                for index in sorted(mergedreject.keys()):
-                    if index < endindex:
-                        break
-                    outrow = mergedreject[index]
-                    rowdata = outrow.get('_rowdata')
-                    for rowdataitem in rowdata:
-                        loadrowdata(outrow, rowdataitem)
-                        rejcsv.writerow(mergedresult[index])
-
-            if args.number and outrowcount == args.number:
-                break
-
-        outfile.close()
-        if args.rejfile:
-            rejfile.close()
+            sizer.record(rows)
+            metrics.batch(rows, backend, inrowcount, sum(query.outrowcount for query in queries), sum(query.rejrowcount for query in queries))
+            if isinstance(rows, RowBatch):
+                rows.close()
+
+        metrics.close()
+        backend.close()
+        inreader.close()
+        for query in queries:
+            if query.rejfile:
+                query.rejfile.close()
+
+        counts.update(rowsin=inrowcount)
+        profiler.write(parser.prog)
+
+    counts = {}
+    if pipeout:
+        return RowStream('' if args.no_comments else parser.build_comments(args) + incomments,
+                         queries[0].outfieldnames, (outrow for (query, outrow) in filterrows()))
+
+    for (query, outrow) in filterrows():
+        query.writerow(outrow)
+
+    for query in queries:
+        query.outfile.close()
+        if args.verbosity >= 1 and query.name:
+            print("Query " + query.name + ": " + str(query.outrowcount) + " rows output.", file=sys.stderr)
+        write_stats(query.args.outfile, parser.prog, starttime, rowsout=query.outrowcount, rowsrejected=query.rejrowcount, **counts)
 
 if __name__ == '__main__':
     csvFilter(None)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import csv
+import fcntl
+import shutil
+import subprocess
+import threading
+import weakref
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from argrecord import ArgumentHelper
+
+BUFFER_SIZE = 1 << 20
+
+# Size of the chunks read ahead, and the most bytes held waiting to be read.
+CHUNK_SIZE = 1 << 20
+READAHEAD_BYTES = 16 << 20
+
+# Size of the blocks compressed independently when writing.
+BLOCK_SIZE = 1 << 20
+
+COMPRESSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+def compression(filename):
+    return COMPRESSIONS.get(os.path.splitext(filename)[1].lower()) if filename else None
+
+class GzipDecompressor:
+    # Decompresses a gzip stream of one or more members, as written by pigz or by
+    # BlockWriter.
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(31)
+        self.started = False
+
+    def decompress(self, data):
+        output = []
+        while data:
+            self.started = True
+            output.append(self.decompressor.decompress(data))
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data.lstrip(b'\0')
+                self.decompressor = zlib.decompressobj(31)
+                self.started = False
+            else:
+                data = b''
+
+        return b''.join(output)
+
+    def finish(self):
+        if self.started:
+            raise RuntimeError("Compressed input is truncated.")
+        return b''
+
+class Readahead(io.RawIOBase):
+    # Reads a byte source such as a file, pipe or stdin in a background thread
+    # into a queue of chunks, decompressing them if a decompressor is given, so
+    # that the producer of the input, or its decompression, overlaps with
+    # processing it. The thread waits while READAHEAD_BYTES are queued. tell()
+    # gives the number of bytes read so far.
+
+    def __init__(self, source, decompressor=None, process=None):
+        self.source = source
+        self.decompressor = decompressor
+        self.process = process
+        self.condition = threading.Condition()
+        self.chunks = deque()
+        self.queued = 0
+        self.chunk = b''
+        self.offset = 0
+        self.position = 0
+        self.done = False
+        self.error = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def put(self, data):
+        with self.condition:
+            while data is not None and self.queued >= READAHEAD_BYTES and not self.stopping:
+                self.condition.wait()
+            self.chunks.append(data)
+            self.queued += len(data) if data else 0
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while not self.chunks:
+                self.condition.wait()
+            data = self.chunks.popleft()
+            self.queued -= len(data) if data else 0
+            self.condition.notify_all()
+            return data
+
+    def fill(self):
+        # Reads return what is available, so a slow producer's input is passed on
+        # as it arrives.
+        read = getattr(self.source, 'read1', self.source.read)
+        try:
+            while not self.stopping:
+                data = read(CHUNK_SIZE)
+                if not data:
+                    break
+                if self.decompressor:
+                    data = self.decompressor.decompress(data)
+                if data:
+                    self.put(data)
+
+            if self.decompressor and not self.stopping:
+                data = self.decompressor.finish()
+                if data:
+                    self.put(data)
+        except BaseException as error:
+            self.error = error
+        finally:
+            self.put(None)
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        while self.offset == len(self.chunk):
+            if self.done:
+                return 0
+            chunk = self.get()
+            if chunk is None:
+                self.done = True
+                if self.error:
+                    raise self.error
+                return 0
+            (self.chunk, self.offset) = (chunk, 0)
+
+        count = min(len(buffer), len(self.chunk) - self.offset)
+        buffer[:count] = self.chunk[self.offset:self.offset + count]
+        self.offset += count
+        self.position += count
+        return count
+
+    def close(self):
+        if not self.closed:
+            # Wake the thread if it is waiting for room in the queue. One blocked
+            # reading a pipe is left to finish with the process.
+            with self.condition:
+                self.stopping = True
+                self.condition.notify_all()
+            self.source.close()
+            if self.process:
+                self.process.wait()
+        super().close()
+
+def readahead_text(source, process=None):
+    # A text stream of a binary pipe or file read ahead in a thread. A pipe's
+    # buffer is enlarged where possible, so that its producer blocks less often.
+    try:
+        fcntl.fcntl(source.fileno(), fcntl.F_SETPIPE_SZ, CHUNK_SIZE)
+    except (AttributeError, OSError, ValueError):
+        pass
+
+    return io.TextIOWrapper(io.BufferedReader(Readahead(source, process=process), BUFFER_SIZE), newline='')
+
+def gzip_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+class BlockWriter(io.RawIOBase):
+    # Compresses output in independent blocks across a pool of threads, in the
+    # manner of pigz, writing the compressed blocks in order. zlib releases the
+    # interpreter lock while compressing, so the threads run in parallel.
+
+    def __init__(self, outfile, compress, jobs=1):
+        self.outfile = outfile
+        self.compress = compress
+        self.jobs = max(1, jobs)
+        self.pool = ThreadPoolExecutor(self.jobs) if self.jobs > 1 else None
+        self.pending = deque()
+        self.block = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.block += data
+        if len(self.block) >= BLOCK_SIZE:
+            self.submit()
+        return len(data)
+
+    def submit(self):
+        block = bytes(self.block)
+        self.block = bytearray()
+        if self.pool:
+            self.pending.append(self.pool.submit(self.compress, block))
+            while len(self.pending) > 2 * self.jobs:
+                self.outfile.write(self.pending.popleft().result())
+        else:
+            self.outfile.write(self.compress(block))
+
+    def close(self):
+        if not self.closed:
+            if self.block:
+                self.submit()
+            while self.pending:
+                self.outfile.write(self.pending.popleft().result())
+            if self.pool:
+                self.pool.shutdown()
+            self.outfile.close()
+        super().close()
+
+# Open ProcessWriters, whose pipes are released in forked children.
+processwriters = weakref.WeakSet()
+
+def release_pipes():
+    # A forked worker holding a compressing command's input open would stop the
+    # command from seeing the end of its input, so the pipe is replaced with
+    # /dev/null in the child.
+    for writer in list(processwriters):
+        if not writer.closed:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, writer.process.stdin.fileno())
+            os.close(devnull)
+
+os.register_at_fork(after_in_child=release_pipes)
+
+class ProcessWriter(io.RawIOBase):
+    # Writes to the input of a compressing command, waiting for it on close.
+    def __init__(self, process):
+        self.process = process
+        processwriters.add(self)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.process.stdin.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.process.stdin.close()
+            if self.process.wait():
+                raise RuntimeError("Error compressing output.")
+        super().close()
+
+def zstd_command():
+    command = shutil.which('zstd')
+    if command is None:
+        raise RuntimeError("Reading or writing .zst files needs the zstandard module or the zstd command.")
+    return command
+
+def open_text(filename, mode='r', jobs=1):
+    # Open a CSV file for reading or writing text, compressed if its name ends in
+    # .gz or .zst. Reading decompresses in a Readahead thread; writing compresses
+    # blocks in parallel across jobs threads. zstd uses the zstandard module if it
+    # is installed, otherwise the zstd command.
+    kind = compression(filename)
+    if kind is None:
+        if mode == 'r':
+            return open(filename, 'r', newline='', buffering=BUFFER_SIZE)
+        else:
+            return open(filename, 'w')
+
+    if mode == 'r':
+        if kind == 'gzip':
+            raw = Readahead(open(filename, 'rb'), GzipDecompressor())
+        else:
+            try:
+                import zstandard
+                raw = Readahead(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True, closefd=True))
+            except ImportError:
+                process = subprocess.Popen([zstd_command(), '-d', '-c', '-q', filename], stdout=subprocess.PIPE)
+                raw = Readahead(process.stdout, process=process)
+
+        return io.TextIOWrapper(io.BufferedReader(raw, BUFFER_SIZE), newline='')
+    else:
+        if kind == 'gzip':
+            raw = BlockWriter(open(filename, 'wb'), gzip_block, jobs)
+        else:
+            try:
+                import zstandard
+                raw = BlockWriter(open(filename, 'wb'), zstandard.ZstdCompressor().compress, jobs)
+            except ImportError:
+                process = subprocess.Popen([zstd_command(), '-q', '-f', '-T' + str(jobs), '-o', filename], stdin=subprocess.PIPE)
+                raw = ProcessWriter(process)
+
+        return io.TextIOWrapper(io.BufferedWriter(raw, BUFFER_SIZE))
+
+def read_header(infile):
+    # The comment trail and header line at the start of an open CSV file.
+    comments = ''
+    while True:
+        line = infile.readline()
+        if line[:1] == '#':
+            comments += line
+        else:
+            break
+
+    return (comments, next(csv.reader([line])) if line else None)
+
+def read_comments(source):
+    # As ArgumentHelper.read_comments, which opens file names as plain text, but
+    # also reading compressed files.
+    if isinstance(source, str):
+        comments = ''
+        with open_text(source) as infile:
+            for line in infile:
+                if line[:1] != '#':
+                    break
+                comments += line
+        return comments
+
+    return ArgumentHelper.read_comments(source)
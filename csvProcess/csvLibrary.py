@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shlex
+import itertools
+from csvProcess.csvPipeline import RowStream
+from csvProcess.csvFilter import csvFilter
+from csvProcess.csvCollect import csvCollect
+
+# Calling csvFilter and csvCollect from Python without writing and parsing CSV text.
+# Each takes the tool's options as an argument list or string, and as input either
+# a file name or list of file names and glob patterns, or an iterable of rows. The
+# tools run as from the command line, with the same filtering, jobs and batches,
+# and return their output rows as they are produced. For example
+#     for row in filter_rows('tweets.csv', '--filter "lang == \'en\'" --copy id text'):
+#         ...
+#     counts = collect(rows, '--column text --regexp "(?P<hashtag>#\\w+)"', fieldnames=['id', 'text'])
+
+def source_args(source, arglist, fieldnames, verbosity):
+    # The tool's argument list and source. Rows are dicts or sequences in the order
+    # of fieldnames; without fieldnames, those of the first dict, or the first
+    # sequence as a header as from csv.reader. Row values are read as their strings,
+    # as the tool would have parsed them from CSV. File names follow '--' so that
+    # an option taking a list of values does not take them too.
+    arglist = ['--verbosity', str(verbosity)] + (shlex.split(arglist) if isinstance(arglist, str) else list(arglist or []))
+    if isinstance(source, (str, os.PathLike)):
+        return (arglist + ['--', os.fspath(source)], None)
+    elif isinstance(source, (list, tuple)) and source and all(isinstance(item, (str, os.PathLike)) for item in source):
+        return (arglist + ['--'] + [os.fspath(item) for item in source], None)
+
+    rows = iter(source)
+    if fieldnames is None:
+        first = next(rows, None)
+        if first is None:
+            raise RuntimeError("Input rows have no header.")
+        if isinstance(first, dict):
+            fieldnames = list(first)
+            rows = itertools.chain([first], rows)
+        else:
+            fieldnames = [str(fieldname) for fieldname in first]
+
+    return (arglist, RowStream('', fieldnames, rows))
+
+def output_rows(stream, asdict):
+    # The rows of a tool's RowStream with their values as the tool produced them,
+    # as dicts by column name or tuples in column order. Each row is a new object,
+    # as the tool may reuse its own.
+    if asdict:
+        return ({fieldname: row.get(key) for (fieldname, key) in zip(stream.fieldnames, stream.keys)} for row in stream.rows)
+    else:
+        return (tuple(row.get(key) for key in stream.keys) for row in stream.rows)
+
+def filter_rows(source, arglist=None, fieldnames=None, asdict=False, verbosity=0):
+    # Rows output by csvFilter, read lazily, so that rows are filtered one batch at
+    # a time as they are consumed and reading stops when the caller does.
+    (arglist, stream) = source_args(source, arglist, fieldnames, verbosity)
+    return output_rows(csvFilter(arglist, source=stream, pipeout=True), asdict)
+
+def collect_rows(source, arglist=None, fieldnames=None, asdict=False, verbosity=0):
+    # Rows output by csvCollect, the index columns followed by the score columns, in
+    # the tool's order and subject to its threshold and number.
+    (arglist, stream) = source_args(source, arglist, fieldnames, verbosity)
+    return output_rows(csvCollect(arglist, source=stream, pipeout=True), asdict)
+
+def collect(source, arglist=None, fieldnames=None, verbosity=0):
+    # The result of csvCollect as a dict from each index, a tuple of the values of the
+    # index columns, to the list of its scores, in the tool's output order.
+    (arglist, stream) = source_args(source, arglist, fieldnames, verbosity)
+    stream = csvCollect(arglist, source=stream, pipeout=True)
+    (keys, scorekeys) = (stream.keys[:stream.keycount], stream.keys[stream.keycount:])
+    return {tuple(row[key] for key in keys): [row[key] for key in scorekeys] for row in stream.rows}
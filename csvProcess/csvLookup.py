@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os
+import csv
+import json
+import mmap
+import struct
+from array import array
+from collections.abc import Mapping
+from hashlib import blake2b
+from csvProcess.csvIO import open_text, read_header
+
+LOOKUP_VERSION = 1
+
+# Open lookups by CSV file and columns, inherited by forked workers.
+lookups = {}
+
+def lookup_filename(infilename, keyindex, valueindex):
+    return infilename + '.' + str(keyindex) + '-' + str(valueindex) + '.lookup'
+
+def keyhash(key):
+    # A stable hash of a key's UTF-8 bytes, never zero as that marks an empty slot.
+    return int.from_bytes(blake2b(key, digest_size=8).digest(), 'little') | 1
+
+class Lookup(Mapping):
+    # A read-only mapping of the values of one column of a CSV file by another, held
+    # in a binary file beside it and memory mapped. The file is a JSON header, an
+    # open addressing table of (hash, offset) slots, and the key and value of each
+    # entry end to end. Workers forked after a lookup is opened share its pages
+    # rather than each holding a copy of a large dictionary, and later runs map the
+    # file rather than parsing the CSV again. The file is rebuilt when the size,
+    # modification time or header of the CSV file changes. As with a dict built row
+    # by row, a repeated key has its last value and keys iterate in the order they
+    # first appear.
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as mapped:
+            self.map = mmap.mmap(mapped.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (metalength,) = struct.unpack_from('=I', self.map, 0)
+        self.meta = json.loads(self.map[4:4 + metalength])
+        tablestart = (4 + metalength + 7) // 8 * 8
+        self.slots = self.meta['slots']
+        self.table = memoryview(self.map)[tablestart:tablestart + 16 * self.slots].cast('Q')
+        self.datastart = tablestart + 16 * self.slots
+
+    def __reduce__(self):
+        return (Lookup, (self.filename,))
+
+    @staticmethod
+    def open(infilename, key=None, value=None, verbosity=1):
+        # The lookup of column value by column key of a CSV file, by default its
+        # first two columns, built first if missing or out of date.
+        if (infilename, key, value) in lookups:
+            return lookups[(infilename, key, value)]
+
+        status = os.stat(infilename)
+        with open_text(infilename) as infile:
+            (comments, header) = read_header(infile)
+        if header is None:
+            raise RuntimeError("Input " + infilename + " has no header.")
+
+        indexes = []
+        for (column, default) in ((key, 0), (value, 1)):
+            if column is None:
+                if default >= len(header):
+                    raise RuntimeError("Input " + infilename + " needs a key and a value column.")
+                indexes.append(default)
+            elif column in header:
+                indexes.append(header.index(column))
+            else:
+                raise RuntimeError("Column '" + column + "' not present in " + infilename + ".")
+
+        filename = lookup_filename(infilename, *indexes)
+        table = None
+        try:
+            table = Lookup(filename)
+            if table.meta.get('version') != LOOKUP_VERSION or table.meta['size'] != status.st_size or table.meta['mtime'] != status.st_mtime_ns or table.meta['header'] != header:
+                table = None
+        except (OSError, ValueError, KeyError, struct.error):
+            pass
+
+        if table is None:
+            if verbosity >= 1:
+                print("Building lookup for " + infilename + ".", file=sys.stderr)
+            Lookup.build(infilename, filename, indexes, status, header)
+            table = Lookup(filename)
+
+        lookups[(infilename, key, value)] = table
+        return table
+
+    @staticmethod
+    def build(infilename, filename, indexes, status, header):
+        (keyindex, valueindex) = indexes
+        entries = {}
+        with open_text(infilename) as infile:
+            read_header(infile)
+            for row in csv.reader(infile):
+                if len(row) > keyindex:
+                    entries[row[keyindex]] = row[valueindex] if valueindex < len(row) else ''
+
+        slots = 8
+        while slots < 2 * len(entries):
+            slots *= 2
+
+        table = array('Q', [0]) * (2 * slots)
+        data = bytearray()
+        for (key, value) in entries.items():
+            keybytes = key.encode('utf-8')
+            valuebytes = value.encode('utf-8')
+            slot = keyhash(keybytes) & (slots - 1)
+            while table[2 * slot]:
+                slot = (slot + 1) & (slots - 1)
+            table[2 * slot] = keyhash(keybytes)
+            table[2 * slot + 1] = len(data)
+            data += struct.pack('=II', len(keybytes), len(valuebytes)) + keybytes + valuebytes
+
+        meta = json.dumps({'version': LOOKUP_VERSION,
+                           'size':    status.st_size,
+                           'mtime':   status.st_mtime_ns,
+                           'header':  header,
+                           'rows':    len(entries),
+                           'slots':   slots}).encode('utf-8')
+
+        tempfilename = filename + '.' + str(os.getpid())
+        try:
+            with open(tempfilename, 'wb') as outfile:
+                outfile.write(struct.pack('=I', len(meta)) + meta)
+                outfile.write(b'\0' * ((4 + len(meta) + 7) // 8 * 8 - 4 - len(meta)))
+                table.tofile(outfile)
+                outfile.write(data)
+            os.replace(tempfilename, filename)
+        except BaseException:
+            if os.path.exists(tempfilename):
+                os.remove(tempfilename)
+            raise
+
+    def find(self, key):
+        keybytes = str(key).encode('utf-8')
+        valuehash = keyhash(keybytes)
+        slot = valuehash & (self.slots - 1)
+        while self.table[2 * slot]:
+            if self.table[2 * slot] == valuehash:
+                offset = self.datastart + self.table[2 * slot + 1]
+                (keylength, valuelength) = struct.unpack_from('=II', self.map, offset)
+                offset += 8
+                if self.map[offset:offset + keylength] == keybytes:
+                    return str(self.map[offset + keylength:offset + keylength + valuelength], 'utf-8')
+            slot = (slot + 1) & (self.slots - 1)
+
+        return None
+
+    def get(self, key, default=None):
+        value = self.find(key)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.find(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def __iter__(self):
+        # Entries are stored in the order of the dict they were built from.
+        offset = self.datastart
+        while offset < len(self.map):
+            (keylength, valuelength) = struct.unpack_from('=II', self.map, offset)
+            offset += 8
+            yield str(self.map[offset:offset + keylength], 'utf-8')
+            offset += keylength + valuelength
+
+def lookup(infilename, key=None, value=None):
+    # For prelude and expression code: a lookup of one column of a CSV file by
+    # another, opened once per process, for example
+    #     --prelude "bots = lookup('bots.csv', 'user', 'kind')" --filter "user not in bots"
+    return Lookup.open(infilename, key, value)
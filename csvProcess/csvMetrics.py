@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os
+import json
+import time
+from time import perf_counter
+from csvProcess.csvReader import RowBatch
+
+class Metrics:
+    # Live progress of a run, reported after a batch completes at most once per
+    # interval: to stderr as a line of text, or appended to a metrics file as one
+    # JSON object per line. Only a few additions and clock reads are made per
+    # batch, so metrics can be left on in production. Rates and worker utilization
+    # are over the rows since the previous report; the final report covers the
+    # whole run. Progress through the input is in bytes, or in rows for an input
+    # read through its column cache, as rowsread and rowstotal.
+
+    def __init__(self, outfilename, interval, command, reader):
+        self.enabled = outfilename is not None
+        if not self.enabled:
+            return
+
+        self.outfile = None if outfilename == '-' else open(outfilename, 'a')
+        self.interval = interval
+        self.command = os.path.splitext(os.path.basename(command))[0]
+        self.reader = reader
+        self.unit = 'rows' if reader.cache else 'bytes'
+        self.total = reader.size()
+        self.batchbytes = 0
+        self.starttime = self.batchstart = self.reporttime = perf_counter()
+        self.reportrows = 0
+        self.jobseconds = 0
+        self.workerseconds = 0
+        self.totaljobseconds = 0
+        self.totalworkerseconds = 0
+        self.record = {}
+
+    def amountread(self):
+        # Bytes or rows read from the input file if it can tell, otherwise the bytes
+        # of the shared memory batches seen so far.
+        position = self.reader.position()
+        if position is not None:
+            return position
+        return self.batchbytes or None
+
+    def batch(self, rows, backend, rowsin, rowsout=None, rowsrejected=None):
+        if not self.enabled:
+            return
+
+        now = perf_counter()
+        if isinstance(rows, RowBatch):
+            self.batchbytes += rows.offsets[-1]
+        jobseconds = sum(backend.jobseconds)
+        workerseconds = backend.mapseconds * len(backend.jobseconds)
+        self.jobseconds += jobseconds
+        self.workerseconds += workerseconds
+        self.totaljobseconds += jobseconds
+        self.totalworkerseconds += workerseconds
+
+        self.record = {'rowsin':       rowsin,
+                       'rowsout':      rowsout,
+                       'rowsrejected': rowsrejected,
+                       self.unit + 'read': self.amountread(),
+                       'batchrows':    len(rows),
+                       'batchseconds': round(now - self.batchstart, 6)}
+        self.batchstart = now
+
+        if now - self.reporttime >= self.interval:
+            self.report(now, rowsin - self.reportrows, now - self.reporttime, self.jobseconds, self.workerseconds)
+            self.reporttime = now
+            self.reportrows = rowsin
+            self.jobseconds = 0
+            self.workerseconds = 0
+
+    def report(self, now, rows, seconds, jobseconds, workerseconds, final=False):
+        record = dict(command=self.command,
+                      time=round(time.time(), 3),
+                      elapsed=round(now - self.starttime, 3),
+                      **self.record)
+        record[self.unit + 'total'] = self.total
+        record['rowspersec'] = round(rows / seconds, 1) if seconds else None
+        record['utilization'] = round(jobseconds / workerseconds, 3) if workerseconds else None
+        amountread = record.get(self.unit + 'read')
+        if self.total and amountread:
+            record['eta'] = 0 if final else round((now - self.starttime) * max(self.total - amountread, 0) / amountread, 1)
+        else:
+            record['eta'] = None
+        record['final'] = final
+
+        if self.outfile:
+            self.outfile.write(json.dumps(record) + '\n')
+            self.outfile.flush()
+        else:
+            print(self.format(record), file=sys.stderr)
+
+    def format(self, record):
+        line = record['command'] + ': ' + str(record.get('rowsin', 0)) + ' rows in'
+        if record.get('rowsout') is not None:
+            line += ', ' + str(record['rowsout']) + ' out'
+        if record.get('rowsrejected') is not None:
+            line += ', ' + str(record['rowsrejected']) + ' rejected'
+        if record.get('bytesread') is not None:
+            line += ', ' + format(record['bytesread'] / 1e6, '.1f')
+            if record['bytestotal']:
+                line += ' of ' + format(record['bytestotal'] / 1e6, '.1f')
+            line += ' MB read'
+        elif record.get('rowsread') is not None:
+            line += ', ' + str(record['rowsread'])
+            if record['rowstotal']:
+                line += ' of ' + str(record['rowstotal'])
+            line += ' cached rows read'
+        if record['rowspersec'] is not None:
+            line += ', ' + str(int(record['rowspersec'])) + ' rows/s'
+        if record.get('batchseconds') is not None:
+            line += ', batch ' + format(record['batchseconds'], '.2f') + 's'
+        if record['utilization'] is not None:
+            line += ', utilization ' + str(int(record['utilization'] * 100)) + '%'
+        if record['eta'] is not None and not record['final']:
+            line += ', ETA ' + str(int(record['eta'])) + 's'
+        if record['final']:
+            line += ', done'
+        return line
+
+    def close(self):
+        if not self.enabled:
+            return
+
+        now = perf_counter()
+        self.report(now, self.record.get('rowsin', 0), now - self.starttime, self.totaljobseconds, self.totalworkerseconds, final=True)
+        if self.outfile:
+            self.outfile.close()
+        self.enabled = False
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os
+import importlib
+import subprocess
+from csvProcess.csvIO import readahead_text
+
+# Tools that can be chained in-process, mapped to the module that defines them.
+INPROCESS_COMMANDS = {
+    'csvFilter':  'csvProcess.csvFilter',
+    'csvCollect': 'csvProcess.csvCollect',
+}
+
+class RowStream:
+    # Rows passed between tools running in the same process. Rows are dicts from the
+    # upstream tool, or sequences in the order of fieldnames from a library caller,
+    # presented as tuples in the order of fieldnames with their values rendered as
+    # strings, so that the downstream tool sees exactly what it would have parsed
+    # from the upstream tool's CSV output. The first keycount fieldnames of a
+    # collection are its index.
+
+    def __init__(self, comments, fieldnames, rows, keycount=None):
+        self.comments = comments
+        self.keys = fieldnames
+        self.fieldnames = [str(fieldname) for fieldname in fieldnames]
+        self.rows = iter(rows)
+        self.keycount = keycount
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = next(self.rows)
+        return tuple(value if isinstance(value, str) else '' if value is None else str(value)
+                     for value in ((row.get(key) for key in self.keys) if isinstance(row, dict) else row))
+
+def inprocess_function(cmd):
+    modulename = INPROCESS_COMMANDS.get(os.path.splitext(os.path.basename(cmd))[0])
+    if modulename:
+        module = importlib.import_module(modulename)
+        return getattr(module, modulename.rsplit('.', 1)[1])
+    else:
+        return None
+
+def csvPipeline(stages, verbosity=1):
+    # Run a pipeline given as a list of (cmd, arglist) in execution order. Leading
+    # foreign commands run as subprocesses; the remaining stages must all be known
+    # csvProcess tools and are chained in-process as row streams. Returns False
+    # without running anything if the pipeline does not have that shape.
+    functions = [inprocess_function(cmd) for (cmd, arglist) in stages]
+    firstknown = next((index for index, function in enumerate(functions) if function), len(stages))
+    if firstknown == len(stages) or not all(functions[firstknown:]):
+        return False
+
+    process = None
+    for (cmd, arglist) in stages[:firstknown]:
+        if verbosity >= 1:
+            print("Executing: " + cmd + ' ' + ' '.join(arglist), file=sys.stderr)
+        process = subprocess.Popen([cmd] + arglist,
+                                   stdout=subprocess.PIPE,
+                                   stdin=process.stdout if process else sys.stdin,
+                                   stderr=sys.stderr)
+
+    stream = readahead_text(process.stdout) if process else None
+    for index in range(firstknown, len(stages)):
+        (cmd, arglist) = stages[index]
+        if verbosity >= 1:
+            print("Executing in-process: " + cmd + ' ' + ' '.join(arglist), file=sys.stderr)
+        # The tools record their command name from sys.argv[0] in the comment trail.
+        argv0 = sys.argv[0]
+        sys.argv[0] = cmd
+        try:
+            stream = functions[index](arglist, source=stream, pipeout=index < len(stages) - 1)
+        finally:
+            sys.argv[0] = argv0
+
+    if process:
+        process.wait()
+        if process.returncode:
+            raise RuntimeError("Error running script.")
+
+    return True
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import threading
+import contextlib
+import cProfile
+import pstats
+from time import perf_counter
+
+class ProfileStats:
+    # Holds the stats of a cProfile run returned from a worker, in the form that
+    # pstats.Stats loads.
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+class Profiler:
+    # Records the time and number of calls of each stage of a run. Functions wrapped
+    # with timed() count towards the stages of the job running them: kernels run
+    # by a Backend return their job's stages along with their results, and the
+    # Backend records them with the batch. When not enabled, timed() returns the
+    # function unchanged and stage() does nothing, so an unprofiled run pays
+    # nothing for the instrumentation.
+
+    def __init__(self, outfilename=None, cprofilename=None):
+        self.outfilename = outfilename
+        self.cprofilename = cprofilename
+        self.enabled = bool(outfilename or cprofilename)
+        self.starttime = time.time()
+        self.stages = {}
+        self.jobs = []
+        self.batches = []
+        self.cprofiles = []
+        self.local = threading.local()
+        self.local.stages = self.stages
+        self.local.cprofile = None
+
+    def add(self, stages, name, seconds, calls=1):
+        entry = stages.get(name)
+        if entry is None:
+            stages[name] = [seconds, calls]
+        else:
+            entry[0] += seconds
+            entry[1] += calls
+
+    def timed(self, name, function, user=False):
+        # User functions are also run under cProfile if that was requested.
+        if not self.enabled:
+            return function
+
+        local = self.local
+        def timedfunction(*args, **kwargs):
+            cprofile = local.cprofile if user else None
+            start = perf_counter()
+            if cprofile:
+                cprofile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if cprofile:
+                    cprofile.disable()
+                self.add(local.stages, name, perf_counter() - start)
+
+        return timedfunction
+
+    @contextlib.contextmanager
+    def timing(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(self.stages, name, perf_counter() - start)
+
+    def stage(self, name):
+        return self.timing(name) if self.enabled else contextlib.nullcontext()
+
+    def kernel(self, kernel):
+        # Wrap a kernel so that it returns (result, job profile).
+        local = self.local
+        def profiledkernel(rows, start, stop):
+            (stages, cprofile) = (getattr(local, 'stages', None), getattr(local, 'cprofile', None))
+            local.stages = {}
+            local.cprofile = cProfile.Profile() if self.cprofilename else None
+            kernelstart = perf_counter()
+            try:
+                result = kernel(rows, start, stop)
+                profile = {'rows':    stop - start,
+                           'seconds': perf_counter() - kernelstart,
+                           'stages':  local.stages}
+                if local.cprofile:
+                    local.cprofile.create_stats()
+                    profile['cprofile'] = local.cprofile.stats
+            finally:
+                (local.stages, local.cprofile) = (stages, cprofile)
+
+            return (result, profile)
+
+        return profiledkernel
+
+    def batch(self, rowcount, seconds, profiles):
+        # Record a batch mapped over the jobs. Imbalance is the slowest job's time
+        # over the mean; overhead is the time not spent in the slowest job, that is
+        # starting the jobs and passing rows and results between processes.
+        self.add(self.stages, 'map', seconds)
+        jobseconds = [profile['seconds'] for profile in profiles]
+        meanseconds = sum(jobseconds) / len(jobseconds) if jobseconds else 0
+        self.batches.append({'rows':       rowcount,
+                             'seconds':    round(seconds, 6),
+                             'jobseconds': [round(jobsecond, 6) for jobsecond in jobseconds],
+                             'imbalance':  round(max(jobseconds) / meanseconds, 3) if meanseconds else 1,
+                             'overhead':   round(seconds - max(jobseconds, default=0), 6)})
+
+        for jobindex, profile in enumerate(profiles):
+            if jobindex == len(self.jobs):
+                self.jobs.append({'rows': 0, 'seconds': 0, 'stages': {}})
+            job = self.jobs[jobindex]
+            job['rows'] += profile['rows']
+            job['seconds'] += profile['seconds']
+            for name, (stageseconds, calls) in profile['stages'].items():
+                self.add(job['stages'], name, stageseconds, calls)
+            if 'cprofile' in profile:
+                self.cprofiles.append(ProfileStats(profile['cprofile']))
+
+    def write(self, command):
+        if not self.enabled:
+            return
+
+        def stagereport(stages):
+            return {name: {'seconds': round(seconds, 6), 'calls': calls} for name, (seconds, calls) in stages.items()}
+
+        if self.outfilename:
+            report = {'command': os.path.splitext(os.path.basename(command))[0],
+                      'wall':    round(time.time() - self.starttime, 3),
+                      'stages':  stagereport(self.stages),
+                      'jobs':    [{'job':     jobindex,
+                                   'rows':    job['rows'],
+                                   'seconds': round(job['seconds'], 6),
+                                   'stages':  stagereport(job['stages'])} for jobindex, job in enumerate(self.jobs)],
+                      'batches': self.batches}
+            with open(self.outfilename, 'w') as outfile:
+                json.dump(report, outfile, indent=1)
+
+        if self.cprofilename and self.cprofiles:
+            stats = pstats.Stats(self.cprofiles[0])
+            if len(self.cprofiles) > 1:
+                stats.add(*self.cprofiles[1:])
+            stats.dump_stats(self.cprofilename)
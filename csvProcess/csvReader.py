@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os
+import stat
+import csv
+import glob
+import random
+import subprocess
+import itertools
+import weakref
+from array import array
+from multiprocessing import shared_memory
+from operator import itemgetter
+from csvProcess.csvPipeline import RowStream
+from csvProcess.csvColumnCache import ColumnCache, ColumnBatch
+from csvProcess.csvIO import compression, open_text, read_header, readahead_text
+
+BUFFER_SIZE = 1 << 20
+
+# Names that let an expression reach row values without naming their columns.
+INDIRECT_NAMES = {'kwargs', 'locals', 'vars', 'eval', 'exec', 'globals'}
+
+class CSVReader:
+    # Shared input handling for the csvProcess tools. Reads the comment trail and
+    # header from a file, pipe, stdin, text stream or upstream RowStream, then yields
+    # rows as tuples of strings in the order of fieldnames. Short rows are padded
+    # with None and long rows truncated, as csv.DictReader would present them. With
+    # cache set, an input file is read through its ColumnCache.
+    #
+    # infile may also be a list of file names and glob patterns, read in order as one
+    # input. Their headers must match, and their comment trails are merged. Batches
+    # run on across file boundaries, so that small files are shared among jobs and
+    # large ones split between them.
+
+    def __init__(self, infile=None, pipe=None, source=None, cache=False, verbosity=1):
+        self.file = None
+        self.process = None
+        self.cache = None
+        self.infiles = expand_inputs(infile)
+        self.consumed = 0
+        self.totalsize = None
+        self.sampler = None
+        if isinstance(source, RowStream):
+            self.comments = source.comments
+            self.infieldnames = source.fieldnames
+            self.rows = source
+        elif cache and len(self.infiles) == 1 and source is None:
+            self.cache = ColumnCache.open(self.infiles[0], verbosity)
+            self.comments = self.cache.comments
+            self.infieldnames = self.cache.fieldnames
+            self.rowindex = 0
+        else:
+            if source is not None:
+                self.file = source
+            elif self.infiles:
+                self.file = open_text(self.infiles[0])
+            elif pipe:
+                # Pipes and stdin are read ahead in a thread, so that their producer
+                # need not wait while rows are processed.
+                self.process = subprocess.Popen(pipe, stdout=subprocess.PIPE, shell=True, bufsize=BUFFER_SIZE)
+                self.file = readahead_text(self.process.stdout)
+            else:
+                self.file = readahead_text(open(sys.stdin.fileno(), 'rb', buffering=BUFFER_SIZE, closefd=False))
+
+            # Read comments at start of infile. The first other line is the header.
+            (self.comments, self.infieldnames) = read_header(self.file)
+            if self.infieldnames is None:
+                raise RuntimeError("Input " + (self.infiles[0] if self.infiles else pipe or '<stdin>') + " has no header.")
+
+            # Comment trails of further files are added unless one is already present,
+            # as when the files were written by the same command.
+            for infilename in self.infiles[1:]:
+                with open_text(infilename) as otherfile:
+                    (comments, header) = read_header(otherfile)
+                if header != self.infieldnames:
+                    raise RuntimeError("Input " + infilename + " has a different header from " + self.infiles[0] + ".")
+                if comments not in self.comments:
+                    self.comments += comments
+
+            self.lines = self.readlines() if len(self.infiles) > 1 else self.file
+            self.rows = csv.reader(self.lines)
+            self.records = self.readrecords()
+
+        self.project(None)
+
+    def project(self, columns):
+        # Restrict rows to the given columns, keeping their input order. None selects
+        # all columns.
+        if columns is None:
+            self.indexes = None
+            self.fieldnames = list(self.infieldnames)
+        else:
+            self.indexes = [index for index, fieldname in enumerate(self.infieldnames) if fieldname in columns]
+            self.fieldnames = [self.infieldnames[index] for index in self.indexes]
+
+        self.width = len(self.infieldnames)
+        self.getter = itemgetter(*self.indexes) if self.indexes and len(self.indexes) > 1 else None
+        self.fieldindex = {fieldname: index for index, fieldname in enumerate(self.fieldnames)}
+        if self.cache:
+            self.columns = self.cache.columnlist(self.indexes)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.cache:
+            if self.sampler:
+                while self.rowindex < self.cache.rowcount and not self.sampler.choose(self.rowindex):
+                    self.rowindex += 1
+            if self.rowindex == self.cache.rowcount:
+                raise StopIteration
+            self.rowindex += 1
+            return self.cache.row(self.rowindex - 1, self.columns, self.indexes)
+
+        # Blank lines are skipped, as csv.DictReader does.
+        row = next(self.rows)
+        while row == []:
+            row = next(self.rows)
+
+        return shaperow(row, self.width, self.indexes, self.getter)
+
+    def sample(self, fraction, blockrows=None, seed=None):
+        # Read only a random sample of the rows, or of blocks of blockrows consecutive
+        # rows. Rows that are not sampled are never parsed, and with a column cache
+        # whole blocks are skipped without being read.
+        # Sampled records or rows are read as (unit, record or row), the unit being the
+        # number of the row or block.
+        self.sampler = Sampler(fraction, blockrows or 1, seed)
+        if self.file is not None:
+            self.samples = self.sampler.sample(self.records)
+            self.rows = (next(csv.reader([record])) for (unit, record) in self.samples)
+        elif not self.cache:
+            self.samples = self.sampler.sample(self.rows)
+            self.rows = (row for (unit, row) in self.samples)
+
+    def readlines(self):
+        # Lines of each input file in turn, skipping the comments and header of all
+        # but the first. Each file is opened only once the one before is finished.
+        yield from self.file
+        for infilename in self.infiles[1:]:
+            self.consumed += self.file.buffer.tell()
+            self.file.close()
+            self.file = open_text(infilename)
+            read_header(self.file)
+            yield from self.file
+
+    def readrecords(self):
+        # Raw CSV records, each one or more lines. A line with an odd number of
+        # quotes may end inside a quoted field, in which case the record continues
+        # until it parses.
+        record = ''
+        for line in self.lines:
+            record += line
+            if record.count('"') % 2:
+                try:
+                    next(csv.reader([record], strict=True))
+                except csv.Error:
+                    continue
+
+            if record.strip('\r\n'):
+                yield record
+            record = ''
+
+        if record:
+            yield record
+
+    def batch(self, count):
+        # The next count rows as a sequence. Rows read from text are kept unparsed in
+        # a RowBatch; rows from an upstream tool are already parsed. A sample's batch
+        # has the sample unit of each row in units.
+        if self.cache:
+            if self.sampler:
+                rowindexes = array('q')
+                units = array('q')
+                while len(rowindexes) < count and self.rowindex < self.cache.rowcount:
+                    if self.sampler.choose(self.rowindex):
+                        rowindexes.append(self.rowindex)
+                        units.append(self.sampler.unit)
+                        self.rowindex += 1
+                    else:
+                        self.rowindex = (self.sampler.unit + 1) * self.sampler.blockrows
+                return ColumnBatch(self.cache, 0, 0, self.indexes, rowindexes, units) if rowindexes else []
+
+            start = self.rowindex
+            self.rowindex = min(start + count, self.cache.rowcount)
+            return ColumnBatch(self.cache, start, self.rowindex, self.indexes) if self.rowindex > start else []
+        elif self.sampler:
+            samples = list(itertools.islice(self.samples, count))
+            units = array('q', [unit for (unit, item) in samples])
+            if self.file is None:
+                return RowList([shaperow(row, self.width, self.indexes, self.getter) for (unit, row) in samples], units)
+            return RowBatch([record for (unit, record) in samples], self.width, self.indexes, units) if samples else []
+        elif self.file is None:
+            return list(itertools.islice(self, count))
+
+        records = list(itertools.islice(self.records, count))
+        return RowBatch(records, self.width, self.indexes) if records else []
+
+    def size(self):
+        # Size in bytes of a regular input file or uncompressed input files, otherwise
+        # None.
+        if self.cache:
+            return self.cache.rowcount
+        if len(self.infiles) > 1:
+            if self.totalsize is None and not any(compression(infilename) for infilename in self.infiles):
+                self.totalsize = sum(os.path.getsize(infilename) for infilename in self.infiles)
+            return self.totalsize
+        try:
+            status = os.fstat(self.file.fileno())
+        except (AttributeError, OSError, ValueError):
+            return None
+        return status.st_size if stat.S_ISREG(status.st_mode) else None
+
+    def position(self):
+        # Bytes read so far from a seekable input, including buffered readahead,
+        # otherwise None. A cached input counts rows rather than bytes.
+        if self.cache:
+            return self.rowindex
+        try:
+            return self.consumed + self.file.buffer.tell()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        if self.process:
+            self.process.wait()
+
+class Sampler:
+    # Chooses a random sample of rows, or of blocks of consecutive rows, each with
+    # probability fraction. Choices are drawn in input order from a seeded generator,
+    # so that the sample depends only on the seed and not on how the input is read
+    # or batched.
+
+    def __init__(self, fraction, blockrows=1, seed=None):
+        if not 0 < fraction <= 1:
+            raise RuntimeError("Sample fraction must be greater than 0 and at most 1.")
+
+        self.fraction = fraction
+        self.blockrows = blockrows
+        self.random = random.Random(0 if seed is None else seed)
+        self.unit = -1
+        self.chosen = False
+
+    def choose(self, rownumber):
+        # Whether the row numbered rownumber is sampled, for increasing row numbers.
+        unit = rownumber // self.blockrows
+        if unit != self.unit:
+            self.unit = unit
+            self.chosen = self.random.random() < self.fraction
+        return self.chosen
+
+    def sample(self, items):
+        for (rownumber, item) in enumerate(items):
+            if self.choose(rownumber):
+                yield (self.unit, item)
+
+def expand_inputs(infile):
+    # Input file names from a name or list of names and glob patterns, each pattern
+    # expanded in sorted order. A pattern matching nothing is kept, so that opening
+    # it reports the missing file.
+    if infile is None:
+        return []
+    elif isinstance(infile, str):
+        infile = [infile]
+
+    infiles = []
+    for pattern in infile:
+        infiles += sorted(glob.glob(pattern)) or [pattern]
+    return infiles
+
+def shaperow(row, width, indexes, getter):
+    if len(row) != width:
+        row = list(row[:width]) + [None] * (width - len(row))
+
+    if indexes is None:
+        return tuple(row)
+    elif getter:
+        return getter(row)
+    else:
+        return tuple(row[index] for index in indexes)
+
+class RowBatch:
+    # A batch of raw CSV records held as their UTF-8 text in one shared memory
+    # block, with an array of offsets. Parallel workers parse only the rows they
+    # are given, and the batch is never pickled or copied row by row; forked
+    # workers share the block rather than touching the reference counts of
+    # per-row objects inherited from the parent. Pickling a batch, as for a
+    # process pool, sends only the block name and offsets. The block is freed by
+    # close() or when the batch is garbage collected.
+
+    def __init__(self, records, width, indexes, units=None):
+        encoded = [record.encode('utf-8') for record in records]
+        offsets = array('q', itertools.accumulate([0] + [len(record) for record in encoded]))
+        self.count = len(records)
+        self.units = units
+        self.width = width
+        self.indexes = indexes
+        self.getter = itemgetter(*indexes) if indexes and len(indexes) > 1 else None
+        self.offsets = offsets
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offsets[-1], 1))
+        self.shm.buf[:offsets[-1]] = b''.join(encoded)
+        self.finalizer = weakref.finalize(self, RowBatch.release, self.shm)
+
+    @staticmethod
+    def release(shm):
+        shm.close()
+        shm.unlink()
+
+    def __getstate__(self):
+        return (self.shm.name, self.offsets, self.count, self.units, self.width, self.indexes)
+
+    def __setstate__(self, state):
+        (name, self.offsets, self.count, self.units, self.width, self.indexes) = state
+        self.getter = itemgetter(*self.indexes) if self.indexes and len(self.indexes) > 1 else None
+        # Only the creator unlinks the block.
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.finalizer = weakref.finalize(self, self.shm.close)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0 or index >= self.count:
+            raise IndexError(index)
+
+        record = bytes(self.shm.buf[self.offsets[index]:self.offsets[index + 1]]).decode('utf-8')
+        return shaperow(next(csv.reader([record])), self.width, self.indexes, self.getter)
+
+    def close(self):
+        self.finalizer()
+
+class RowList(list):
+    # Parsed rows of a sample, with the sample unit of each row.
+    def __init__(self, rows, units):
+        super().__init__(rows)
+        self.units = units
+
+def expression_columns(expressions, fieldnames, clean):
+    # The columns an expression can refer to, found from the names in its compiled
+    # code, or None if it might refer to any column.
+    names = set()
+    def addnames(code):
+        names.update(code.co_names)
+        names.update(code.co_varnames)
+        for const in code.co_consts:
+            if hasattr(const, 'co_names'):
+                addnames(const)
+
+    for expression in expressions:
+        addnames(compile(expression, '<expression>', 'eval'))
+
+    if names & INDIRECT_NAMES:
+        return None
+
+    return [fieldname for fieldname in fieldnames if clean(fieldname) in names]
@@ -23,6 +23,13 @@ import sys
 import re
 from datetime import datetime
 import subprocess
+import hashlib
+import json
+import shutil
+import time
+from csvProcess.csvPipeline import csvPipeline
+from csvProcess.csvStats import read_stats
+from csvProcess.csvIO import read_comments
 
 # Work out whether the user wants gooey before gooey has a chance to strip the argument
 gui = '--gui' in sys.argv
@@ -51,10 +58,20 @@ def add_arguments(parser):
                              help='Replay even if input file is not older than its dependents.')
     replaygroup.add_argument(      '--dry-run', action='store_true',
                              help='Print but do not execute command')
+    replaygroup.add_argument(      '--plan', action='store_true',
+                             help='Print the steps that would be executed, why, and how long they took last time, without executing them.')
     replaygroup.add_argument(      '--edit', action='store_true',
                              help='Add --gui argument when replaying commands. If supported, this will open a window to allow editing of the command arguments.')
     replaygroup.add_argument(      '--substitute', nargs='*', type=str,
                              help='List of variable:value pairs for substitution')
+    replaygroup.add_argument(      '--in-process', action='store_true',
+                             help='Run csvProcess tools in this process, passing rows directly between pipeline stages. Other commands still run as subprocesses.')
+    replaygroup.add_argument(      '--cache-dir', type=str, default='.csvcache',
+                             help='Directory holding the replay manifest and cached outputs. Cached outputs are kept without limit unless --cache-limit is given.')
+    replaygroup.add_argument(      '--cache-limit', type=float,
+                             help='Evict the least recently used cached outputs once they take more than this many megabytes; 0 empties the cache.')
+    replaygroup.add_argument(      '--no-cache', action='store_true',
+                             help='Use file modification times rather than content hashes to decide what to replay.')
 
     advancedgroup = parser.add_argument_group('Advanced')
     advancedgroup.add_argument('-v', '--verbosity', type=int, default=1)
@@ -87,12 +104,169 @@ else:
 def build_comments(kwargs):
     return ''
 
+# The replay manifest records the content hash of every file it has seen (memoised
+# on size and modification time so unchanged files are not re-read), the key and
+# output hash of each replayed step and, for each step key, the hash of the output
+# it produced. Outputs themselves are kept in a content-addressed object store.
+def load_manifest(cache_dir):
+    manifestname = os.path.join(cache_dir, 'manifest.json')
+    if os.path.isfile(manifestname):
+        with open(manifestname, 'r') as manifestfile:
+            return json.load(manifestfile)
+    else:
+        return {'files': {}, 'steps': {}, 'outputs': {}}
+
+def save_manifest(cache_dir, manifest):
+    os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+    manifestname = os.path.join(cache_dir, 'manifest.json')
+    with open(manifestname + '.tmp', 'w') as manifestfile:
+        json.dump(manifest, manifestfile, indent=1, sort_keys=True)
+    os.replace(manifestname + '.tmp', manifestname)
+
+def file_hash(filename, manifest):
+    stat = os.stat(filename)
+    filepath = os.path.abspath(filename)
+    fileentry = manifest['files'].get(filepath)
+    if fileentry and fileentry['size'] == stat.st_size and fileentry['mtime'] == stat.st_mtime:
+        return fileentry['hash']
+
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fileobject:
+        for chunk in iter(lambda: fileobject.read(1 << 20), b''):
+            digest.update(chunk)
+
+    filehash = digest.hexdigest()
+    manifest['files'][filepath] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': filehash}
+    return filehash
+
+# pending maps files that a dry run would have restored from the cache to the hash
+# of their restored content.
+def step_key(pipestack, infilelist, manifest, pending=None):
+    # Normalise the command line by dropping arguments that do not affect the output
+    commands = []
+    for (cmd, arglist) in reversed(pipestack):
+        normargs = []
+        argiter = iter(arglist)
+        for arg in argiter:
+            if arg == '--verbosity':
+                next(argiter, None)
+            elif arg != '--gui':
+                normargs.append(arg)
+        commands.append([os.path.splitext(os.path.basename(cmd))[0]] + normargs)
+
+    inhashes = []
+    for infilename in infilelist:
+        if pending and os.path.abspath(infilename) in pending:
+            inhashes.append(pending[os.path.abspath(infilename)])
+        elif not os.path.isfile(infilename):
+            return None
+        else:
+            inhashes.append(file_hash(infilename, manifest))
+
+    return hashlib.sha256(json.dumps([commands, inhashes]).encode('utf-8')).hexdigest()
+
+def object_name(cache_dir, filehash):
+    return os.path.join(cache_dir, 'objects', filehash)
+
+def record_output(cache_dir, manifest, key, outfilename, wall=None):
+    outhash = file_hash(outfilename, manifest)
+    objectname = object_name(cache_dir, outhash)
+    if not os.path.isfile(objectname):
+        os.makedirs(os.path.dirname(objectname), exist_ok=True)
+        shutil.copyfile(outfilename, objectname + '.tmp')
+        os.replace(objectname + '.tmp', objectname)
+    else:
+        os.utime(objectname)
+
+    manifest['steps'][os.path.abspath(outfilename)] = {'key': key, 'hash': outhash}
+    if wall is not None:
+        manifest['steps'][os.path.abspath(outfilename)]['wall'] = round(wall, 3)
+    manifest['outputs'][key] = outhash
+
+def evict_objects(cache_dir, manifest, limit):
+    # Remove the least recently used objects, by modification time, until the rest
+    # take at most limit bytes, and forget the step outputs they held and files that
+    # no longer exist. Returns the number of objects removed.
+    objectdir = os.path.join(cache_dir, 'objects')
+    objects = []
+    if os.path.isdir(objectdir):
+        for entry in os.scandir(objectdir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                objects.append((stat.st_mtime, stat.st_size, entry.name))
+
+    total = sum(size for (mtime, size, name) in objects)
+    evicted = set()
+    for (mtime, size, name) in sorted(objects):
+        if total <= limit:
+            break
+        os.remove(os.path.join(objectdir, name))
+        evicted.add(name)
+        total -= size
+
+    manifest['outputs'] = {key: outhash for (key, outhash) in manifest['outputs'].items() if outhash not in evicted}
+    manifest['files'] = {filepath: fileentry for (filepath, fileentry) in manifest['files'].items() if os.path.isfile(filepath)}
+    return len(evicted)
+
+def estimated_duration(outfilename, manifest):
+    # Prefer the timing the tool recorded itself, then the time csvReplay last took.
+    stats = read_stats(outfilename)
+    if stats:
+        return stats.get('wall')
+    step = manifest['steps'].get(os.path.abspath(outfilename)) if manifest and outfilename else None
+    return step.get('wall') if step else None
+
+def print_plan(planned, manifest):
+    producers = {}
+    total = 0
+    unknown = 0
+    count = 0
+    for stepno, (outfilename, stages, inputs, reason) in enumerate(planned, 1):
+        estimate = estimated_duration(outfilename, manifest)
+        print("Step " + str(stepno) + ": " + (outfilename or '<stdout>')
+              + " [" + (reason or 'current') + "]"
+              + ((" est. " + ("%.1fs" % estimate if estimate is not None else "unknown")) if reason else ''))
+        for (cmd, arglist) in stages:
+            print("    " + cmd + ' ' + ' '.join(arglist))
+        for infilename in inputs:
+            print("    < " + infilename + (" (step " + str(producers[os.path.abspath(infilename)]) + ")"
+                                        if os.path.abspath(infilename) in producers else ''))
+
+        if outfilename:
+            producers[os.path.abspath(outfilename)] = stepno
+        if reason and reason != 'cached':
+            count += 1
+            if estimate is None:
+                unknown += 1
+            else:
+                total += estimate
+
+    print(str(count) + " of " + str(len(planned)) + " steps to execute, estimated " + "%.1fs" % total
+          + ((" plus " + str(unknown) + " without timings") if unknown else ''))
+
+def mtime_stale(infilelist, outfilename):
+    outfilestamp = (datetime.utcfromtimestamp(os.path.getmtime(outfilename)) if os.path.isfile(outfilename) else None) if outfilename else None
+    if not infilelist:
+        return True
+    for infilename in infilelist:
+        if not os.path.isfile(infilename):
+            return True
+        if datetime.utcfromtimestamp(os.path.getmtime(infilename)) > (outfilestamp or datetime.min):
+            return True
+
+    return False
+
 def csvReplay(input_file, force, dry_run, edit,
               verbosity, depth, remove,
-              extraargs=[], substitute={}, **dummy):
+              extraargs=[], substitute={}, cache_dir='.csvcache', no_cache=False, in_process=False, plan=False, cache_limit=None, **dummy):
+    if plan:
+        dry_run = True
+
+    # Accept both the original '#     --name="value"' comment trail and the argrecord
+    # format, where input and output arguments are flagged with '<' and '>'.
     fileregexp = re.compile(r"^#+(?:\s+(?P<file>.+)\s+)?#+$", re.UNICODE)
-    cmdregexp  = re.compile(r"^#\s+(?P<cmd>[\w\.-]+)", re.UNICODE)
-    argregexp  = re.compile(r"^#\s+(?:--)?(?P<name>[\w-]+)(?:=(?P<quote>\"?)(?P<value>.+)(?P=quote))?", re.UNICODE)
+    cmdregexp  = re.compile(r"^#[<>]*\s+(?P<cmd>[\w\.-]+)\s*$", re.UNICODE)
+    argregexp  = re.compile(r"^#(?P<dependency>[<> ])(?P<indent>\s*)(?:--(?P<name>[\w-]+))?\s*(?:=?(?P<quote>\"?)(?P<value>.+?)(?P=quote))?\s*$", re.UNICODE)
     piperegexp = re.compile(r"^#+$", re.UNICODE)
     argvalexp  = re.compile(r"(\$\{?(\w+)\}?)", re.UNICODE)
 
@@ -104,15 +278,7 @@ def csvReplay(input_file, force, dry_run, edit,
             print("Replaying " + infilename, file=sys.stderr)
 
         # Read comments at start of infile.
-        infile = open(infilename, 'r')
-        comments = []
-        while True:
-            line = infile.readline()
-            if line[:1] == '#':
-                comments.append(line)
-            else:
-                infile.close()
-                break
+        comments = read_comments(infilename).splitlines(keepends=True)
 
         if remove:
             os.remove(infilename)
@@ -137,13 +303,35 @@ def csvReplay(input_file, force, dry_run, edit,
                 else:
                     break
 
+                # A command's arguments end with its input lines, flagged '<', a bare
+                # one meaning its input was piped from the command recorded next. A
+                # value without a name continues the argument above it only if
+                # indented beyond it; other comment lines are skipped.
                 arglist = []
                 lastargname = ''
+                argindent = None
+                inputs = False
+                piped = False
                 commentline = comments.pop(0) if len(comments) else None
-                argmatch = argregexp.match(commentline) if commentline else None
-                while argmatch:
-                    argname  = argmatch.group('name')
-                    argvalue = argmatch.group('value')
+                while commentline and not fileregexp.match(commentline):
+                    argmatch = argregexp.match(commentline)
+                    dependency = argmatch.group('dependency') if argmatch else None
+                    if inputs and dependency != '<':
+                        break
+
+                    argname  = argmatch.group('name') if argmatch else None
+                    argvalue = argmatch.group('value') if argmatch else None
+                    if dependency == '<':
+                        inputs = True
+                        piped = piped or not (argname or argvalue)
+                    elif argname:
+                        argindent = len(argmatch.group('indent'))
+                    elif argvalue and argindent is not None and len(argmatch.group('indent')) > argindent:
+                        argname = lastargname
+                    else:
+                        argindent = None
+                        commentline = comments.pop(0) if len(comments) else None
+                        continue
 
                     if argvalue:
                         argvalsubs = argvalexp.findall(argvalue)
@@ -155,8 +343,8 @@ def csvReplay(input_file, force, dry_run, edit,
 
                             argvalue = argvalue.replace(argvalsub[0], subval)
 
-                    if argname == 'infile':
-                        if argvalue != '<stdin>':
+                    if argname == 'infile' or (argname is None and dependency == '<'):
+                        if argvalue and argvalue != '<stdin>':
                             infilelist.append(argvalue)
                     else:
                         if argname == 'outfile':
@@ -165,7 +353,7 @@ def csvReplay(input_file, force, dry_run, edit,
                                 if filename and filename != outfile:
                                     print("WARNING: Argument outfile: " + outfile + " differs from comment filename: " + filename, file=sys.stderr)
                         else:
-                            if argname != lastargname:
+                            if argname and argname != lastargname:
                                 arglist.append('--' + argname)
                                 lastargname = argname
 
@@ -173,10 +361,11 @@ def csvReplay(input_file, force, dry_run, edit,
                                 arglist.append(argvalue)
 
                     commentline = comments.pop(0) if len(comments) else None
-                    argmatch = argregexp.match(commentline) if commentline else None
 
                 pipestack.append((cmd, arglist + extraargs + ['--verbosity', str(verbosity)]))
-                pipematch = piperegexp.match(commentline) if commentline else None
+                # A separator after a piped input, or in the original format after a
+                # command without inputs, starts the command that fed it.
+                pipematch = piperegexp.match(commentline) if commentline and (piped or not inputs) else None
 
             replaystack.append((pipestack, infilelist, outfile))
 
@@ -192,20 +381,51 @@ def csvReplay(input_file, force, dry_run, edit,
         else:
             pipestack = None
 
+        if not no_cache:
+            manifest = load_manifest(cache_dir)
+
+        planned = []
+        pending = {}
         execute = force
         while pipestack:
-            if not execute:
-                outfilestamp = (datetime.utcfromtimestamp(os.path.getmtime(outfilename)) if os.path.isfile(outfilename) else None) if outfilename else None
-                if not infilelist:
-                    execute = True
-                for infilename in infilelist:
-                    infilestamp = (datetime.utcfromtimestamp(os.path.getmtime(infilename)) if os.path.isfile(infilename) else None) if infilename else None
-                    if infilestamp > (outfilestamp or datetime.min):
-                        execute = True
-                        break
+            key = None
+            restore = None
+            reason = None
+            stepinputs = list(infilelist or [])
+            if not no_cache and infilelist and outfilename:
+                key = step_key(pipestack, infilelist, manifest, pending)
 
             if execute:
-                process = None
+                reason = 'forced' if force else 'upstream'
+            elif no_cache or key is None:
+                if mtime_stale(infilelist, outfilename):
+                    reason = 'stale' if outfilename and os.path.isfile(outfilename) else 'missing'
+            else:
+                step = manifest['steps'].get(os.path.abspath(outfilename))
+                if os.path.isfile(outfilename) and step and step['key'] == key:
+                    if file_hash(outfilename, manifest) != step['hash']:
+                        reason = 'modified'
+                elif key in manifest['outputs'] and os.path.isfile(object_name(cache_dir, manifest['outputs'][key])):
+                    restore = object_name(cache_dir, manifest['outputs'][key])
+                    reason = 'cached'
+                elif step is None and os.path.isfile(outfilename) and not mtime_stale(infilelist, outfilename):
+                    # Output predates the manifest but is up to date; adopt it.
+                    if not dry_run:
+                        record_output(cache_dir, manifest, key, outfilename)
+                else:
+                    reason = 'stale' if os.path.isfile(outfilename) else 'missing'
+
+            execute = reason is not None and not restore
+            # A dry run restores nothing, so dependents are keyed on the content a
+            # restore would have given their input, as a replay would key them.
+            if restore and dry_run:
+                pending[os.path.abspath(outfilename)] = manifest['outputs'][key]
+
+            if plan:
+                planned.append((outfilename, list(reversed(pipestack)), stepinputs, reason))
+            elif execute:
+                stepstart = time.time()
+                stages = []
                 while len(pipestack):
                     (cmd, arglist) = pipestack.pop()
                     if infilelist:
@@ -217,33 +437,66 @@ def csvReplay(input_file, force, dry_run, edit,
                     if edit:
                         arglist += ['--gui']
 
-                    if verbosity >= 1:
-                        print("Executing: " + cmd + ' ' + ' '.join(arglist), file=sys.stderr)
+                    stages.append((cmd, arglist))
 
-                    if not dry_run:
-                        if not process:
-                            process = subprocess.Popen([cmd] + arglist,
-                                                       stdout=subprocess.PIPE if len(pipestack) else sys.stdout,
-                                                       stdin=sys.stdin,
-                                                       stderr=sys.stderr)
-                        else:
+                # csvPipeline declines pipelines that need a subprocess after an in-process stage
+                inprocess = in_process and not edit and not dry_run and csvPipeline(stages, verbosity)
+                if not inprocess:
+                    process = None
+                    for index, (cmd, arglist) in enumerate(stages):
+                        if verbosity >= 1:
+                            print("Executing: " + cmd + ' ' + ' '.join(arglist), file=sys.stderr)
+
+                        if not dry_run:
                             process = subprocess.Popen([cmd] + arglist,
-                                                       stdout=subprocess.PIPE if len(pipestack) else sys.stdout,
-                                                       stdin=process.stdout,
+                                                       stdout=subprocess.PIPE if index < len(stages) - 1 else sys.stdout,
+                                                       stdin=process.stdout if process else sys.stdin,
                                                        stderr=sys.stderr)
+                    if not dry_run:
+                        process.wait()
+                        if process.returncode:
+                            raise RuntimeError("Error running script.")
+
+                if not dry_run:
+                    if key:
+                        record_output(cache_dir, manifest, key, outfilename, time.time() - stepstart)
+                        save_manifest(cache_dir, manifest)
+            elif restore:
+                if verbosity >= 1:
+                    print("Restoring from cache: " + outfilename, file=sys.stderr)
                 if not dry_run:
-                    process.wait()
-                    if process.returncode:
-                        raise RuntimeError("Error running script.")
+                    if os.path.isfile(outfilename):
+                        shutil.move(outfilename, outfilename + '.bak')
+                    shutil.copyfile(restore, outfilename)
+                    os.utime(restore)
+                    manifest['steps'][os.path.abspath(outfilename)] = {'key': key, 'hash': manifest['outputs'][key]}
+                    save_manifest(cache_dir, manifest)
             else:
                 if verbosity >= 2:
                     print("File not replayed: " + outfilename, file=sys.stderr)
 
+            # Once a step has been replayed, its dependents are checked against the new
+            # content, unless nothing was actually executed.
+            if no_cache or dry_run:
+                execute = execute or force
+            else:
+                execute = force
+
             if replaystack:
                 (pipestack, infilelist, outfilename) = replaystack.pop()
             else:
                 pipestack = None
 
+        if plan:
+            print_plan(planned, manifest if not no_cache else None)
+
+        if not no_cache and not dry_run:
+            if cache_limit is not None:
+                evicted = evict_objects(cache_dir, manifest, cache_limit * (1 << 20))
+                if evicted and verbosity >= 1:
+                    print("Evicted " + str(evicted) + " cached outputs.", file=sys.stderr)
+            save_manifest(cache_dir, manifest)
+
 def main():
     kwargs = parse_arguments()
     kwargs['func'](**kwargs)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os
+import json
+import time
+from datetime import datetime
+import resource
+
+# Each tool writing to an output file leaves a sidecar beside it recording how the
+# run went, which csvReplay uses to estimate how long a replay will take. Outputs
+# that are not regular files, such as /dev/null, have none.
+def stats_filename(outfilename):
+    return outfilename + '.stats.json'
+
+def peak_rss():
+    # Peak resident set size in kilobytes of this process or any of its waited-for
+    # children, such as pymp workers. ru_maxrss is in bytes on macOS.
+    maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss
+
+def write_stats(outfilename, command, starttime, **counts):
+    if outfilename is None or not os.path.isfile(outfilename):
+        return
+
+    stats = {'command': os.path.splitext(os.path.basename(command))[0],
+             'start':   datetime.utcfromtimestamp(starttime).isoformat(),
+             'wall':    round(time.time() - starttime, 3),
+             'maxrss':  peak_rss()}
+    stats.update(counts)
+    # The statistics are only advisory, so failing to write them does not fail the
+    # run whose output has already been written.
+    try:
+        with open(stats_filename(outfilename), 'w') as statsfile:
+            json.dump(stats, statsfile, indent=1, sort_keys=True)
+    except OSError as error:
+        print("WARNING: Could not write " + stats_filename(outfilename) + ": " + str(error), file=sys.stderr)
+
+def read_stats(outfilename):
+    if outfilename and os.path.isfile(stats_filename(outfilename)):
+        with open(stats_filename(outfilename), 'r') as statsfile:
+            return json.load(statsfile)
+    else:
+        return None
@@ -8,7 +8,12 @@ setup(
         "gui_scripts": ['csvReplay  = csvProcess.csvReplay:main',
                         'csvCollect = csvProcess.csvCollect:csvCollect',
                         'csvCloud   = csvProcess.csvCloud:csvCloud',
-                        'csvFilter  = csvProcess.csvFilter:csvFilter']
+                        'csvFilter  = csvProcess.csvFilter:csvFilter'],
+        "console_scripts": ['csvBench   = csvProcess.csvBench:csvBench',
+                            'csvDaemon  = csvProcess.csvDaemon:csvDaemon',
+                            'csvClient  = csvProcess.csvClient:csvClient',
+                            'csvCompare = csvProcess.csvCompare:csvCompare',
+                            'csvCheck   = csvProcess.csvCheck:main']
         },
     version = "0.1",
     description = "Multi-threaded CSV processing tools",